@@ -0,0 +1,520 @@
+# bench_orders.py
+"""
+Сквозной бенчмарк без сети: создание заказов, рассылка предложений водителям и отмена
+против локальной заглушки Bot API (mock_telegram.py) на временной базе.
+
+    python bench_orders.py --drivers 300 --orders 20 --latency-ms 40
+    python bench_orders.py --payload    # только стоимость подготовки предложения на водителя
+    python bench_orders.py --waves --bid-after 2 --drivers 300    # рассылка волнами, заявка через 2 с
+    python bench_orders.py --geo --drivers 10000    # поиск ближайших водителей в GeoGrid
+    python bench_orders.py --board --drivers 5000    # WebSocket-доска заказов, 5000 подключений
+    python bench_orders.py --accept-race --orders 200 --contenders 20 --processes 4    # гонка принятия заявок
+    python bench_orders.py --bid-counts --rounds 200    # время ответа GET /bids при 1..100 заявках
+    python bench_orders.py --session --messages 2000    # сообщений/с: общая keep-alive сессия против новой на запрос
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+import database
+import telegram_api
+from mock_telegram import MockTelegram, start_mock_server
+
+
+async def wait_outbox_drained(expected: int, timeout: float):
+    """Ждёт, пока все expected сообщений будут поставлены в outbox и обработаны."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = await database.outbox_counts()
+        if sum(counts.values()) >= expected and not counts.get("pending") and not counts.get("sending"):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def bench_payload(drivers: int, rounds: int = 20):
+    """Сравнивает CPU на получателя: сборка тела для каждого водителя против PreparedMessage."""
+    from webapp import build_message_payload
+    text = "🔥 <b>Новый заказ №1</b>\n\n📍 <b>Откуда:</b> ул. Ленина, 1\n🏁 <b>Куда:</b> аэропорт\n" * 2
+    keyboard = {"inline_keyboard": [[{"text": "✅ Принять заказ", "callback_data": "accept_1"}]]}
+    driver_ids = range(1_000_000, 1_000_000 + drivers)
+
+    def per_driver():
+        for driver_id in driver_ids:
+            # Сборка payload, запись в outbox, чтение воркером и сериализация aiohttp
+            body = json.dumps(build_message_payload(driver_id, text, keyboard), ensure_ascii=False)
+            json.dumps(json.loads(body)).encode()
+
+    def prepared():
+        message = telegram_api.PreparedMessage("sendMessage", build_message_payload(0, text, keyboard))
+        for driver_id in driver_ids:
+            message.body(driver_id).encode()
+
+    for name, func in (("на каждого водителя", per_driver), ("PreparedMessage", prepared)):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        per_recipient_us = (time.perf_counter() - started) / (rounds * drivers) * 1e6
+        print(f"{name}: {per_recipient_us:.2f} мкс на получателя")
+
+
+def bench_geo(drivers: int, queries: int = 2000, center=(69.349, 88.201), spread_km: float = 15.0):
+    """Поиск k ближайших в GeoGrid на drivers случайных позициях вокруг центра + сверка с перебором."""
+    from dispatch import GeoGrid, DISPATCH_WAVE_SIZE, KM_PER_DEGREE, distance_km
+
+    rng = random.Random(1)
+    lat_spread = spread_km / KM_PER_DEGREE
+    lon_spread = lat_spread / max(0.01, abs(__import__("math").cos(__import__("math").radians(center[0]))))
+
+    def random_point():
+        return center[0] + rng.uniform(-lat_spread, lat_spread), center[1] + rng.uniform(-lon_spread, lon_spread)
+
+    grid = GeoGrid()
+    positions = {driver_id: random_point() for driver_id in range(drivers)}
+    started = time.perf_counter()
+    for driver_id, (lat, lon) in positions.items():
+        grid.update(driver_id, lat, lon)
+    update_us = (time.perf_counter() - started) / drivers * 1e6
+    print(f"Водителей: {drivers}, обновление позиции: {update_us:.2f} мкс")
+
+    points = [random_point() for _ in range(queries)]
+    for radius_km in (2, 5, 10):
+        started = time.perf_counter()
+        for lat, lon in points:
+            grid.nearest(lat, lon, radius_km, DISPATCH_WAVE_SIZE)
+        per_query_ms = (time.perf_counter() - started) / queries * 1000
+        print(f"k={DISPATCH_WAVE_SIZE}, R={radius_km} км: {per_query_ms:.3f} мс на запрос")
+
+    # Сверка с полным перебором
+    for lat, lon in points[:50]:
+        expected = sorted(
+            (distance_km(lat, lon, d_lat, d_lon), driver_id) for driver_id, (d_lat, d_lon) in positions.items()
+            if distance_km(lat, lon, d_lat, d_lon) <= 5
+        )[:DISPATCH_WAVE_SIZE]
+        assert grid.nearest(lat, lon, 5, DISPATCH_WAVE_SIZE) == expected, "GeoGrid расходится с перебором"
+    print("Сверка с перебором: OK")
+
+
+async def bench_session(args):
+    """
+    Сообщений в секунду через call_api с общей keep-alive сессией против новой aiohttp-сессии
+    (новое TCP-соединение) на каждое сообщение. Лимиты Telegram отключены, меряется только HTTP.
+    """
+    import aiohttp
+
+    mock = MockTelegram(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+    runner = await start_mock_server(mock, port=args.port)
+    api_url = f"http://127.0.0.1:{args.port}/botBENCH"
+    telegram_api.GLOBAL_LIMITER = telegram_api.TokenBucket(1_000_000)
+    chats = [1_000_000 + i for i in range(args.messages)]
+
+    async def shared(chat_id) -> bool:
+        data = await telegram_api.call_api(
+            api_url, "sendMessage", {"chat_id": chat_id, "text": "bench"}, chat_id=chat_id
+        )
+        return bool(data and data.get("ok"))
+
+    async def per_message(chat_id) -> bool:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{api_url}/sendMessage", json={"chat_id": chat_id, "text": "bench"}) as response:
+                data = await response.json(content_type=None)
+        return bool(data.get("ok"))
+
+    # Прогрев: соединения общей сессии открываются до замера, как в работающем процессе
+    await telegram_api.fan_out(shared, chats[:args.concurrency], args.concurrency)
+    for name, send in (("общая сессия", shared), ("сессия на сообщение", per_message)):
+        started = time.perf_counter()
+        stats = await telegram_api.fan_out(send, chats, args.concurrency)
+        elapsed = time.perf_counter() - started
+        print(f"{name}: {stats['sent']} сообщений за {elapsed:.2f} с ({stats['sent'] / elapsed:.0f}/с), "
+              f"ошибок {stats['failed']}")
+
+    await telegram_api.close_session()
+    await runner.cleanup()
+
+
+BID_COUNTS = (1, 10, 25, 50, 100)
+
+
+async def bench_bid_counts(args):
+    """Время ответа GET /api/web/order/{id}/bids в зависимости от числа заявок (авто и рейтинг водителей)."""
+    from fastapi import Response
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="taxi_bench_"), "taxi_bot.db")
+    database.DB_PATH = db_path
+    import webapp
+    webapp.DB_PATH = db_path
+    await database.migrate_all()
+
+    drivers = [1_000_000 + i for i in range(max(BID_COUNTS))]
+    order_ids = {}
+    async with database.writer(db_path) as db:
+        await db.executemany(
+            "INSERT INTO users (user_id, role, shift_opened, is_verified, car_brand, car_number, has_co_driver) "
+            "VALUES (?, 'driver', 1, 1, 'Лада', ?, ?)",
+            [(driver_id, f"А{i:03d}АА", i % 2) for i, driver_id in enumerate(drivers)]
+        )
+        await db.execute("INSERT INTO users (user_id, role) VALUES (1, 'client')")
+        # Рейтинги водителей: агрегаты user_rating_stats обновляют триггеры
+        await db.executemany(
+            "INSERT INTO ratings (order_id, rater_id, target_id, rating) VALUES (?, 1, ?, ?)",
+            [(-i * 10 - k, driver_id, 3 + (i + k) % 3) for i, driver_id in enumerate(drivers) for k in range(5)]
+        )
+        for count in BID_COUNTS:
+            cursor = await db.execute(
+                "INSERT INTO orders (client_id, pickup_address, dropoff_address, status) VALUES (1, 'A', 'B', 'pending')"
+            )
+            order_ids[count] = cursor.lastrowid
+            await db.executemany(
+                "INSERT INTO bids (order_id, driver_id, arrival_minutes) VALUES (?, ?, 5)",
+                [(cursor.lastrowid, driver_id) for driver_id in drivers[:count]]
+            )
+        await db.commit()
+
+    for count, order_id in order_ids.items():
+        result = await webapp.get_order_bids(order_id, Response(), since=None, timeout=0, if_none_match=None)
+        assert result["count"] == count, f"Заказ {order_id}: {result['count']} заявок вместо {count}"
+        assert all(bid["driver_rating"] for bid in result["bids"]), "Рейтинг водителя не загружен"
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            await webapp.get_order_bids(order_id, Response(), since=None, timeout=0, if_none_match=None)
+        per_call_ms = (time.perf_counter() - started) / args.rounds * 1000
+        print(f"Заявок: {count:3d} — {per_call_ms:.2f} мс на запрос, {per_call_ms / count * 1000:.1f} мкс на заявку")
+    await database.close_pools()
+
+
+async def _accept_race_attempts(db_path: str, attempts: list) -> list:
+    database.DB_PATH = db_path
+    try:
+        results = await asyncio.gather(*(database.try_accept_bid(order_id, driver_id) for order_id, driver_id in attempts))
+    finally:
+        await database.close_pools()
+    return [(order_id, driver_id, result) for (order_id, driver_id), result in zip(attempts, results)]
+
+
+def _accept_race_process(db_path: str, attempts: list) -> list:
+    """Попытки принятия в отдельном процессе: свой пул и своё соединение записи."""
+    return asyncio.run(_accept_race_attempts(db_path, attempts))
+
+
+async def _accept_race_setup(db_path: str, args, rng: random.Random) -> list:
+    """
+    Заказы с заявками contenders водителей; возвращает перемешанные попытки (order_id, driver_id).
+    Общие водители откликаются на многие заказы (проверка «водитель уже занят»), плюс у каждого заказа
+    есть свой водитель — поэтому победитель у заказа должен быть всегда.
+    """
+    database.DB_PATH = db_path
+    await database.migrate_all()
+    shared = [1_000_000 + i for i in range(max(args.drivers, args.contenders))]
+    dedicated = [2_000_000 + i for i in range(args.orders)]
+    attempts = []
+    async with database.writer(db_path) as db:
+        await db.executemany(
+            "INSERT INTO users (user_id, role, shift_opened, is_verified) VALUES (?, 'driver', 1, 1)",
+            [(driver_id,) for driver_id in shared + dedicated]
+        )
+        await db.execute("INSERT INTO users (user_id, role) VALUES (1, 'client')")
+        for own_driver in dedicated:
+            cursor = await db.execute(
+                "INSERT INTO orders (client_id, pickup_address, dropoff_address, status) VALUES (1, 'A', 'B', 'pending')"
+            )
+            order_id = cursor.lastrowid
+            contenders = [own_driver] + rng.sample(shared, args.contenders - 1)
+            await db.executemany(
+                "INSERT INTO bids (order_id, driver_id, arrival_minutes) VALUES (?, ?, 5)",
+                [(order_id, driver_id) for driver_id in contenders]
+            )
+            attempts.extend((order_id, driver_id) for driver_id in contenders)
+        await db.commit()
+    await database.close_pools()
+    rng.shuffle(attempts)
+    return attempts
+
+
+async def _accept_race_check(db_path: str, results: list):
+    """Ровно один победитель на заказ, водитель побеждает не больше одного раза, БД согласована с ответами."""
+    winners = {}
+    for order_id, driver_id, result in results:
+        if result == database.ACCEPT_OK:
+            assert order_id not in winners, f"Заказ {order_id}: два победителя ({winners[order_id]}, {driver_id})"
+            winners[order_id] = driver_id
+    order_ids = {order_id for order_id, _, _ in results}
+    assert winners.keys() == order_ids, f"Заказы без победителя: {sorted(order_ids - winners.keys())[:10]}"
+    assert len(set(winners.values())) == len(winners), "Водитель принят сразу на несколько заказов"
+
+    database.DB_PATH = db_path
+    async with database.reader(db_path) as db:
+        async with db.execute("SELECT id, status, driver_id FROM orders") as cursor:
+            for order_id, status, driver_id in await cursor.fetchall():
+                assert (status, driver_id) == ("accepted", winners[order_id]), \
+                    f"Заказ {order_id}: в БД {status}/{driver_id}, победитель {winners[order_id]}"
+        async with db.execute(
+            "SELECT order_id, driver_id FROM bids WHERE status = 'accepted'"
+        ) as cursor:
+            accepted = await cursor.fetchall()
+        async with db.execute("SELECT COUNT(*) FROM bids WHERE status = 'pending'") as cursor:
+            pending = (await cursor.fetchone())[0]
+    await database.close_pools()
+    assert sorted(accepted) == sorted(winners.items()), "Принятые заявки не совпадают с победителями"
+    assert pending == 0, f"Заявок без решения: {pending}"
+
+
+def bench_accept_race(args):
+    """
+    Гонка принятия: contenders водителей одновременно принимаются на каждый заказ из processes процессов
+    (у каждого своё соединение записи, как у бота и нескольких воркеров API). Падает, если у заказа
+    не ровно один победитель.
+    """
+    rng = random.Random(args.seed)
+    db_path = os.path.join(tempfile.mkdtemp(prefix="taxi_bench_"), "taxi_bot.db")
+    attempts = asyncio.run(_accept_race_setup(db_path, args, rng))
+    chunks = [attempts[i::args.processes] for i in range(args.processes)]
+
+    started = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = [row for chunk in pool.starmap(_accept_race_process, [(db_path, chunk) for chunk in chunks])
+                   for row in chunk]
+    elapsed = time.perf_counter() - started
+
+    counts = {}
+    for _, _, result in results:
+        counts[result] = counts.get(result, 0) + 1
+    print(f"Заказов: {args.orders}, попыток: {len(results)} из {args.processes} процессов за {elapsed:.2f} с")
+    print(f"Результаты: {counts}")
+    asyncio.run(_accept_race_check(db_path, results))
+    print("Ровно один победитель на заказ: OK")
+
+
+async def run(args):
+    db_path = os.path.join(tempfile.mkdtemp(prefix="taxi_bench_"), "taxi_bot.db")
+    database.DB_PATH = db_path
+    telegram_api.GLOBAL_LIMITER = telegram_api.TokenBucket(args.global_rate)
+
+    import dispatch
+    import webapp
+    webapp.DB_PATH = db_path
+    dispatch.DISPATCH_WAVES = args.waves
+    dispatch.DISPATCH_BID_WINDOW = args.bid_window
+    if args.api_base:
+        webapp.TELEGRAM_API_URL = f"{args.api_base.rstrip('/')}/botBENCH"
+        mock = runner = None
+    else:
+        mock = MockTelegram(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                            rate_429=args.rate_429, error_rate=args.error_rate)
+        runner = await start_mock_server(mock, port=args.port)
+        webapp.TELEGRAM_API_URL = f"http://127.0.0.1:{args.port}/botBENCH"
+
+    await webapp.on_startup()
+    async with database.writer(db_path) as db:
+        await db.executemany(
+            "INSERT INTO users (user_id, role, shift_opened, is_verified) VALUES (?, 'driver', 1, 1)",
+            [(1_000_000 + i,) for i in range(args.drivers)]
+        )
+        await db.execute("INSERT INTO users (user_id, role) VALUES (1, 'client')")
+        await db.commit()
+
+    # 1. Создание заказов (время ответа API)
+    started = time.perf_counter()
+    order_ids = []
+    for i in range(args.orders):
+        response = await webapp.create_web_order(webapp.CreateOrderRequest(
+            client_id=1, pickup_address=f"Откуда {i}", dropoff_address=f"Куда {i}", price=300,
+            distance_km=5.0, estimated_time_min="15 мин", pickup_lat=69.35, pickup_lon=88.2,
+        ))
+        order_ids.append(response["order_id"])
+    create_ms = (time.perf_counter() - started) * 1000
+
+    # 2. Рассылка предложений (до доставки последнего сообщения)
+    if args.waves:
+        # Первый уведомлённый водитель откликается через bid_after секунд
+        await asyncio.sleep(args.bid_after)
+        for order_id in order_ids:
+            await database.create_bid(order_id, 1_000_000, 5)
+        while dispatch.dispatch_metrics()["in_progress"]:
+            await asyncio.sleep(0.05)
+        offers = dispatch.dispatch_metrics()["offers"]
+    else:
+        offers = args.orders * args.drivers
+    drained = await wait_outbox_drained(offers, args.timeout)
+    fanout_sec = time.perf_counter() - started
+
+    # 3. Отмена и закрытие предложений у водителей
+    started = time.perf_counter()
+    for order_id in order_ids:
+        await webapp.cancel_order_api(order_id, webapp.CancelOrderRequest(reason="bench"))
+    cancel_ms = (time.perf_counter() - started) * 1000
+    while webapp.offer_metrics()["in_progress"]:
+        await asyncio.sleep(0.02)
+    cleanup_sec = time.perf_counter() - started
+
+    print(f"Водителей: {args.drivers}, заказов: {args.orders}")
+    print(f"Создание заказов: {create_ms / args.orders:.1f} мс на заказ")
+    print(f"Рассылка: {offers} предложений за {fanout_sec:.2f} с ({offers / fanout_sec:.0f}/с)"
+          f"{'' if drained else ' — не завершена за отведённое время'}")
+    print(f"Отмена: {cancel_ms / args.orders:.1f} мс на заказ, закрытие предложений за {cleanup_sec:.2f} с")
+    print(f"Outbox: {await webapp.outbox.outbox_metrics()}")
+    print(f"Предложения: {webapp.offer_metrics()}")
+    if args.waves:
+        print(f"Волны: {dispatch.dispatch_metrics()}")
+    if mock is not None:
+        print(f"Заглушка: {mock.stats()}")
+
+    await webapp.on_shutdown()
+    if runner is not None:
+        await runner.cleanup()
+
+
+async def bench_board(args):
+    """N водителей на WebSocket-доске: подключение, рассылка нового заказа всем и его снятие."""
+    import resource
+    import aiohttp
+    import uvicorn
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="taxi_bench_"), "taxi_bot.db")
+    database.DB_PATH = db_path
+    import dispatch
+    import webapp
+    webapp.DB_PATH = db_path
+    dispatch.DISPATCH_WAVES = False
+    mock = MockTelegram()
+    runner = await start_mock_server(mock, port=args.port)
+    webapp.TELEGRAM_API_URL = f"http://127.0.0.1:{args.port}/botBENCH"
+    server = uvicorn.Server(uvicorn.Config(webapp.app, port=args.port + 1, log_level="warning", ws_ping_interval=None))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    drivers = [1_000_000 + i for i in range(args.drivers)]
+    async with database.writer(db_path) as db:
+        # Смена закрыта: рассылка в Telegram не мешает замеру доски
+        await db.executemany(
+            "INSERT INTO users (user_id, role, shift_opened, is_verified) VALUES (?, 'driver', 0, 1)",
+            [(driver_id,) for driver_id in drivers]
+        )
+        await db.execute("INSERT INTO users (user_id, role) VALUES (1, 'client')")
+        await db.commit()
+
+    seen = {}  # order_id → [получили add, получили remove, время последнего]
+    connected = asyncio.Event()
+    counter = {"snapshots": 0, "failed": 0}
+    # Подключения пачками: тысячи одновременных SYN переполняют очередь listen()
+    connecting = asyncio.Semaphore(200)
+
+    async def client(session, driver_id):
+        try:
+            async with connecting:
+                ws = await session.ws_connect(f"ws://127.0.0.1:{args.port + 1}/ws/driver/{driver_id}/board")
+        except Exception as e:
+            counter["failed"] += 1
+            print(f"Не удалось подключиться: {e!r}")
+            return
+        async with ws:
+            async for msg in ws:
+                data = json.loads(msg.data)
+                if data["type"] == "ping":
+                    await ws.send_str('{"type":"pong"}')
+                elif data["type"] == "snapshot":
+                    counter["snapshots"] += 1
+                    if counter["snapshots"] == len(drivers):
+                        connected.set()
+                elif data["type"] == "diff":
+                    now = time.perf_counter()
+                    for order in data["add"]:
+                        entry = seen.setdefault(order["id"], [0, 0, now])
+                        entry[0] += 1
+                        entry[2] = now
+                    for order_id in data["remove"]:
+                        entry = seen.setdefault(order_id, [0, 0, now])
+                        entry[1] += 1
+                        entry[2] = now
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        clients = [asyncio.create_task(client(session, driver_id)) for driver_id in drivers]
+        await asyncio.wait_for(connected.wait(), args.timeout)
+        connect_sec = time.perf_counter() - started
+
+        started = time.perf_counter()
+        response = await webapp.create_web_order(webapp.CreateOrderRequest(
+            client_id=1, pickup_address="Откуда", dropoff_address="Куда", price=300,
+            distance_km=5.0, estimated_time_min="15 мин", pickup_lat=69.35, pickup_lon=88.2,
+        ))
+        order_id = response["order_id"]
+        while seen.get(order_id, [0])[0] < len(drivers):
+            await asyncio.sleep(0.005)
+        add_ms = (seen[order_id][2] - started) * 1000
+
+        started = time.perf_counter()
+        await webapp.cancel_order_api(order_id, webapp.CancelOrderRequest(reason="bench"))
+        while seen[order_id][1] < len(drivers):
+            await asyncio.sleep(0.005)
+        remove_ms = (seen[order_id][2] - started) * 1000
+
+        print(f"Подключений: {len(drivers)} за {connect_sec:.1f} с")
+        print(f"Новый заказ у всех водителей через {add_ms:.0f} мс, снятие через {remove_ms:.0f} мс")
+        print(f"Доска: {webapp.board.board_metrics()}")
+        print(f"Пик памяти процесса (сервер и клиенты): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} МБ")
+        for task in clients:
+            task.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+
+    server.should_exit = True
+    await server_task
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк заказов против заглушки Bot API")
+    parser.add_argument("--drivers", type=int, default=200)
+    parser.add_argument("--orders", type=int, default=10)
+    parser.add_argument("--global-rate", type=float, default=telegram_api.GLOBAL_RATE,
+                        help="лимит отправки, сообщений в секунду")
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--api-base", default="", help="внешняя заглушка вместо встроенной")
+    parser.add_argument("--timeout", type=float, default=600, help="ожидание рассылки, с")
+    parser.add_argument("--waves", action="store_true", help="рассылка волнами до первой заявки")
+    parser.add_argument("--bid-window", type=float, default=1.0, help="ожидание заявок между волнами, с")
+    parser.add_argument("--bid-after", type=float, default=2.5, help="через сколько секунд приходит заявка")
+    parser.add_argument("--payload", action="store_true", help="микробенчмарк подготовки предложения")
+    parser.add_argument("--geo", action="store_true", help="бенчмарк индекса геопозиций водителей")
+    parser.add_argument("--board", action="store_true", help="нагрузка на WebSocket-доску заказов")
+    parser.add_argument("--accept-race", action="store_true", help="гонка одновременного принятия заявок")
+    parser.add_argument("--contenders", type=int, default=20, help="водителей, принимаемых на один заказ")
+    parser.add_argument("--processes", type=int, default=4, help="процессов в гонке принятия")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bid-counts", action="store_true", help="время ответа списка заявок от их числа")
+    parser.add_argument("--rounds", type=int, default=200, help="повторов каждого замера")
+    parser.add_argument("--session", action="store_true", help="сообщений/с: общая сессия против новой на запрос")
+    parser.add_argument("--messages", type=int, default=2000, help="сообщений в замере --session")
+    parser.add_argument("--concurrency", type=int, default=telegram_api.FANOUT_CONCURRENCY,
+                        help="одновременных запросов в замере --session")
+    args = parser.parse_args()
+    if args.payload:
+        bench_payload(args.drivers)
+    elif args.geo:
+        bench_geo(args.drivers)
+    elif args.board:
+        asyncio.run(bench_board(args))
+    elif args.accept_race:
+        bench_accept_race(args)
+    elif args.bid_counts:
+        asyncio.run(bench_bid_counts(args))
+    elif args.session:
+        asyncio.run(bench_session(args))
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
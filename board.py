@@ -0,0 +1,279 @@
+# board.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from fastapi import WebSocket
+
+import dispatch
+from database import get_pending_board_orders
+
+logger = logging.getLogger(__name__)
+
+# === Настройки ===
+# Как часто перечитывать ожидающие заказы (созданные ботом или другим процессом), секунд
+BOARD_REFRESH_INTERVAL = float(os.getenv("BOARD_REFRESH_INTERVAL", "1.0"))
+# Заказы дальше этого от водителя на доску не попадают, км (без геопозиции — все заказы)
+BOARD_RADIUS_KM = float(os.getenv("BOARD_RADIUS_KM", str(dispatch.DISPATCH_RINGS_KM[-1] if dispatch.DISPATCH_RINGS_KM else 25)))
+# Пинг клиенту при отсутствии изменений, секунд; без ответа за 3 интервала соединение закрывается
+BOARD_HEARTBEAT = float(os.getenv("BOARD_HEARTBEAT", "20"))
+# Неотправленных сообщений на соединение; переполнение — медленный клиент отключается
+BOARD_QUEUE_SIZE = int(os.getenv("BOARD_QUEUE_SIZE", "32"))
+# Максимальное время отправки одного сообщения, секунд
+BOARD_SEND_TIMEOUT = float(os.getenv("BOARD_SEND_TIMEOUT", "10"))
+
+# Коды закрытия WebSocket
+CLOSE_SLOW_CONSUMER = 1013  # Try Again Later
+CLOSE_IDLE = 1001           # Going Away
+
+_ORDERS = {}  # order_id → (pickup_lat, pickup_lon, карточка заказа в JSON)
+_CONNECTIONS = set()
+_WAKEUP = asyncio.Event()
+_LOCK = asyncio.Lock()
+_TASK: Optional[asyncio.Task] = None
+_LOADED = False
+BOARD_METRICS = {
+    "connected": 0,
+    "connections_total": 0,
+    "dropped_slow": 0,
+    "closed_idle": 0,
+    "messages": 0,
+    "refreshes": 0,
+    "last_refresh_ms": 0.0,
+    "last_fanout_ms": 0.0,
+}
+
+
+class DriverConnection:
+    """Соединение одного водителя: видимые заказы, геопозиция и очередь исходящих сообщений."""
+
+    def __init__(self, websocket: WebSocket, driver_id: int):
+        self.websocket = websocket
+        self.driver_id = driver_id
+        self.queue = asyncio.Queue(maxsize=BOARD_QUEUE_SIZE)
+        self.visible = set()
+        self.position = None  # (lat, lon) или None — показываются все заказы
+        self.close_code = None
+        self.last_seen = time.monotonic()
+
+    def sees(self, order: tuple) -> bool:
+        lat, lon, _ = order
+        if self.position is None or lat is None or lon is None:
+            return True
+        return dispatch.distance_km(self.position[0], self.position[1], lat, lon) <= BOARD_RADIUS_KM
+
+    def push(self, text: str):
+        """Неблокирующая постановка сообщения; переполненная очередь — медленный клиент."""
+        if self.close_code is not None:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.drop(CLOSE_SLOW_CONSUMER)
+
+    def drop(self, code: int):
+        if self.close_code is None:
+            self.close_code = code
+            # Будим отправителя, чтобы он закрыл соединение
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    def apply(self, added: list, removed: list):
+        """Отправляет изменения доски, касающиеся этого водителя."""
+        add = [order_id for order_id in added if order_id in _ORDERS and self.sees(_ORDERS[order_id])]
+        remove = [order_id for order_id in removed if order_id in self.visible]
+        if add or remove:
+            self.visible.update(add)
+            self.visible.difference_update(remove)
+            self.push(_diff_message(add, remove))
+
+    def resync(self):
+        """Пересчитывает видимые заказы целиком (после смены геопозиции)."""
+        now_visible = {order_id for order_id, order in _ORDERS.items() if self.sees(order)}
+        add = list(now_visible - self.visible)
+        remove = list(self.visible - now_visible)
+        if add or remove:
+            self.visible = now_visible
+            self.push(_diff_message(add, remove))
+
+
+def _card(order: dict) -> str:
+    # Карточка сериализуется один раз на заказ и переиспользуется для всех водителей
+    return json.dumps(order, ensure_ascii=False, default=str)
+
+
+def _diff_message(add: list, remove: list) -> str:
+    cards = ",".join(_ORDERS[order_id][2] for order_id in add)
+    return f'{{"type":"diff","add":[{cards}],"remove":{json.dumps(remove)}}}'
+
+
+def _snapshot_message(conn: DriverConnection) -> str:
+    conn.visible = {order_id for order_id, order in _ORDERS.items() if conn.sees(order)}
+    cards = ",".join(_ORDERS[order_id][2] for order_id in conn.visible)
+    return f'{{"type":"snapshot","radius_km":{BOARD_RADIUS_KM},"orders":[{cards}]}}'
+
+
+async def refresh(initial: bool = False):
+    """
+    Перечитывает ожидающие заказы и рассылает изменения всем подключённым водителям.
+    initial=True — только первая загрузка: одновременные подключения читают БД один раз.
+    """
+    global _LOADED
+    async with _LOCK:
+        if initial and _LOADED:
+            return
+        started = time.perf_counter()
+        rows = await get_pending_board_orders()
+        BOARD_METRICS["refreshes"] += 1
+        BOARD_METRICS["last_refresh_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        current = {row["id"]: row for row in rows}
+        # Данные ожидающего заказа не меняются, поэтому сравниваем только номера
+        added = [order_id for order_id in current if order_id not in _ORDERS]
+        removed = [order_id for order_id in _ORDERS if order_id not in current]
+        for order_id in removed:
+            del _ORDERS[order_id]
+        for order_id in added:
+            row = current[order_id]
+            _ORDERS[order_id] = (row["pickup_lat"], row["pickup_lon"], _card(row))
+        _LOADED = True
+
+        if added or removed:
+            started = time.perf_counter()
+            for conn in list(_CONNECTIONS):
+                conn.apply(added, removed)
+            BOARD_METRICS["last_fanout_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def refresh_soon():
+    """Заказ создан, принят или отменён в этом процессе: обновить доску, не дожидаясь интервала."""
+    _WAKEUP.set()
+
+
+async def _refresh_loop():
+    global _LOADED
+    while True:
+        try:
+            await asyncio.wait_for(_WAKEUP.wait(), BOARD_REFRESH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _WAKEUP.clear()
+        if not _CONNECTIONS:
+            # Никто не смотрит: не читаем БД, при первом подключении доска загрузится заново
+            _ORDERS.clear()
+            _LOADED = False
+            continue
+        try:
+            await refresh()
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления доски заказов: {e}")
+
+
+async def _sender(conn: DriverConnection):
+    while True:
+        try:
+            text = await asyncio.wait_for(conn.queue.get(), BOARD_HEARTBEAT)
+        except asyncio.TimeoutError:
+            if time.monotonic() - conn.last_seen > BOARD_HEARTBEAT * 3:
+                BOARD_METRICS["closed_idle"] += 1
+                conn.close_code = CLOSE_IDLE
+                return
+            text = f'{{"type":"ping","ts":{int(time.time())}}}'
+        if text is None:
+            return
+        try:
+            await asyncio.wait_for(conn.websocket.send_text(text), BOARD_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            conn.close_code = CLOSE_SLOW_CONSUMER
+            return
+        BOARD_METRICS["messages"] += 1
+
+
+async def _receiver(conn: DriverConnection):
+    """
+    Сообщения от водителя: {"type": "pong"} и {"type": "location", "lat": ..., "lon": ...}.
+    Бинарные кадры только продлевают соединение (receive_text() упал бы на них с KeyError).
+    """
+    while True:
+        frame = await conn.websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            return
+        conn.last_seen = time.monotonic()
+        text = frame.get("text")
+        if text is None:
+            continue
+        try:
+            message = json.loads(text)
+        except ValueError:
+            continue
+        if not isinstance(message, dict) or message.get("type") != "location":
+            continue
+        try:
+            lat, lon = float(message["lat"]), float(message["lon"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if -90 <= lat <= 90 and -180 <= lon <= 180:
+            dispatch.update_driver_location(conn.driver_id, lat, lon)
+            conn.position = (lat, lon)
+            conn.resync()
+
+
+async def serve_driver(websocket: WebSocket, driver_id: int):
+    """
+    Доска заказов водителя: snapshot при подключении, затем diff с добавленными
+    и снятыми заказами рядом. Соединение уже принято (websocket.accept()).
+    """
+    conn = DriverConnection(websocket, driver_id)
+    position = dispatch.DRIVER_INDEX.position(driver_id)
+    if position and position[2] >= time.time() - dispatch.DRIVER_LOCATION_TTL:
+        conn.position = position[:2]
+
+    if not _LOADED:
+        await refresh(initial=True)
+    # Между snapshot и подпиской нет await: ни один diff не потеряется
+    conn.push(_snapshot_message(conn))
+    _CONNECTIONS.add(conn)
+    BOARD_METRICS["connected"] = len(_CONNECTIONS)
+    BOARD_METRICS["connections_total"] += 1
+    tasks = []
+    try:
+        tasks = [asyncio.create_task(_sender(conn)), asyncio.create_task(_receiver(conn))]
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        _CONNECTIONS.discard(conn)
+        BOARD_METRICS["connected"] = len(_CONNECTIONS)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if conn.close_code == CLOSE_SLOW_CONSUMER:
+        BOARD_METRICS["dropped_slow"] += 1
+    if conn.close_code is not None:
+        try:
+            await websocket.close(code=conn.close_code)
+        except Exception:
+            pass  # клиент уже отключился
+
+
+async def start_board():
+    global _TASK
+    _TASK = asyncio.create_task(_refresh_loop())
+
+
+async def stop_board():
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        await asyncio.gather(_TASK, return_exceptions=True)
+        _TASK = None
+    for conn in list(_CONNECTIONS):
+        conn.drop(CLOSE_IDLE)
+
+
+def board_metrics() -> dict:
+    return {**BOARD_METRICS, "orders": len(_ORDERS)}
@@ -0,0 +1,191 @@
+# broadcaster.py
+
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from database import (
+    claim_due_broadcast, release_broadcast, get_broadcast_recipients_page, save_broadcast_receipts,
+    mark_broadcast_sent
+)
+from outbox import PRIORITY_BROADCAST
+from telegram_api import TokenBucket, call_api
+
+logger = logging.getLogger(__name__)
+
+# === Настройки ===
+# Сообщений в секунду для рассылок. Общий лимит бота рассылка занимает с приоритетом
+# PRIORITY_BROADCAST: предложения заказов из outbox получают токены раньше неё
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+# Одновременных запросов
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Получателей за один запрос к БД
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "1000"))
+# Квитанций в одной транзакции (столько сообщений может уйти повторно после падения)
+BROADCAST_FLUSH_SIZE = int(os.getenv("BROADCAST_FLUSH_SIZE", "100"))
+# Как часто проверять запланированные рассылки, секунд
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "30"))
+# Попыток на получателя при временных ошибках (сеть, 429, 5xx), дальше квитанция 'failed'
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+# Пауза перед повтором: delay * номер попытки, секунд
+BROADCAST_RETRY_DELAY = float(os.getenv("BROADCAST_RETRY_DELAY", "5"))
+# Аренда рассылки, продлевается с каждой пачкой квитанций: пока она действует, рассылку
+# не возьмёт другой процесс. Должна быть больше времени отправки одной пачки с повторами, секунд
+BROADCAST_LEASE_SEC = float(os.getenv("BROADCAST_LEASE_SEC", "300"))
+
+BROADCAST_LIMITER = TokenBucket(BROADCAST_RATE)
+
+_API_URL: Optional[str] = None
+_TASK: Optional[asyncio.Task] = None
+BROADCAST_METRICS = {
+    "broadcasts_done": 0,
+    "delivered": 0,
+    "failed": 0,
+    "blocked": 0,
+    "network_errors": 0,
+    "current_broadcast": None,
+    "last_rate_per_sec": 0.0,
+}
+
+
+def receipt_status(data: Optional[dict]) -> Optional[str]:
+    """
+    Итог доставки для квитанции; None — временная ошибка (сеть, 429, 5xx Telegram),
+    отправка будет повторена.
+    """
+    if data is None:
+        return None
+    if data.get("ok"):
+        return "delivered"
+    error_code = data.get("error_code") or 0
+    if error_code == 429 or error_code >= 500:
+        return None
+    # 403: бот заблокирован пользователем или аккаунт удалён
+    return "blocked" if error_code == 403 else "failed"
+
+
+def build_broadcast_request(text, photo_file_id, document_file_id, caption) -> tuple:
+    """Метод Bot API и общая часть тела запроса (без chat_id)."""
+    if photo_file_id:
+        return "sendPhoto", {"photo": photo_file_id, "caption": caption or text or "", "parse_mode": "HTML"}
+    if document_file_id:
+        return "sendDocument", {
+            "document": document_file_id, "caption": caption or text or "", "parse_mode": "HTML"
+        }
+    return "sendMessage", {"text": text or "", "parse_mode": "HTML", "disable_web_page_preview": True}
+
+
+async def send_broadcast(broadcast: tuple):
+    """
+    Рассылает одну рассылку. Получатели читаются постранично, квитанции пишутся пачками,
+    поэтому после перезапуска рассылка продолжается с пользователей без квитанции.
+    Получателю с временными ошибками сообщение повторяется до BROADCAST_MAX_ATTEMPTS раз,
+    затем он получает квитанцию 'failed': рассылка всегда завершается (is_sent = 1).
+    """
+    broadcast_id, target, text, photo_file_id, document_file_id, caption = broadcast
+    method, base_payload = build_broadcast_request(text, photo_file_id, document_file_id, caption)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started = time.monotonic()
+    counts = {"delivered": 0, "failed": 0, "blocked": 0}
+
+    async def send_one(user_id) -> Optional[str]:
+        async with semaphore:
+            await BROADCAST_LIMITER.acquire()
+            data = await call_api(
+                _API_URL, method, {"chat_id": user_id, **base_payload}, chat_id=user_id,
+                priority=PRIORITY_BROADCAST
+            )
+        return receipt_status(data)
+
+    async def send_chunk(chunk: list) -> list:
+        results = dict.fromkeys(chunk)
+        pending = list(chunk)
+        for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+            if attempt > 1:
+                await asyncio.sleep(BROADCAST_RETRY_DELAY * (attempt - 1))
+            statuses = await asyncio.gather(*(send_one(user_id) for user_id in pending))
+            for user_id, status in zip(pending, statuses):
+                results[user_id] = status
+            pending = [user_id for user_id, status in zip(pending, statuses) if status is None]
+            BROADCAST_METRICS["network_errors"] += len(pending)
+            if not pending:
+                break
+        if pending:
+            logger.warning(
+                f"⚠️ Рассылка {broadcast_id}: {len(pending)} получателей без ответа "
+                f"после {BROADCAST_MAX_ATTEMPTS} попыток"
+            )
+        return [(user_id, results[user_id] or "failed") for user_id in chunk]
+
+    BROADCAST_METRICS["current_broadcast"] = broadcast_id
+    logger.info(f"📢 Рассылка {broadcast_id} ({target}): старт")
+    last_user_id = 0
+    while True:
+        page = await get_broadcast_recipients_page(broadcast_id, target, last_user_id, BROADCAST_PAGE_SIZE)
+        if not page:
+            break
+        last_user_id = page[-1]
+        for i in range(0, len(page), BROADCAST_FLUSH_SIZE):
+            results = await send_chunk(page[i:i + BROADCAST_FLUSH_SIZE])
+            # Счётчики broadcast_stats обновляются в той же транзакции, что и квитанции
+            await save_broadcast_receipts(broadcast_id, results, BROADCAST_LEASE_SEC)
+            for _, status in results:
+                counts[status] += 1
+                BROADCAST_METRICS[status] += 1
+
+    elapsed = time.monotonic() - started
+    BROADCAST_METRICS["current_broadcast"] = None
+    BROADCAST_METRICS["last_rate_per_sec"] = round(counts["delivered"] / elapsed, 1) if elapsed else 0.0
+    await mark_broadcast_sent(broadcast_id)
+    BROADCAST_METRICS["broadcasts_done"] += 1
+    logger.info(
+        f"✅ Рассылка {broadcast_id}: доставлено {counts['delivered']}, заблокировали {counts['blocked']}, "
+        f"ошибок {counts['failed']} за {elapsed:.1f} с"
+    )
+
+
+async def _send_claimed():
+    """Отправляет рассылки по одной, каждую — только после захвата аренды."""
+    while True:
+        broadcast = await claim_due_broadcast(BROADCAST_LEASE_SEC)
+        if broadcast is None:
+            return
+        try:
+            await send_broadcast(broadcast)
+        except BaseException:
+            # Не завершена (ошибка или остановка): продолжить можно сразу, квитанции уже записаны
+            await asyncio.shield(release_broadcast(broadcast[0]))
+            raise
+
+
+async def _broadcast_loop():
+    while True:
+        try:
+            await _send_claimed()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка рассылки: {e}", exc_info=True)
+            BROADCAST_METRICS["current_broadcast"] = None
+        await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+
+async def start_broadcaster(api_url: str):
+    """Запускает планировщик; незавершённые рассылки продолжатся с места остановки."""
+    global _API_URL, _TASK
+    _API_URL = api_url
+    _TASK = asyncio.create_task(_broadcast_loop())
+
+
+async def stop_broadcaster():
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        await asyncio.gather(_TASK, return_exceptions=True)
+        _TASK = None
+
+
+def broadcast_metrics() -> dict:
+    return dict(BROADCAST_METRICS)
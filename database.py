@@ -1,232 +1,879 @@
 import aiosqlite
+import asyncio
 import logging
-import shutil
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime, date, timezone
 from typing import Optional, Tuple, List
 
+from db_pool import reader, writer, close_pools
+
 #РЕЗЕРВНОЕ КОПИРОВАНИЕ
 DB_PATH = "taxi_bot.db"
 BACKUP_DIR = "backups"
 MAX_BACKUPS = 7
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS ad_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ad_id INTEGER,
-                user_id INTEGER,
-                event_type TEXT,  -- 'impression' или 'click'
-                timestamp TEXT
-            )      
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS partner_ads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                partner_name TEXT NOT NULL,
-                message_text TEXT NOT NULL,
-                photo_file_id TEXT,
-                url TEXT NOT NULL,               -- Обязательная партнёрская ссылка
-                is_active BOOLEAN DEFAULT 1,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                role TEXT CHECK(role IN ('driver', 'client')),
-                car_brand TEXT,
-                car_number TEXT,
-                is_verified BOOLEAN DEFAULT 0,
-                verification_expires DATE,
-                shift_opened BOOLEAN DEFAULT 0,
-                is_banned BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP 
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_id INTEGER,
-                driver_id INTEGER,
-                pickup_address TEXT,
-                dropoff_address TEXT,
-                comment TEXT,
-                status TEXT CHECK(status IN ('pending', 'accepted', 'completed', 'cancelled')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                cancelled_by TEXT,
-                source TEXT DEFAULT 'telegram',
-                driver_arrived INTEGER DEFAULT 0
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS bids (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                driver_id INTEGER,
-                arrival_minutes INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT CHECK(status IN ('pending', 'accepted', 'rejected')) DEFAULT 'pending',
-                FOREIGN KEY(order_id) REFERENCES orders(id),
-                FOREIGN KEY(driver_id) REFERENCES users(user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS ratings (
-                order_id INTEGER,
-                rater_id INTEGER,
-                target_id INTEGER,
-                rating INTEGER CHECK(rating BETWEEN 1 AND 5),
-                PRIMARY KEY (order_id, rater_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS broadcasts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                target TEXT NOT NULL,          -- 'all', 'drivers', 'clients'
-                message_text TEXT,
-                photo_file_id TEXT,
-                document_file_id TEXT,
-                caption TEXT,
-                scheduled_at TIMESTAMP,        -- когда отправить
-                is_sent BOOLEAN DEFAULT 0,
-                total_recipients INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS broadcast_receipts (
-                broadcast_id INTEGER,
-                user_id INTEGER,
-                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (broadcast_id, user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS driver_order_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER NOT NULL,
-                driver_id INTEGER NOT NULL,
-                chat_id INTEGER NOT NULL,
-                message_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
-                FOREIGN KEY (driver_id) REFERENCES users(user_id) ON DELETE CASCADE
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        """)
-        # По умолчанию выбор роли ВКЛЮЧЁН
-        await db.execute("""
-            INSERT OR IGNORE INTO settings (key, value) VALUES ('driver_role_enabled', '1')
-        """)
-        await db.commit()
+# === Вторичные индексы ===
+# Новые индексы добавляются вместе с миграцией, которая вызывает create_indexes
+INDEXES = [
+    # Активный заказ клиента и история клиента (ORDER BY created_at)
+    ("idx_orders_client_created", "orders(client_id, created_at)"),
+    # Заказы водителя по статусу, счётчик завершённых
+    ("idx_orders_driver_status", "orders(driver_id, status)"),
+    # Диапазоны по дате создания (статистика)
+    ("idx_orders_created_at", "orders(created_at)"),
+    # Частичные индексы: ожидающие заказы и водители на заказе
+    ("idx_orders_pending", "orders(status, created_at) WHERE status = 'pending'"),
+    ("idx_orders_accepted", "orders(status, driver_id) WHERE status = 'accepted'"),
+    ("idx_bids_order_status", "bids(order_id, status)"),
+    ("idx_bids_order_driver", "bids(order_id, driver_id)"),
+    # Покрывающий индекс для AVG(rating) по target_id
+    ("idx_ratings_target", "ratings(target_id, rating)"),
+    # Отбор водителей на смене для рассылки заказа
+    ("idx_users_dispatch", "users(role, shift_opened, is_verified)"),
+    ("idx_driver_order_messages_order", "driver_order_messages(order_id)"),
+]
+
+# Рейтинг из агрегатов user_rating_stats (поиск по первичному ключу)
+RATING_STATS_QUERY = """
+    SELECT CAST(rating_sum AS REAL) / rating_count
+    FROM user_rating_stats
+    WHERE user_id = ? AND rating_count > 0
+"""
+
+# Водители на смене для рассылки заказа: рейтинг и занятость другим заказом
+DISPATCH_CANDIDATES_QUERY = """
+    SELECT u.user_id,
+           COALESCE(CAST(s.rating_sum AS REAL) / NULLIF(s.rating_count, 0), 0),
+           EXISTS (SELECT 1 FROM orders o WHERE o.driver_id = u.user_id AND o.status = 'accepted')
+    FROM users u
+    LEFT JOIN user_rating_stats s ON s.user_id = u.user_id
+    WHERE u.role = 'driver' AND u.shift_opened = 1 AND u.is_verified = 1
+"""
+
+# Статус заказа и число активных заявок — проверка между волнами рассылки
+ORDER_DISPATCH_STATE_QUERY = """
+    SELECT o.status, (SELECT COUNT(*) FROM bids b WHERE b.order_id = o.id AND b.status = 'pending')
+    FROM orders o
+    WHERE o.id = ?
+"""
+
+# Ожидающие заказы для доски водителей: карточка с ценой и координатами
+BOARD_ORDER_COLUMNS = (
+    "id", "pickup_address", "dropoff_address", "comment", "created_at", "passengers", "price",
+    "distance_km", "estimated_time", "pickup_lat", "pickup_lon", "dropoff_lat", "dropoff_lon",
+)
+PENDING_BOARD_QUERY = f"SELECT {', '.join(BOARD_ORDER_COLUMNS)} FROM orders WHERE status = 'pending'"
+
+# Горячие запросы, которые не должны деградировать до полного сканирования таблицы
+HOT_QUERIES = {
+    "pending_orders": (
+        "SELECT id, client_id, pickup_address FROM orders WHERE status = 'pending' ORDER BY created_at", ()
+    ),
+    "accepted_orders": ("SELECT id, driver_id FROM orders WHERE status = 'accepted'", ()),
+    "client_active_order": (
+        "SELECT * FROM orders WHERE client_id = ? AND status = 'accepted' ORDER BY created_at DESC LIMIT 1", (0,)
+    ),
+    "client_history": ("SELECT id FROM orders WHERE client_id = ? ORDER BY created_at DESC LIMIT 5", (0,)),
+    "driver_busy": ("SELECT id FROM orders WHERE driver_id = ? AND status = 'accepted'", (0,)),
+    "driver_completed": ("SELECT COUNT(*) FROM orders WHERE driver_id = ? AND status = 'completed'", (0,)),
+    "bids_pending": ("SELECT driver_id FROM bids WHERE order_id = ? AND status = 'pending'", (0,)),
+    "bid_exists": ("SELECT 1 FROM bids WHERE order_id = ? AND driver_id = ?", (0, 0)),
+    "rating_avg": ("SELECT AVG(rating) FROM ratings WHERE target_id = ?", (0,)),
+    "rating_stats": (RATING_STATS_QUERY, (0,)),
+    "dispatch_drivers": (
+        "SELECT user_id FROM users WHERE role = 'driver' AND shift_opened = 1 AND is_verified = 1", ()
+    ),
+    "dispatch_candidates": (DISPATCH_CANDIDATES_QUERY, ()),
+    "order_dispatch_state": (ORDER_DISPATCH_STATE_QUERY, (0,)),
+    "pending_board": (PENDING_BOARD_QUERY, ()),
+    "orders_created_range": (
+        "SELECT DATE(created_at), COUNT(*) FROM orders WHERE created_at >= ? GROUP BY DATE(created_at)", ("",)
+    ),
+    "daily_stats": ("SELECT total, completed, cancelled FROM daily_order_stats WHERE day = ?", ("",)),
+    "order_messages": ("SELECT chat_id, message_id FROM driver_order_messages WHERE order_id = ?", (0,)),
+    "driver_locations_since": ("SELECT driver_id FROM driver_locations WHERE updated_at > ?", (0.0,)),
+    "outbox_due": (
+        "SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+        "ORDER BY priority, next_attempt_at LIMIT 20", (0.0,)
+    ),
+    "outbox_expired_leases": ("SELECT id FROM outbox WHERE status = 'sending' AND lease_until < ?", (0.0,)),
+    "deadlines_due": ("SELECT order_id, kind FROM order_deadlines WHERE due_at <= ?", (0.0,)),
+}
+
+async def create_indexes(db):
+    """Создаёт набор вторичных индексов (повторный вызов безопасен)."""
+    for name, target in INDEXES:
+        await db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+async def find_full_scans(db) -> list:
+    """Возвращает [(имя запроса, строка плана)] для горячих запросов без поиска по индексу."""
+    scans = []
+    for name, (query, params) in HOT_QUERIES.items():
+        async with db.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+            for row in await cursor.fetchall():
+                detail = row[-1]
+                # Горячий запрос обязан идти через SEARCH; SCAN (даже по индексу) — проход всей таблицы
+                if detail.startswith("SCAN"):
+                    scans.append((name, detail))
+    return scans
+
+# === Агрегаты рейтингов ===
+async def _fill_rating_stats(db):
+    await db.execute("DELETE FROM user_rating_stats")
+    await db.execute("""
+        INSERT INTO user_rating_stats (user_id, rating_sum, rating_count)
+        SELECT target_id, SUM(rating), COUNT(rating)
+        FROM ratings
+        WHERE target_id IS NOT NULL AND rating IS NOT NULL
+        GROUP BY target_id
+    """)
+
+async def rebuild_rating_stats():
+    """Пересчитывает user_rating_stats из ratings (восстановление после ручных правок)."""
+    async with writer(DB_PATH) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await _fill_rating_stats(db)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        async with db.execute("SELECT COUNT(*) FROM user_rating_stats") as cursor:
+            total = (await cursor.fetchone())[0]
+    logging.info(f"✅ Агрегаты рейтингов пересчитаны: {total} пользователей")
+    return total
+
+# === Сводная статистика заказов ===
+async def _fill_daily_order_stats(db, since: Optional[str] = None):
+    """Пересчитывает daily_order_stats за дни начиная с since ('YYYY-MM-DD') или за всё время."""
+    start = since or "0000-01-01"
+    await db.execute("DELETE FROM daily_order_stats WHERE day >= ?", (start,))
+    # Один сгруппированный проход по диапазону created_at (индекс idx_orders_created_at)
+    await db.execute("""
+        INSERT INTO daily_order_stats (day, total, completed, cancelled)
+        SELECT DATE(created_at), COUNT(*), SUM(status = 'completed'), SUM(status = 'cancelled')
+        FROM orders
+        WHERE created_at >= ?
+        GROUP BY DATE(created_at)
+    """, (start,))
+
+async def rebuild_daily_order_stats(since: Optional[str] = None):
+    """Пересчитывает сводную статистику заказов из таблицы orders."""
+    async with writer(DB_PATH) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await _fill_daily_order_stats(db, since)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    logging.info(f"✅ Статистика заказов пересчитана с {since or 'начала'}")
+
+# === Статистика рассылок ===
+async def _fill_broadcast_stats(db):
+    await db.execute("DELETE FROM broadcast_stats")
+    await db.execute("DELETE FROM broadcast_delivery_buckets")
+    await db.execute("""
+        INSERT INTO broadcast_stats (broadcast_id, delivered, failed, blocked)
+        SELECT broadcast_id, SUM(status = 'delivered'), SUM(status = 'failed'), SUM(status = 'blocked')
+        FROM broadcast_receipts
+        GROUP BY broadcast_id
+    """)
+    await db.execute("""
+        INSERT INTO broadcast_delivery_buckets (broadcast_id, minute, delivered, failed, blocked)
+        SELECT broadcast_id, strftime('%Y-%m-%d %H:%M', received_at),
+               SUM(status = 'delivered'), SUM(status = 'failed'), SUM(status = 'blocked')
+        FROM broadcast_receipts
+        WHERE received_at IS NOT NULL
+        GROUP BY broadcast_id, strftime('%Y-%m-%d %H:%M', received_at)
+    """)
+
+async def rebuild_broadcast_stats():
+    """Пересчитывает счётчики рассылок из broadcast_receipts."""
+    async with writer(DB_PATH) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await _fill_broadcast_stats(db)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    logging.info("✅ Статистика рассылок пересчитана")
+
+# === Миграции схемы ===
+# Версия схемы хранится в PRAGMA user_version. Новые изменения схемы добавляются
+# отдельной функцией в конец MIGRATIONS — уже выпущенные шаги не редактируются.
+
+async def _add_missing_columns(db, table: str, columns: dict):
+    """Добавляет отсутствующие колонки (для баз, созданных до движка миграций)."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        existing = {col[1] for col in await cursor.fetchall()}
+    for name, ddl in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+            logging.info(f"✅ Добавлен столбец {name} в таблицу {table}")
+
+async def _migration_1_base_schema(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS ad_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ad_id INTEGER,
+            user_id INTEGER,
+            event_type TEXT,  -- 'impression' или 'click'
+            timestamp TEXT
+        )      
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS partner_ads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            partner_name TEXT NOT NULL,
+            message_text TEXT NOT NULL,
+            photo_file_id TEXT,
+            url TEXT NOT NULL,               -- Обязательная партнёрская ссылка
+            is_active BOOLEAN DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            role TEXT CHECK(role IN ('driver', 'client')),
+            car_brand TEXT,
+            car_number TEXT,
+            is_verified BOOLEAN DEFAULT 0,
+            verification_expires DATE,
+            shift_opened BOOLEAN DEFAULT 0,
+            is_banned BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP 
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER,
+            driver_id INTEGER,
+            pickup_address TEXT,
+            dropoff_address TEXT,
+            comment TEXT,
+            status TEXT CHECK(status IN ('pending', 'accepted', 'completed', 'cancelled')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            cancelled_by TEXT,
+            source TEXT DEFAULT 'telegram',
+            driver_arrived INTEGER DEFAULT 0
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS bids (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            driver_id INTEGER,
+            arrival_minutes INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT CHECK(status IN ('pending', 'accepted', 'rejected')) DEFAULT 'pending',
+            FOREIGN KEY(order_id) REFERENCES orders(id),
+            FOREIGN KEY(driver_id) REFERENCES users(user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS ratings (
+            order_id INTEGER,
+            rater_id INTEGER,
+            target_id INTEGER,
+            rating INTEGER CHECK(rating BETWEEN 1 AND 5),
+            PRIMARY KEY (order_id, rater_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target TEXT NOT NULL,          -- 'all', 'drivers', 'clients'
+            message_text TEXT,
+            photo_file_id TEXT,
+            document_file_id TEXT,
+            caption TEXT,
+            scheduled_at TIMESTAMP,        -- когда отправить
+            is_sent BOOLEAN DEFAULT 0,
+            total_recipients INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_receipts (
+            broadcast_id INTEGER,
+            user_id INTEGER,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS driver_order_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            driver_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
+            FOREIGN KEY (driver_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+    """)
 
-        await db.execute("""
-            INSERT OR IGNORE INTO settings (key, value) VALUES ('co_driver_enabled', '1')
-        """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_rides (
+            user_id INTEGER NOT NULL,
+            year_month TEXT NOT NULL,  -- формат: '2025-10'
+            ride_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, year_month)
+        )
+    """)
+
+    # По умолчанию выбор роли ВКЛЮЧЁН
+    await db.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", [
+        ("driver_role_enabled", "1"),
+        ("co_driver_enabled", "1"),
+        ("auto_accept_on_first_bid", "0"),
+    ])
+
+    # Базы, созданные до движка миграций, могут не иметь части колонок
+    await _add_missing_columns(db, "users", {
+        "is_banned": "BOOLEAN DEFAULT 0",
+        "created_at": "TIMESTAMP",  # заполняется фоновым BACKFILLS
+        "has_co_driver": "INTEGER DEFAULT 0",
+    })
+    await _add_missing_columns(db, "broadcasts", {"total_recipients": "INTEGER DEFAULT 0"})
+    await _add_missing_columns(db, "bids", {"arrival_minutes": "INTEGER DEFAULT 0"})
+    await _add_missing_columns(db, "orders", {
+        "cancelled_by": "TEXT",
+        "source": "TEXT DEFAULT 'telegram'",
+        "driver_arrived": "INTEGER DEFAULT 0",
+    })
+
+async def _migration_2_indexes(db):
+    await create_indexes(db)
+
+async def _migration_3_rating_stats(db):
+    # Сумма и количество оценок на пользователя: рейтинг читается по первичному ключу
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_rating_stats (
+            user_id INTEGER PRIMARY KEY,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            rating_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Триггеры поддерживают агрегаты при любой записи в ratings (бот и веб-API)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_ratings_stats_insert
+        AFTER INSERT ON ratings WHEN NEW.rating IS NOT NULL
+        BEGIN
+            INSERT INTO user_rating_stats (user_id, rating_sum, rating_count)
+            VALUES (NEW.target_id, NEW.rating, 1)
+            ON CONFLICT(user_id) DO UPDATE SET
+                rating_sum = rating_sum + excluded.rating_sum,
+                rating_count = rating_count + 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_ratings_stats_delete
+        AFTER DELETE ON ratings WHEN OLD.rating IS NOT NULL
+        BEGIN
+            UPDATE user_rating_stats
+            SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1
+            WHERE user_id = OLD.target_id;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_ratings_stats_update
+        AFTER UPDATE OF target_id, rating ON ratings
+        BEGIN
+            UPDATE user_rating_stats
+            SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1
+            WHERE user_id = OLD.target_id AND OLD.rating IS NOT NULL;
+            INSERT INTO user_rating_stats (user_id, rating_sum, rating_count)
+            SELECT NEW.target_id, NEW.rating, 1 WHERE NEW.rating IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET
+                rating_sum = rating_sum + excluded.rating_sum,
+                rating_count = rating_count + 1;
+        END
+    """)
+    await _fill_rating_stats(db)
+
+async def _migration_4_daily_order_stats(db):
+    # Счётчики заказов по дню создания: статистика админки не сканирует orders
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_order_stats (
+            day TEXT PRIMARY KEY,            -- DATE(orders.created_at)
+            total INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_daily_insert
+        AFTER INSERT ON orders WHEN NEW.created_at IS NOT NULL
+        BEGIN
+            INSERT INTO daily_order_stats (day, total, completed, cancelled)
+            VALUES (DATE(NEW.created_at), 1, NEW.status = 'completed', NEW.status = 'cancelled')
+            ON CONFLICT(day) DO UPDATE SET
+                total = total + 1,
+                completed = completed + excluded.completed,
+                cancelled = cancelled + excluded.cancelled;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_daily_delete
+        AFTER DELETE ON orders WHEN OLD.created_at IS NOT NULL
+        BEGIN
+            UPDATE daily_order_stats SET
+                total = total - 1,
+                completed = completed - (OLD.status = 'completed'),
+                cancelled = cancelled - (OLD.status = 'cancelled')
+            WHERE day = DATE(OLD.created_at);
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_daily_update
+        AFTER UPDATE OF status, created_at ON orders
+        WHEN OLD.status IS NOT NEW.status OR OLD.created_at IS NOT NEW.created_at
+        BEGIN
+            UPDATE daily_order_stats SET
+                total = total - 1,
+                completed = completed - (OLD.status = 'completed'),
+                cancelled = cancelled - (OLD.status = 'cancelled')
+            WHERE day = DATE(OLD.created_at);
+            INSERT INTO daily_order_stats (day, total, completed, cancelled)
+            SELECT DATE(NEW.created_at), 1, NEW.status = 'completed', NEW.status = 'cancelled'
+            WHERE NEW.created_at IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET
+                total = total + 1,
+                completed = completed + excluded.completed,
+                cancelled = cancelled + excluded.cancelled;
+        END
+    """)
+    await _fill_daily_order_stats(db)
+
+async def _migration_5_order_meta(db):
+    # Данные веб-заказа, которые раньше жили только в памяти процесса API
+    await _add_missing_columns(db, "orders", {
+        "passengers": "INTEGER DEFAULT 1",
+        "price": "REAL",
+        "distance_km": "REAL",
+        "estimated_time": "TEXT",
+        "pickup_lat": "REAL",
+        "pickup_lon": "REAL",
+        "dropoff_lat": "REAL",
+        "dropoff_lon": "REAL",
+    })
+
+async def _migration_6_outbox(db):
+    # Надёжная очередь исходящих сообщений Telegram (см. outbox.py)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT UNIQUE,             -- повторная постановка с тем же ключом игнорируется
+            priority INTEGER NOT NULL DEFAULT 5,  -- меньше — раньше
+            kind TEXT,                         -- 'order_offer', 'broadcast', ...
+            order_id INTEGER,
+            method TEXT NOT NULL DEFAULT 'sendMessage',
+            chat_id INTEGER,
+            payload TEXT NOT NULL,             -- JSON тела запроса к Bot API
+            status TEXT NOT NULL DEFAULT 'pending'
+                CHECK(status IN ('pending', 'sending', 'sent', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,  -- unix time
+            enqueued_at REAL NOT NULL,
+            sent_at REAL,
+            last_error TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_due
+        ON outbox(next_attempt_at) WHERE status = 'pending'
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_finished ON outbox(status, enqueued_at)")
+
+async def _migration_7_broadcast_stats(db):
+    # Итог доставки по каждому получателю: delivered / failed / blocked
+    await _add_missing_columns(db, "broadcast_receipts", {"status": "TEXT DEFAULT 'delivered'"})
+    # Счётчики на рассылку и по минутам: статистика не считает квитанции построчно
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_stats (
+            broadcast_id INTEGER PRIMARY KEY,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_delivery_buckets (
+            broadcast_id INTEGER NOT NULL,
+            minute TEXT NOT NULL,            -- 'YYYY-MM-DD HH:MM' по received_at (UTC)
+            delivered INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (broadcast_id, minute)
+        )
+    """)
+    # Триггеры срабатывают в транзакции, которая пишет пачку квитанций
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_broadcast_receipts_insert
+        AFTER INSERT ON broadcast_receipts
+        BEGIN
+            INSERT INTO broadcast_stats (broadcast_id, delivered, failed, blocked)
+            VALUES (NEW.broadcast_id, NEW.status = 'delivered', NEW.status = 'failed', NEW.status = 'blocked')
+            ON CONFLICT(broadcast_id) DO UPDATE SET
+                delivered = delivered + excluded.delivered,
+                failed = failed + excluded.failed,
+                blocked = blocked + excluded.blocked;
+            INSERT INTO broadcast_delivery_buckets (broadcast_id, minute, delivered, failed, blocked)
+            SELECT NEW.broadcast_id, strftime('%Y-%m-%d %H:%M', NEW.received_at),
+                   NEW.status = 'delivered', NEW.status = 'failed', NEW.status = 'blocked'
+            WHERE NEW.received_at IS NOT NULL
+            ON CONFLICT(broadcast_id, minute) DO UPDATE SET
+                delivered = delivered + excluded.delivered,
+                failed = failed + excluded.failed,
+                blocked = blocked + excluded.blocked;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_broadcast_receipts_delete
+        AFTER DELETE ON broadcast_receipts
+        BEGIN
+            UPDATE broadcast_stats SET
+                delivered = delivered - (OLD.status = 'delivered'),
+                failed = failed - (OLD.status = 'failed'),
+                blocked = blocked - (OLD.status = 'blocked')
+            WHERE broadcast_id = OLD.broadcast_id;
+            UPDATE broadcast_delivery_buckets SET
+                delivered = delivered - (OLD.status = 'delivered'),
+                failed = failed - (OLD.status = 'failed'),
+                blocked = blocked - (OLD.status = 'blocked')
+            WHERE broadcast_id = OLD.broadcast_id AND minute = strftime('%Y-%m-%d %H:%M', OLD.received_at);
+        END
+    """)
+    await _fill_broadcast_stats(db)
+
+async def _migration_8_offer_message_state(db):
+    # Предложения не удаляются, а редактируются: храним, что сейчас показано водителю
+    await _add_missing_columns(db, "driver_order_messages", {
+        "state": "TEXT DEFAULT 'open'",   # open / won / taken / cancelled / deleted
+        "closed_at": "TIMESTAMP",
+    })
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_driver_order_messages_open
+        ON driver_order_messages(order_id) WHERE state = 'open'
+    """)
+
+async def _migration_9_driver_locations(db):
+    # Последняя известная позиция водителя (индекс в памяти — dispatch.py)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS driver_locations (
+            driver_id INTEGER PRIMARY KEY,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            updated_at REAL NOT NULL          -- unix time
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_driver_locations_updated ON driver_locations(updated_at)")
+
+async def _migration_10_order_version(db):
+    # Версия заказа для ETag и long-poll: растёт при смене статуса, водителя, «прибыл» и заявок,
+    # в том числе при записях из бота
+    await _add_missing_columns(db, "orders", {"version": "INTEGER NOT NULL DEFAULT 0"})
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_version
+        AFTER UPDATE OF status, driver_id, driver_arrived ON orders
+        WHEN OLD.status IS NOT NEW.status OR OLD.driver_id IS NOT NEW.driver_id
+          OR OLD.driver_arrived IS NOT NEW.driver_arrived
+        BEGIN
+            UPDATE orders SET version = version + 1 WHERE id = NEW.id;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_bids_version_insert
+        AFTER INSERT ON bids
+        BEGIN
+            UPDATE orders SET version = version + 1 WHERE id = NEW.order_id;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_bids_version_update
+        AFTER UPDATE OF status ON bids WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE orders SET version = version + 1 WHERE id = NEW.order_id;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_bids_version_delete
+        AFTER DELETE ON bids
+        BEGIN
+            UPDATE orders SET version = version + 1 WHERE id = OLD.order_id;
+        END
+    """)
+
+async def _migration_11_order_deadlines(db):
+    # Сроки по заказам (автоотмена без заявок); переживают перезапуск, планировщик — scheduler.py
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS order_deadlines (
+            order_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,               -- auto_cancel
+            due_at REAL NOT NULL,             -- unix time
+            PRIMARY KEY (order_id, kind)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_order_deadlines_due ON order_deadlines(due_at)")
+    # Заявка снимает автоотмену, в том числе заявка из бота
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_bids_clear_auto_cancel
+        AFTER INSERT ON bids
+        BEGIN
+            DELETE FROM order_deadlines WHERE order_id = NEW.order_id AND kind = 'auto_cancel';
+        END
+    """)
+    # Заказ вышел из ожидания (принят, отменён, завершён) — его сроки больше не нужны
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_clear_deadlines
+        AFTER UPDATE OF status ON orders
+        WHEN NEW.status IS NOT 'pending'
+        BEGIN
+            DELETE FROM order_deadlines WHERE order_id = NEW.id;
+        END
+    """)
+
+async def _migration_12_outbox_lease(db):
+    # Аренда забранного сообщения: после перезапуска одного процесса в очередь возвращаются
+    # только сообщения с истёкшей арендой, а не те, что сейчас отправляет другой процесс
+    await _add_missing_columns(db, "outbox", {"lease_until": "REAL"})
+    # Сообщения, забранные до миграции, считаем с истёкшей арендой
+    await db.execute("UPDATE outbox SET lease_until = 0 WHERE status = 'sending' AND lease_until IS NULL")
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_sending
+        ON outbox(lease_until) WHERE status = 'sending'
+    """)
+
+async def _migration_13_deadline_arg(db):
+    # Параметр срока: для волны рассылки — сколько водителей уже уведомлено
+    await _add_missing_columns(db, "order_deadlines", {"arg": "INTEGER"})
+
+async def _migration_14_broadcast_lease(db):
+    # Аренда рассылки: её отправляет только один процесс, после его падения — другой, когда аренда истечёт
+    await _add_missing_columns(db, "broadcasts", {"lease_until": "REAL"})
+
+MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_indexes),
+    (3, _migration_3_rating_stats),
+    (4, _migration_4_daily_order_stats),
+    (5, _migration_5_order_meta),
+    (6, _migration_6_outbox),
+    (7, _migration_7_broadcast_stats),
+    (8, _migration_8_offer_message_state),
+    (9, _migration_9_driver_locations),
+    (10, _migration_10_order_version),
+    (11, _migration_11_order_deadlines),
+    (12, _migration_12_outbox_lease),
+    (13, _migration_13_deadline_arg),
+    (14, _migration_14_broadcast_lease),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Долгие обновления данных: выполняются порциями в фоне и безопасно продолжаются
+# после перезапуска, т.к. условие WHERE само отбирает ещё не обработанные строки.
+BACKFILLS = [
+    ("users.created_at", """
+        UPDATE users SET created_at = CURRENT_TIMESTAMP
+        WHERE rowid IN (SELECT rowid FROM users WHERE created_at IS NULL LIMIT ?)
+    """),
+]
+BACKFILL_BATCH_SIZE = 500
+_BACKFILL_TASK = None
+
+async def get_schema_version(db) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+async def migrate(db) -> int:
+    """Применяет недостающие миграции в одной транзакции. Возвращает версию схемы."""
+    version = await get_schema_version(db)
+    if version >= SCHEMA_VERSION:
+        return version
+
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        # Другой процесс мог успеть обновить схему, пока мы ждали блокировку
+        version = await get_schema_version(db)
+        for step_version, step in MIGRATIONS:
+            if step_version > version:
+                await step(db)
+                logging.info(f"✅ Применена миграция {step_version}: {step.__name__}")
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return SCHEMA_VERSION
+
+async def run_backfills(db_path: Optional[str] = None, batch_size: int = BACKFILL_BATCH_SIZE):
+    """Выполняет BACKFILLS короткими транзакциями, не удерживая соединение записи надолго."""
+    for name, query in BACKFILLS:
+        total = 0
+        while True:
+            async with writer(db_path or DB_PATH) as db:
+                cursor = await db.execute(query, (batch_size,))
+                await db.commit()
+            total += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                break
+            await asyncio.sleep(0)
+        if total:
+            logging.info(f"✅ Фоновое обновление {name}: {total} строк")
+
+async def init_db(db_path: Optional[str] = None):
+    async with writer(db_path or DB_PATH) as db:
+        await migrate(db)
+
+    global _BACKFILL_TASK
+    if _BACKFILL_TASK is None or _BACKFILL_TASK.done():
+        _BACKFILL_TASK = asyncio.create_task(run_backfills(db_path))
+
+async def migrate_all():
+    """Миграции и фоновые обновления данных до конца (для ручного запуска)."""
+    await init_db()
+    await _BACKFILL_TASK
+
+async def check_plans(db_path: Optional[str] = None) -> list:
+    """
+    Проверка планов HOT_QUERIES: python database.py check-plans [путь к БД].
+    Без пути схема создаётся миграциями во временной базе. Возвращает найденные полные сканирования.
+    """
+    if db_path is None:
+        import tempfile
+        db_path = os.path.join(tempfile.mkdtemp(prefix="taxi_plans_"), "taxi_bot.db")
+    async with writer(db_path) as db:
+        await migrate(db)
+        scans = await find_full_scans(db)
+    for name, detail in scans:
+        print(f"❌ {name}: {detail}")
+    if not scans:
+        print(f"✅ Полных сканирований нет ({len(HOT_QUERIES)} запросов)")
+    return scans
+
+# === Кэш пользователей ===
+# Роль, бан, смена, верификация и машина нужны почти на каждое обновление бота и запрос API
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# Сколько хранить профиль, секунд. Запись через этот модуль сбрасывает его сразу,
+# запись из другого процесса (бот / webapp) станет видна не позже чем через TTL
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+# Отсутствующий пользователь хранится меньше: он вот-вот может зарегистрироваться
+USER_CACHE_MISSING_TTL = float(os.getenv("USER_CACHE_MISSING_TTL", "5"))
+
+class AsyncTTLCache:
+    """
+    Кэш со сроком жизни у каждой записи и вытеснением давно не использованных (LRU).
+    Одновременные промахи по одному ключу ждут один вызов loader.
+    """
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS monthly_rides (
-                user_id INTEGER NOT NULL,
-                year_month TEXT NOT NULL,  -- формат: '2025-10'
-                ride_count INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, year_month)
-            )
-        """)
-
-        await db.execute("""
-            INSERT OR IGNORE INTO settings (key, value) VALUES ('auto_accept_on_first_bid', '0')
-        """)
-
-        # 2. Добавляем колонки, если их нет (для существующих баз)
-        # Проверяем users
-        cursor = await db.execute("PRAGMA table_info(users)")
-        columns = await cursor.fetchall()
-        column_names = [col[1] for col in columns]
-
-        if "is_banned" not in column_names:
-            await db.execute("ALTER TABLE users ADD COLUMN is_banned BOOLEAN DEFAULT 0")
-
-        cursor = await db.execute("PRAGMA table_info(broadcasts)")
-        columns = await cursor.fetchall()
-        colum_names = [col[1] for col in columns]
-
-        if "total_recipients" not in colum_names:
-            await db.execute("ALTER TABLE broadcasts ADD COLUMN total_recipients INTEGER DEFAULT 0")
-
-        cursor = await db.execute("PRAGMA table_info(bids)")
-        columns = await cursor.fetchall()
-        colum_names = [col[1] for col in columns]
-
-        if "arrival_minutes" not in colum_names:
-            await db.execute("ALTER TABLE bids ADD COLUMN arrival_minutes INTEGER DEFAULT 0")
-
-
-        cursor = await db.execute("PRAGMA table_info(users)")
-        columns = await cursor.fetchall()
-        column_names = [col[1] for col in columns]
-
-        if 'created_at' not in column_names:
-            await db.execute("ALTER TABLE users ADD COLUMN created_at TIMESTAMP")
-            await db.execute("UPDATE users SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
-
-            # === Добавляем has_co_driver только если его нет ===
-        async with db.execute("PRAGMA table_info(users)") as cursor:
-            columns = await cursor.fetchall()
-            column_names = {col[1] for col in columns}  # col[1] — имя столбца
-
-        if "has_co_driver" not in column_names:
-            await db.execute("ALTER TABLE users ADD COLUMN has_co_driver INTEGER DEFAULT 0")
-            await db.commit()
-            logging.info("✅ Добавлен столбец has_co_driver в таблицу users")
-        # Проверяем другие таблицы при необходимости...
-
-        # Добавляем cancelled_by, если его нет
-        cursor = await db.execute("PRAGMA table_info(orders)")
-        columns = await cursor.fetchall()
-        column_names = {col[1] for col in columns}
-        if "cancelled_by" not in column_names:
-            await db.execute("ALTER TABLE orders ADD COLUMN cancelled_by TEXT")
-            await db.commit()
-            logging.info("✅ Добавлен столбец cancelled_by в таблицу orders")
+    def __init__(self, loader, maxsize: int, ttl: float, missing_ttl: float):
+        self._loader = loader
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._missing_ttl = missing_ttl
+        self._data = OrderedDict()  # key → (истекает, time.monotonic(); значение)
+        self._loading = {}          # key → asyncio.Task загрузки
+        self.metrics = {"hits": 0, "misses": 0, "shared_loads": 0, "evictions": 0, "invalidations": 0}
+
+    async def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._data.move_to_end(key)
+            self.metrics["hits"] += 1
+            return entry[1]
+        self.metrics["misses"] += 1
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key))
+            self._loading[key] = task
+        else:
+            self.metrics["shared_loads"] += 1
+        # Отмена одного ожидающего не отменяет загрузку для остальных
+        return await asyncio.shield(task)
+
+    async def _load(self, key):
+        task = asyncio.current_task()
+        try:
+            value = await self._loader(key)
+        except BaseException:
+            if self._loading.get(key) is task:
+                del self._loading[key]
+            raise
+        # Если ключ сбросили во время загрузки, прочитанное значение могло устареть: не сохраняем
+        if self._loading.get(key) is task:
+            del self._loading[key]
+            ttl = self._ttl if value is not None else self._missing_ttl
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+                self.metrics["evictions"] += 1
+        return value
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        self._loading.pop(key, None)
+        self.metrics["invalidations"] += 1
+
+    def clear(self):
+        self._data.clear()
+        self._loading.clear()
+
+    def stats(self) -> dict:
+        return {**self.metrics, "size": len(self._data)}
+
+USER_PROFILE_COLUMNS = (
+    "role", "username", "is_banned", "shift_opened",
+    "is_verified", "verification_expires", "car_brand", "car_number",
+)
+
+async def _load_user_profile(user_id: int) -> Optional[dict]:
+    async with reader(DB_PATH) as db:
+        async with db.execute(
+            f"SELECT {', '.join(USER_PROFILE_COLUMNS)} FROM users WHERE user_id = ?", (user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return dict(zip(USER_PROFILE_COLUMNS, row)) if row else None
 
-        # Добавляем Source, если его нет
-        cursor = await db.execute("PRAGMA table_info(orders)")
-        columns = {col[1] for col in await cursor.fetchall()}
-        if "source" not in columns:
-            await db.execute("ALTER TABLE orders ADD COLUMN source TEXT DEFAULT 'telegram'")
+USER_CACHE = AsyncTTLCache(_load_user_profile, USER_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_MISSING_TTL)
 
-        # Добавляем driver_arrived, если его нет
-        cursor = await db.execute("PRAGMA table_info(orders)")
-        columns = {col[1] for col in await cursor.fetchall()}
-        if "driver_arrived" not in columns:
-            await db.execute("ALTER TABLE orders ADD COLUMN driver_arrived INTEGER DEFAULT 0")
+async def get_user_profile(user_id: int) -> Optional[dict]:
+    """Профиль пользователя (USER_PROFILE_COLUMNS) из кэша; None — пользователя нет. Не изменять."""
+    return await USER_CACHE.get(user_id)
 
-        await db.commit()
+def user_cache_metrics() -> dict:
+    return USER_CACHE.stats()
 
 async def get_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
             return await cursor.fetchone()
 
 async def get_client_order_history(client_id: int, limit: int = 5):
     """Возвращает последние заказы клиента."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("""
             SELECT id, pickup_address, dropoff_address, created_at
             FROM orders
@@ -238,7 +885,7 @@ async def get_client_order_history(client_id: int, limit: int = 5):
 
 async def save_user(user_id: int, role: str = None, username: str = None):
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         if role is not None:
             await db.execute("""
                 INSERT INTO users (user_id, username, role, created_at)
@@ -257,10 +904,11 @@ async def save_user(user_id: int, role: str = None, username: str = None):
                 (username, user_id)
             )
         await db.commit()
+    USER_CACHE.invalidate(user_id)
 
 async def get_random_partner_ad():
     """Возвращает случайное активное партнёрское объявление."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("""
             SELECT id, message_text, photo_file_id, url
             FROM partner_ads
@@ -272,40 +920,38 @@ async def get_random_partner_ad():
     return row  # (id, message_text, photo_file_id, url)
 
 async def save_car_info(user_id: int, brand: str, number: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute(
             "UPDATE users SET car_brand = ?, car_number = ? WHERE user_id = ?",
             (brand, number, user_id)
         )
         await db.commit()
+    USER_CACHE.invalidate(user_id)
 
 async def set_shift(user_id: int, is_open: bool, has_co_driver: int = 0):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute(
             "UPDATE users SET shift_opened = ?, has_co_driver = ? WHERE user_id = ?",
             (1 if is_open else 0, has_co_driver, user_id)
         )
         await db.commit()
+    USER_CACHE.invalidate(user_id)
 
 async def is_shift_opened(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT shift_opened FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return bool(row[0]) if row else False
+    profile = await get_user_profile(user_id)
+    return bool(profile["shift_opened"]) if profile else False
 
 async def create_order(client_id: int, pickup: str, dropoff: str, comment: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with writer(DB_PATH) as db:
+        cursor = await db.execute(
             "INSERT INTO orders (client_id, pickup_address, dropoff_address, comment, status) VALUES (?, ?, ?, ?, 'pending')",
             (client_id, pickup, dropoff, comment)
         )
         await db.commit()
-        async with db.execute("SELECT last_insert_rowid()") as cursor:
-            row = await cursor.fetchone()
-            return row[0]
+        return cursor.lastrowid
 
 async def get_pending_orders():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("""
             SELECT o.id, o.client_id, o.pickup_address, o.dropoff_address, o.comment 
             FROM orders o 
@@ -314,90 +960,97 @@ async def get_pending_orders():
             return await cursor.fetchall()
 
 async def get_drivers_with_open_shift():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("SELECT user_id FROM users WHERE role = 'driver' AND shift_opened = 1") as cursor:
             return [row[0] for row in await cursor.fetchall()]
 
 async def get_order(order_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("SELECT * FROM orders WHERE id = ?", (order_id,)) as cursor:
             return await cursor.fetchone()
 
 async def get_user_role(user_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT role FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row["role"] if row else None
+    profile = await get_user_profile(user_id)
+    return profile["role"] if profile else None
+
+async def get_user_username(user_id: int) -> Optional[str]:
+    profile = await get_user_profile(user_id)
+    return profile["username"] if profile else None
 
 async def get_driver_info(driver_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT car_brand, car_number FROM users WHERE user_id = ?", (driver_id,)
-        ) as cursor:
-            return await cursor.fetchone()
+    """(марка, номер) машины водителя или None."""
+    profile = await get_user_profile(driver_id)
+    return (profile["car_brand"], profile["car_number"]) if profile else None
 
 async def complete_order(order_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("UPDATE orders SET status = 'completed' WHERE id = ?", (order_id,))
         await db.commit()
 
 async def cancel_order(order_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("UPDATE orders SET status = 'cancelled' WHERE id = ?", (order_id,))
         await db.commit()
 
 async def save_rating(order_id: int, rater_id: int, target_id: int, rating: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO ratings (order_id, rater_id, target_id, rating) VALUES (?, ?, ?, ?)",
-            (order_id, rater_id, target_id, rating)
-        )
+    async with writer(DB_PATH) as db:
+        # UPSERT, а не REPLACE: обновление строки корректно пересчитывает user_rating_stats
+        await db.execute("""
+            INSERT INTO ratings (order_id, rater_id, target_id, rating) VALUES (?, ?, ?, ?)
+            ON CONFLICT(order_id, rater_id) DO UPDATE SET
+                target_id = excluded.target_id,
+                rating = excluded.rating
+        """, (order_id, rater_id, target_id, rating))
         await db.commit()
 
 
 # Общее количество пользователей
 async def get_total_users_count():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("SELECT COUNT(*) FROM users") as cursor:
             return (await cursor.fetchone())[0]
 
+async def get_order_stats(day: Optional[str] = None) -> dict:
+    """
+    Все счётчики заказов одним запросом по daily_order_stats:
+    {"day": (новые, завершённые, отменённые), "total": (всего, завершённые, отменённые)}.
+    """
+    day = day or date.today().isoformat()
+    async with reader(DB_PATH) as db:
+        async with db.execute("""
+            SELECT
+                COALESCE(SUM(CASE WHEN day = ? THEN total END), 0),
+                COALESCE(SUM(CASE WHEN day = ? THEN completed END), 0),
+                COALESCE(SUM(CASE WHEN day = ? THEN cancelled END), 0),
+                COALESCE(SUM(total), 0),
+                COALESCE(SUM(completed), 0),
+                COALESCE(SUM(cancelled), 0)
+            FROM daily_order_stats
+        """, (day, day, day)) as cursor:
+            row = await cursor.fetchone()
+    return {"day": tuple(row[:3]), "total": tuple(row[3:])}
+
 # Статистика за сегодня
 async def get_daily_stats():
     today = date.today().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Новые заказы
-        async with db.execute(
-                "SELECT COUNT(*) FROM orders WHERE DATE(created_at) = ?", (today,)
-        ) as cursor:
-            new_orders = (await cursor.fetchone())[0]
-
-        # Завершённые
-        async with db.execute(
-                "SELECT COUNT(*) FROM orders WHERE status = 'completed' AND DATE(created_at) = ?", (today,)
-        ) as cursor:
-            completed = (await cursor.fetchone())[0]
-
-        # Отменённые
+    async with reader(DB_PATH) as db:
         async with db.execute(
-                "SELECT COUNT(*) FROM orders WHERE status = 'cancelled' AND DATE(created_at) = ?", (today,)
+                "SELECT total, completed, cancelled FROM daily_order_stats WHERE day = ?", (today,)
         ) as cursor:
-            cancelled = (await cursor.fetchone())[0]
+            row = await cursor.fetchone()
 
-        return new_orders, completed, cancelled
+        # Новые, завершённые, отменённые
+        return tuple(row) if row else (0, 0, 0)
 
 async def get_user_rating(user_id: int) -> float:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT AVG(rating) FROM ratings WHERE target_id = ?",
-            (user_id,)
-        ) as cursor:
+    async with reader(DB_PATH) as db:
+        async with db.execute(RATING_STATS_QUERY, (user_id,)) as cursor:
             row = await cursor.fetchone()
-            return round(row[0], 1) if row[0] else 0.0
+            return round(row[0], 1) if row and row[0] else 0.0
 
 async def get_completed_orders_count(user_id: int, role: str) -> int:
     field = "driver_id" if role == "driver" else "client_id"
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute(
             f"SELECT COUNT(*) FROM orders WHERE {field} = ? AND status = 'completed'", (user_id,)
         ) as cursor:
@@ -406,7 +1059,7 @@ async def get_completed_orders_count(user_id: int, role: str) -> int:
 
 async def has_user_rated(order_id: int, rater_id: int) -> bool:
     """Проверяет, ставил ли пользователь (rater_id) оценку по заказу (order_id)."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute(
             "SELECT 1 FROM ratings WHERE order_id = ? AND rater_id = ?",
             (order_id, rater_id)
@@ -415,7 +1068,7 @@ async def has_user_rated(order_id: int, rater_id: int) -> bool:
 
 async def create_bid(order_id: int, driver_id: int, arrival_minutes: int = None):
     """Создаёт заявку водителя на заказ."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         # Проверяем, не делал ли уже заявку
         async with db.execute(
             "SELECT 1 FROM bids WHERE order_id = ? AND driver_id = ?", (order_id, driver_id)
@@ -432,7 +1085,7 @@ async def create_bid(order_id: int, driver_id: int, arrival_minutes: int = None)
 
 async def get_bids_for_order(order_id: int):
     """Получает список активных заявок по заказу."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("""
             SELECT b.driver_id, u.car_brand, u.car_number, b.arrival_minutes, u.has_co_driver
             FROM bids b
@@ -441,108 +1094,130 @@ async def get_bids_for_order(order_id: int):
         """, (order_id,)) as cursor:
             return await cursor.fetchall()  # (driver_id, brand, number, arrival_minutes, has_co_driver)
 
+async def get_bids_with_ratings(order_id: int):
+    """Активные заявки по заказу вместе с авто, напарником и рейтингом — одним запросом."""
+    async with reader(DB_PATH) as db:
+        async with db.execute("""
+            SELECT b.driver_id, u.car_brand, u.car_number, b.arrival_minutes, u.has_co_driver,
+                   CAST(s.rating_sum AS REAL) / NULLIF(s.rating_count, 0)
+            FROM bids b
+            JOIN users u ON b.driver_id = u.user_id
+            LEFT JOIN user_rating_stats s ON s.user_id = b.driver_id
+            WHERE b.order_id = ? AND b.status = 'pending'
+            ORDER BY b.id
+        """, (order_id,)) as cursor:
+            rows = await cursor.fetchall()
+    # (driver_id, brand, number, arrival_minutes, has_co_driver, rating)
+    return [row[:5] + (round(row[5], 1) if row[5] else 0.0,) for row in rows]
+
+# Результаты try_accept_bid
+ACCEPT_OK = "accepted"
+ACCEPT_DRIVER_BUSY = "driver_busy"    # водитель уже выполняет другой заказ
+ACCEPT_UNAVAILABLE = "unavailable"    # заказ уже взят, отменён или не существует
+
+async def try_accept_bid(order_id: int, driver_id: int) -> str:
+    """
+    Атомарно назначает водителя на заказ: одна транзакция BEGIN IMMEDIATE и условный UPDATE.
+    Из нескольких одновременных попыток побеждает ровно одна на заказ и на водителя.
+    """
+    async with writer(DB_PATH) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = await db.execute("""
+                UPDATE orders SET driver_id = ?, status = 'accepted'
+                WHERE id = ? AND status = 'pending' AND driver_id IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM orders WHERE driver_id = ? AND status = 'accepted')
+            """, (driver_id, order_id, driver_id))
+            if cursor.rowcount != 1:
+                async with db.execute(
+                    "SELECT 1 FROM orders WHERE driver_id = ? AND status = 'accepted'", (driver_id,)
+                ) as busy_cursor:
+                    busy = await busy_cursor.fetchone() is not None
+                await db.rollback()
+                return ACCEPT_DRIVER_BUSY if busy else ACCEPT_UNAVAILABLE
+
+            # Принимаем заявку выбранного водителя, остальные отклоняем
+            await db.execute("""
+                UPDATE bids SET status = CASE WHEN driver_id = ? THEN 'accepted' ELSE 'rejected' END
+                WHERE order_id = ?
+            """, (driver_id, order_id))
+            await db.commit()
+            return ACCEPT_OK
+        except Exception:
+            await db.rollback()
+            raise
+
 async def accept_bid(order_id: int, driver_id: int):
     """Клиент выбирает водителя. Возвращает True, если успешно."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверяем, не выбран ли уже водитель на этот заказ
-        async with db.execute("SELECT driver_id FROM orders WHERE id = ? AND status = 'pending'", (order_id,)) as cursor:
-            row = await cursor.fetchone()
-            if not row or row[0] is not None:
-                return False
-
-        # Принимаем заявку
-        await db.execute("UPDATE bids SET status = 'accepted' WHERE order_id = ? AND driver_id = ?", (order_id, driver_id))
-        # Отклоняем остальные
-        await db.execute("UPDATE bids SET status = 'rejected' WHERE order_id = ? AND driver_id != ?", (order_id, driver_id))
-        # Обновляем заказ
-        await db.execute("UPDATE orders SET driver_id = ?, status = 'accepted' WHERE id = ?", (driver_id, order_id))
-        await db.commit()
-        return True
+    return await try_accept_bid(order_id, driver_id) == ACCEPT_OK
 
 async def get_driver_rating(driver_id: int) -> float:
     """Получает рейтинг водителя (уже есть, но для ясности)."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT AVG(rating) FROM ratings WHERE target_id = ?", (driver_id,)) as cursor:
-            row = await cursor.fetchone()
-            return round(row[0], 1) if row[0] else 0.0
+    return await get_user_rating(driver_id)
 
 async def set_driver_verification(user_id: int, expires_date: str = None):
     """
     Подтверждает верификацию водителя.
     expires_date: 'YYYY-MM-DD' или None (бессрочно)
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute(
             "UPDATE users SET is_verified = 1, verification_expires = ? WHERE user_id = ?",
             (expires_date, user_id)
         )
         await db.commit()
+    USER_CACHE.invalidate(user_id)
 
 async def is_driver_verified(user_id: int) -> bool:
     """Проверяет, верифицирован ли водитель и не истёк ли срок."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT is_verified, verification_expires 
-            FROM users 
-            WHERE user_id = ? AND role = 'driver'
-        """, (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if not row or not row[0]:
-                return False
+    profile = await get_user_profile(user_id)
+    if not profile or profile["role"] != "driver" or not profile["is_verified"]:
+        return False
 
-            expires = row[1]
-            if expires is None:
-                return True  # бессрочно
+    expires = profile["verification_expires"]
+    if expires is None:
+        return True  # бессрочно
 
-            from datetime import date
-            try:
-                expire_date = date.fromisoformat(expires)
-                return expire_date >= date.today()
-            except:
-                return False
+    # Срок проверяется при каждом вызове, а не при загрузке в кэш
+    try:
+        expire_date = date.fromisoformat(expires)
+        return expire_date >= date.today()
+    except:
+        return False
 
 # Статистика за всё время
 async def get_total_orders_count():
     """Общее количество заказов за всё время."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM orders") as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+    return (await get_order_stats())["total"][0]
 
 
 async def get_total_completed_orders():
     """Количество завершённых заказов."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM orders WHERE status = 'completed'") as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+    return (await get_order_stats())["total"][1]
 
 
 async def get_total_cancelled_orders():
     """Количество отменённых заказов."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM orders WHERE status = 'cancelled'") as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+    return (await get_order_stats())["total"][2]
 
 async def ban_user(user_id: int):
     """Блокирует пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("UPDATE users SET is_banned = 1 WHERE user_id = ?", (user_id,))
         await db.commit()
+    USER_CACHE.invalidate(user_id)
 
 async def unban_user(user_id: int):
     """Разблокирует пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("UPDATE users SET is_banned = 0 WHERE user_id = ?", (user_id,))
         await db.commit()
+    USER_CACHE.invalidate(user_id)
 
 async def is_user_banned(user_id: int) -> bool:
     """Проверяет, заблокирован ли пользователь."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return bool(row[0]) if row else False
+    profile = await get_user_profile(user_id)
+    return bool(profile["is_banned"]) if profile else False
 
 async def create_backup():
     """Создаёт резервную копию БД."""
@@ -553,7 +1228,11 @@ async def create_backup():
     backup_path = os.path.join(BACKUP_DIR, backup_filename)
 
     try:
-        shutil.copy2(DB_PATH, backup_path)
+        # В режиме WAL часть данных лежит в -wal файле, поэтому копируем
+        # через backup API SQLite, а не простым копированием файла
+        async with reader(DB_PATH) as db:
+            async with aiosqlite.connect(backup_path) as target:
+                await db.backup(target)
         logging.info(f"✅ Резервная копия создана: {backup_path}")
 
         # Удаляем старые копии
@@ -573,24 +1252,161 @@ async def create_backup():
         logging.error(f"❌ Ошибка создания резервной копии: {e}")
         return None
 
+# Условие отбора получателей рассылки по target
+BROADCAST_TARGETS = {
+    "all": "is_banned = 0",
+    "drivers": "role = 'driver' AND is_banned = 0",
+    "clients": "role = 'client' AND is_banned = 0",
+}
+
 async def get_broadcast_recipients(target: str):
     """Возвращает список user_id для рассылки."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        if target == "all":
-            query = "SELECT user_id FROM users WHERE is_banned = 0"
-        elif target == "drivers":
-            query = "SELECT user_id FROM users WHERE role = 'driver' AND is_banned = 0"
-        elif target == "clients":
-            query = "SELECT user_id FROM users WHERE role = 'client' AND is_banned = 0"
-        else:
-            return []
+    condition = BROADCAST_TARGETS.get(target)
+    if condition is None:
+        return []
+    async with reader(DB_PATH) as db:
+        async with db.execute(f"SELECT user_id FROM users WHERE {condition}") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def claim_due_broadcast(lease: float) -> Optional[tuple]:
+    """
+    Забирает одну наступившую неотправленную рассылку с арендой на lease секунд.
+    Рассылки, арендованные другим процессом, пропускаются.
+    Строка: (id, target, message_text, photo_file_id, document_file_id, caption) или None.
+    """
+    now = time.time()
+    async with writer(DB_PATH) as db:
+        async with db.execute("""
+            UPDATE broadcasts SET lease_until = ?
+            WHERE id = (
+                SELECT id FROM broadcasts
+                WHERE is_sent = 0 AND (scheduled_at IS NULL OR datetime(scheduled_at) <= datetime(?))
+                  AND (lease_until IS NULL OR lease_until < ?)
+                ORDER BY scheduled_at, id
+                LIMIT 1
+            )
+            RETURNING id, target, message_text, photo_file_id, document_file_id, caption
+        """, (now + lease, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), now)) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+    return row
+
+async def release_broadcast(broadcast_id: int):
+    """Снимает аренду незавершённой рассылки: её можно продолжить сразу, не дожидаясь истечения."""
+    async with writer(DB_PATH) as db:
+        await db.execute("UPDATE broadcasts SET lease_until = NULL WHERE id = ?", (broadcast_id,))
+        await db.commit()
 
-        async with db.execute(query) as cursor:
+async def get_broadcast_recipients_page(broadcast_id: int, target: str, after_user_id: int, limit: int) -> list:
+    """
+    Следующая страница получателей (user_id > after_user_id) без квитанции по этой рассылке.
+    Постраничный проход по первичному ключу: память не зависит от числа пользователей.
+    """
+    condition = BROADCAST_TARGETS.get(target)
+    if condition is None:
+        return []
+    async with reader(DB_PATH) as db:
+        async with db.execute(f"""
+            SELECT u.user_id FROM users u
+            WHERE u.user_id > ? AND {condition}
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_receipts r WHERE r.broadcast_id = ? AND r.user_id = u.user_id
+              )
+            ORDER BY u.user_id
+            LIMIT ?
+        """, (after_user_id, broadcast_id, limit)) as cursor:
             return [row[0] for row in await cursor.fetchall()]
 
+async def save_broadcast_receipts(broadcast_id: int, results: list, lease: Optional[float] = None):
+    """
+    Записывает квитанции [(user_id, status)] пачкой. Счётчики broadcast_stats обновляют
+    триггеры, total_recipients (доставлено) копируется из них в той же транзакции;
+    там же аренда рассылки продлевается на lease секунд (см. claim_due_broadcast).
+    """
+    if not results:
+        return
+    async with writer(DB_PATH) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await db.executemany(
+                "INSERT OR IGNORE INTO broadcast_receipts (broadcast_id, user_id, status) VALUES (?, ?, ?)",
+                [(broadcast_id, user_id, status) for user_id, status in results]
+            )
+            await db.execute("""
+                UPDATE broadcasts
+                SET total_recipients = COALESCE(
+                    (SELECT delivered FROM broadcast_stats WHERE broadcast_id = ?), total_recipients
+                ),
+                    lease_until = COALESCE(?, lease_until)
+                WHERE id = ?
+            """, (broadcast_id, time.time() + lease if lease is not None else None, broadcast_id))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+async def mark_broadcast_sent(broadcast_id: int):
+    """Закрывает рассылку; total_recipients сверяется со счётчиком доставленных в той же транзакции."""
+    async with writer(DB_PATH) as db:
+        await db.execute("""
+            UPDATE broadcasts
+            SET is_sent = 1,
+                lease_until = NULL,
+                total_recipients = COALESCE(
+                    (SELECT delivered FROM broadcast_stats WHERE broadcast_id = ?), 0
+                )
+            WHERE id = ?
+        """, (broadcast_id, broadcast_id))
+        await db.commit()
+
+async def get_broadcast_stats(broadcast_id: int) -> Optional[dict]:
+    """Счётчики доставки рассылки и ряд по минутам [(минута, доставлено, ошибок, заблокировали)]."""
+    async with reader(DB_PATH) as db:
+        async with db.execute("""
+            SELECT b.target, b.scheduled_at, b.is_sent,
+                   COALESCE(s.delivered, 0), COALESCE(s.failed, 0), COALESCE(s.blocked, 0)
+            FROM broadcasts b
+            LEFT JOIN broadcast_stats s ON s.broadcast_id = b.id
+            WHERE b.id = ?
+        """, (broadcast_id,)) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        async with db.execute("""
+            SELECT minute, delivered, failed, blocked
+            FROM broadcast_delivery_buckets
+            WHERE broadcast_id = ?
+            ORDER BY minute
+        """, (broadcast_id,)) as cursor:
+            series = await cursor.fetchall()
+    target, scheduled_at, is_sent, delivered, failed, blocked = row
+    return {
+        "id": broadcast_id,
+        "target": target,
+        "scheduled_at": scheduled_at,
+        "is_sent": bool(is_sent),
+        "delivered": delivered,
+        "failed": failed,
+        "blocked": blocked,
+        "series": series,
+    }
+
+async def get_recent_broadcast_stats(limit: int = 10) -> list:
+    """Последние рассылки со счётчиками: (id, target, scheduled_at, is_sent, delivered, failed, blocked)."""
+    async with reader(DB_PATH) as db:
+        async with db.execute("""
+            SELECT b.id, b.target, b.scheduled_at, b.is_sent,
+                   COALESCE(s.delivered, 0), COALESCE(s.failed, 0), COALESCE(s.blocked, 0)
+            FROM broadcasts b
+            LEFT JOIN broadcast_stats s ON s.broadcast_id = b.id
+            ORDER BY b.id DESC
+            LIMIT ?
+        """, (limit,)) as cursor:
+            return await cursor.fetchall()
+
 async def save_driver_order_message(order_id: int, driver_id: int, chat_id: int, message_id: int):
     """Сохраняет ID сообщения заказа для водителя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute(
             "INSERT INTO driver_order_messages (order_id, driver_id, chat_id, message_id) VALUES (?, ?, ?, ?)",
             (order_id, driver_id, chat_id, message_id)
@@ -599,7 +1415,7 @@ async def save_driver_order_message(order_id: int, driver_id: int, chat_id: int,
 
 async def get_driver_order_messages(order_id: int) -> list:
     """Возвращает список (chat_id, message_id, driver_id) для всех водителей по заказу."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("""
             SELECT chat_id, message_id, driver_id
             FROM driver_order_messages
@@ -609,18 +1425,282 @@ async def get_driver_order_messages(order_id: int) -> list:
 
 async def delete_driver_order_messages(order_id: int):
     """Удаляет все записи сообщений по заказу."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("DELETE FROM driver_order_messages WHERE order_id = ?", (order_id,))
         await db.commit()
 
+async def delete_driver_order_message_rows(order_id: int, messages: list):
+    """Удаляет записи конкретных сообщений [(chat_id, message_id)] по заказу."""
+    if not messages:
+        return
+    async with writer(DB_PATH) as db:
+        await db.executemany(
+            "DELETE FROM driver_order_messages WHERE order_id = ? AND chat_id = ? AND message_id = ?",
+            [(order_id, chat_id, message_id) for chat_id, message_id in messages]
+        )
+        await db.commit()
+
+async def get_offer_messages(order_id: int) -> list:
+    """Сообщения-предложения заказа с состоянием: [(chat_id, message_id, driver_id, state)]."""
+    async with reader(DB_PATH) as db:
+        async with db.execute("""
+            SELECT chat_id, message_id, driver_id, COALESCE(state, 'open')
+            FROM driver_order_messages
+            WHERE order_id = ?
+        """, (order_id,)) as cursor:
+            return await cursor.fetchall()
+
+async def set_offer_message_states(order_id: int, updates: list):
+    """Запоминает, что показано водителям: [(chat_id, message_id, state)] одной транзакцией."""
+    if not updates:
+        return
+    async with writer(DB_PATH) as db:
+        await db.executemany("""
+            UPDATE driver_order_messages SET state = ?, closed_at = CURRENT_TIMESTAMP
+            WHERE order_id = ? AND chat_id = ? AND message_id = ?
+        """, [(state, order_id, chat_id, message_id) for chat_id, message_id, state in updates])
+        await db.commit()
+
+async def get_orders_with_stale_messages() -> list:
+    """Заказы, которые уже не ожидают водителя, но у водителей остались открытые предложения."""
+    async with reader(DB_PATH) as db:
+        async with db.execute("""
+            SELECT DISTINCT m.order_id
+            FROM driver_order_messages m
+            JOIN orders o ON o.id = m.order_id
+            WHERE m.state = 'open' AND o.status != 'pending'
+        """) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def purge_closed_offer_messages(days: int = 2) -> int:
+    """Удаляет записи о закрытых предложениях старше days дней."""
+    async with writer(DB_PATH) as db:
+        cursor = await db.execute("""
+            DELETE FROM driver_order_messages
+            WHERE state != 'open' AND closed_at < datetime('now', ?)
+        """, (f"-{days} days",))
+        await db.commit()
+        return cursor.rowcount
+
+# === Геопозиции водителей ===
+async def save_driver_locations(locations: list):
+    """Сохраняет позиции [(driver_id, lat, lon, updated_at)] одной транзакцией (более новая побеждает)."""
+    if not locations:
+        return
+    async with writer(DB_PATH) as db:
+        await db.executemany("""
+            INSERT INTO driver_locations (driver_id, lat, lon, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(driver_id) DO UPDATE SET
+                lat = excluded.lat, lon = excluded.lon, updated_at = excluded.updated_at
+            WHERE excluded.updated_at > driver_locations.updated_at
+        """, locations)
+        await db.commit()
+
+async def get_driver_locations(since: float) -> list:
+    """Позиции, обновлённые после since (unix time): [(driver_id, lat, lon, updated_at)]."""
+    async with reader(DB_PATH) as db:
+        async with db.execute(
+            "SELECT driver_id, lat, lon, updated_at FROM driver_locations WHERE updated_at > ?", (since,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+# === Рассылка заказа волнами ===
+async def get_dispatch_candidates() -> list:
+    """Водители на смене и верифицированные: [(driver_id, рейтинг, занят ли принятым заказом)]."""
+    async with reader(DB_PATH) as db:
+        async with db.execute(DISPATCH_CANDIDATES_QUERY) as cursor:
+            return [(driver_id, rating, bool(busy)) for driver_id, rating, busy in await cursor.fetchall()]
+
+async def get_order_dispatch_state(order_id: int) -> Optional[tuple]:
+    """(статус заказа, число активных заявок) или None, если заказа нет."""
+    async with reader(DB_PATH) as db:
+        async with db.execute(ORDER_DISPATCH_STATE_QUERY, (order_id,)) as cursor:
+            return await cursor.fetchone()
+
+# === Доска заказов для водителей (WebSocket) ===
+async def get_pending_board_orders() -> list:
+    """Ожидающие водителя заказы с ценой и координатами: [dict по BOARD_ORDER_COLUMNS]."""
+    async with reader(DB_PATH) as db:
+        async with db.execute(PENDING_BOARD_QUERY) as cursor:
+            return [dict(zip(BOARD_ORDER_COLUMNS, row)) for row in await cursor.fetchall()]
+
+# === События заказов (SSE) ===
+async def get_orders_event_state(order_ids: list) -> dict:
+    """
+    Состояние заказов для ленты событий:
+    {order_id: (статус, driver_id, driver_arrived, число заявок, версия)}.
+    """
+    states = {}
+    async with reader(DB_PATH) as db:
+        # Не больше 500 параметров в одном запросе
+        for i in range(0, len(order_ids), 500):
+            chunk = order_ids[i:i + 500]
+            async with db.execute(f"""
+                SELECT o.id, o.status, o.driver_id, o.driver_arrived,
+                       (SELECT COUNT(*) FROM bids b WHERE b.order_id = o.id), o.version
+                FROM orders o
+                WHERE o.id IN ({",".join("?" * len(chunk))})
+            """, chunk) as cursor:
+                for order_id, *state in await cursor.fetchall():
+                    states[order_id] = tuple(state)
+    return states
+
+async def get_order_statuses(order_ids) -> dict:
+    """Статусы заказов одним запросом: {order_id: статус}; удалённых заказов в ответе нет."""
+    order_ids = list(order_ids)
+    statuses = {}
+    async with reader(DB_PATH) as db:
+        for i in range(0, len(order_ids), 500):
+            chunk = order_ids[i:i + 500]
+            async with db.execute(
+                f"SELECT id, status FROM orders WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ) as cursor:
+                statuses.update(await cursor.fetchall())
+    return statuses
+
+# === Сроки по заказам (scheduler.py) ===
+async def schedule_order_deadline(order_id: int, kind: str, due_at: float, arg: Optional[int] = None):
+    """Назначает (или переносит) срок kind для заказа на due_at (unix time) с параметром arg."""
+    async with writer(DB_PATH) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO order_deadlines (order_id, kind, due_at, arg) VALUES (?, ?, ?, ?)",
+            (order_id, kind, due_at, arg)
+        )
+        await db.commit()
+
+async def get_order_deadline(order_id: int, kind: str) -> Optional[float]:
+    """Момент срока kind для заказа (unix time) или None, если срок не назначен или уже снят."""
+    async with reader(DB_PATH) as db:
+        async with db.execute(
+            "SELECT due_at FROM order_deadlines WHERE order_id = ? AND kind = ?", (order_id, kind)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def get_order_deadlines() -> list:
+    """Все назначенные сроки: [(order_id, kind, due_at)] — для восстановления после перезапуска."""
+    async with reader(DB_PATH) as db:
+        async with db.execute("SELECT order_id, kind, due_at FROM order_deadlines") as cursor:
+            return await cursor.fetchall()
+
+async def claim_due_deadlines(now: float) -> list:
+    """
+    Забирает наступившие сроки, удаляя их: [(order_id, kind, arg)].
+    Срок, снятый заявкой или сменой статуса, уже удалён триггером и сюда не попадёт;
+    удаление в одной транзакции не даёт двум процессам выполнить один срок дважды.
+    """
+    async with writer(DB_PATH) as db:
+        async with db.execute(
+            "DELETE FROM order_deadlines WHERE due_at <= ? RETURNING order_id, kind, arg", (now,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        await db.commit()
+    return rows
+
+# === Очередь исходящих сообщений (outbox) ===
+OUTBOX_COLUMNS = ("dedup_key", "priority", "kind", "order_id", "method", "chat_id", "payload")
+
+async def outbox_enqueue(messages: list) -> int:
+    """Добавляет сообщения (dict с ключами OUTBOX_COLUMNS) одной транзакцией. Возвращает число новых."""
+    now = time.time()
+    async with writer(DB_PATH) as db:
+        before = db.total_changes
+        await db.executemany(
+            f"INSERT OR IGNORE INTO outbox ({', '.join(OUTBOX_COLUMNS)}, enqueued_at, next_attempt_at) "
+            f"VALUES ({', '.join('?' for _ in OUTBOX_COLUMNS)}, ?, ?)",
+            [tuple(message.get(column) for column in OUTBOX_COLUMNS) + (now, now) for message in messages]
+        )
+        await db.commit()
+        return db.total_changes - before
+
+async def outbox_claim(limit: int, lease: float) -> list:
+    """
+    Забирает до limit готовых к отправке сообщений по приоритету и помечает их 'sending'
+    с арендой на lease секунд.
+    Строки: (id, kind, order_id, method, chat_id, payload, attempts, enqueued_at, priority).
+    """
+    async with writer(DB_PATH) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            async with db.execute("""
+                SELECT id, kind, order_id, method, chat_id, payload, attempts, enqueued_at, priority
+                FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY priority, next_attempt_at
+                LIMIT ?
+            """, (time.time(), limit)) as cursor:
+                rows = await cursor.fetchall()
+            if rows:
+                await db.executemany(
+                    "UPDATE outbox SET status = 'sending', attempts = attempts + 1, lease_until = ? WHERE id = ?",
+                    [(time.time() + lease, row[0]) for row in rows]
+                )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    return rows
+
+async def outbox_finish(results: list, offer_messages: list = ()):
+    """
+    Записывает результаты отправки одной транзакцией.
+    results: [(id, status, next_attempt_at, last_error)], status — 'sent', 'pending' (повтор) или 'failed'.
+    offer_messages: [(order_id, driver_id, chat_id, message_id)] — доставленные предложения заказов,
+    сохраняются в driver_order_messages в той же транзакции.
+    """
+    now = time.time()
+    async with writer(DB_PATH) as db:
+        try:
+            await db.executemany("""
+                UPDATE outbox SET status = ?, next_attempt_at = COALESCE(?, next_attempt_at), last_error = ?,
+                    sent_at = CASE WHEN ? = 'sent' THEN ? END
+                WHERE id = ?
+            """, [(status, next_at, error, status, now, outbox_id) for outbox_id, status, next_at, error in results])
+            if offer_messages:
+                await db.executemany(
+                    "INSERT INTO driver_order_messages (order_id, driver_id, chat_id, message_id) VALUES (?, ?, ?, ?)",
+                    offer_messages
+                )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+async def outbox_recover() -> int:
+    """
+    Возвращает в очередь сообщения 'sending' с истёкшей арендой: процесс, забравший их, упал
+    или перезапустился. Сообщения, которые сейчас отправляет другой процесс, не трогаются.
+    """
+    async with writer(DB_PATH) as db:
+        cursor = await db.execute(
+            "UPDATE outbox SET status = 'pending', lease_until = NULL WHERE status = 'sending' AND lease_until < ?",
+            (time.time(),)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+async def outbox_cleanup(older_than: float) -> int:
+    """Удаляет отправленные и окончательно не доставленные сообщения старше older_than (unix time)."""
+    async with writer(DB_PATH) as db:
+        cursor = await db.execute(
+            "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND enqueued_at < ?", (older_than,)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+async def outbox_counts() -> dict:
+    async with reader(DB_PATH) as db:
+        async with db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status") as cursor:
+            return {status: count for status, count in await cursor.fetchall()}
+
 async def get_setting(key: str, default: str = "1") -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cursor:
             row = await cursor.fetchone()
             return row[0] if row else default
 
 async def set_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
         await db.commit()
 
@@ -628,7 +1708,7 @@ async def increment_monthly_rides(user_id: int):
     """Увеличивает счётчик поездок за текущий месяц."""
     now = datetime.now()
     year_month = now.strftime("%Y-%m")
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("""
             INSERT INTO monthly_rides (user_id, year_month, ride_count)
             VALUES (?, ?, 1)
@@ -639,7 +1719,7 @@ async def increment_monthly_rides(user_id: int):
 async def get_monthly_rides(user_id: int) -> int:
     """Возвращает количество поездок за текущий месяц."""
     year_month = datetime.now().strftime("%Y-%m")
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute(
             "SELECT ride_count FROM monthly_rides WHERE user_id = ? AND year_month = ?",
             (user_id, year_month)
@@ -647,8 +1727,52 @@ async def get_monthly_rides(user_id: int) -> int:
             row = await cursor.fetchone()
     return row[0] if row else 0
 
+async def cancel_order_if_no_bids(order_id: int, reason: str) -> Optional[int]:
+    """
+    Отменяет ожидающий заказ без заявок одним условным UPDATE: заявка или принятие,
+    успевшие раньше, не перезаписываются. Возвращает client_id, если заказ отменён, иначе None.
+    """
+    async with writer(DB_PATH) as db:
+        async with db.execute("""
+            UPDATE orders SET status = 'cancelled', cancelled_by = ?
+            WHERE id = ? AND status = 'pending'
+              AND NOT EXISTS (SELECT 1 FROM bids WHERE order_id = ?)
+            RETURNING client_id
+        """, (reason, order_id, order_id)) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+    return row[0] if row else None
+
 async def cancel_order_with_reason(order_id: int, reason: str):
     """Отменяет заказ и сохраняет причину."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("UPDATE orders SET status = 'cancelled', cancelled_by = ? WHERE id = ?", (reason, order_id))
-        await db.commit()
\ No newline at end of file
+        await db.commit()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Служебные команды: python database.py <команда>
+    COMMANDS = {
+        "migrate": migrate_all,
+        "rebuild-rating-stats": rebuild_rating_stats,
+        "rebuild-order-stats": rebuild_daily_order_stats,
+        "rebuild-broadcast-stats": rebuild_broadcast_stats,
+        "check-plans": check_plans,
+    }
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command not in COMMANDS:
+        print(f"Использование: python database.py [{' | '.join(COMMANDS)}]")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+
+    async def run_command():
+        try:
+            return await COMMANDS[command](*sys.argv[2:])
+        finally:
+            await close_pools()
+
+    result = asyncio.run(run_command())
+    # check-plans завершается с ошибкой при полном сканировании (для CI)
+    sys.exit(1 if command == "check-plans" and result else 0)
@@ -0,0 +1,224 @@
+# db_pool.py
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import aiosqlite
+
+# Количество соединений только для чтения на один файл БД
+POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))
+# Сколько секунд ждать свободное соединение
+POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))
+
+# === Настройки SQLite (применяются к каждому соединению) ===
+# WAL: читатели не ждут писателя, а бот и веб-API не блокируют друг друга
+JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+# NORMAL в режиме WAL безопасен при падении процесса и не делает fsync на каждый коммит
+SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Кэш страниц на соединение, КиБ
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+# Окно чтения через mmap, байт (0 — отключить)
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Сколько ждать снятия блокировки другим процессом, мс
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+
+async def bootstrap_connection(conn: aiosqlite.Connection, is_writer: bool = False):
+    """Применяет PRAGMA-настройки к новому соединению."""
+    await conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    if is_writer:
+        # journal_mode хранится в файле БД, достаточно выставить его с соединения записи
+        async with conn.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}") as cursor:
+            row = await cursor.fetchone()
+            if row and row[0].lower() != JOURNAL_MODE.lower():
+                logging.warning(f"⚠️ journal_mode={row[0]} вместо {JOURNAL_MODE}")
+    await conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    await conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    await conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    await conn.execute("PRAGMA temp_store = MEMORY")
+    # INSERT OR REPLACE должен запускать DELETE-триггеры агрегатов (user_rating_stats)
+    await conn.execute("PRAGMA recursive_triggers = ON")
+    if not is_writer:
+        # Запись через читателя обошла бы блокировку писателя: пусть падает с ошибкой
+        await conn.execute("PRAGMA query_only = ON")
+
+
+class ConnectionPool:
+    """
+    Пул соединений aiosqlite на всё время жизни процесса:
+    фиксированное число читателей и одно выделенное соединение для записи.
+    """
+
+    def __init__(self, db_path: str, readers: int = POOL_READERS):
+        self.db_path = db_path
+        self.size = max(1, readers)
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._reader_conns = []
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._closed = False
+        self._stats = {
+            "reader_acquired": 0,
+            "writer_acquired": 0,
+            "timeouts": 0,
+            "wait_total_ms": 0.0,
+            "wait_max_ms": 0.0,
+        }
+
+    async def _connect(self, is_writer: bool = False) -> aiosqlite.Connection:
+        # У каждого соединения свой поток aiosqlite: процесс завершится только после close_pools()
+        conn = await aiosqlite.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+        try:
+            await bootstrap_connection(conn, is_writer)
+        except Exception:
+            await conn.close()
+            raise
+        return conn
+
+    async def open(self):
+        """Открывает соединения (повторный вызов ничего не делает)."""
+        if self._writer is not None:
+            return
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            if self._closed:
+                raise RuntimeError(f"Пул {self.db_path} уже закрыт")
+            # Соединение записи открываем первым: оно переводит файл в WAL
+            writer = await self._connect(is_writer=True)
+            for _ in range(self.size):
+                conn = await self._connect()
+                self._reader_conns.append(conn)
+                self._readers.put_nowait(conn)
+            self._writer = writer
+            logging.info(f"✅ Пул соединений открыт: {self.db_path} (читателей: {self.size})")
+
+    async def close(self):
+        """Закрывает все соединения пула."""
+        self._closed = True
+        conns = list(self._reader_conns)
+        if self._writer is not None:
+            conns.append(self._writer)
+        self._reader_conns.clear()
+        self._writer = None
+        for conn in conns:
+            try:
+                await conn.close()
+            except Exception as e:
+                logging.warning(f"⚠️ Ошибка закрытия соединения {self.db_path}: {e}")
+
+    def _record_wait(self, started: float):
+        waited = (time.perf_counter() - started) * 1000
+        self._stats["wait_total_ms"] += waited
+        if waited > self._stats["wait_max_ms"]:
+            self._stats["wait_max_ms"] = waited
+
+    async def acquire_reader(self, timeout: Optional[float] = None) -> aiosqlite.Connection:
+        await self.open()
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(self._readers.get(), timeout or POOL_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise TimeoutError(f"Нет свободного соединения для чтения: {self.db_path}")
+        self._record_wait(started)
+        self._stats["reader_acquired"] += 1
+        return conn
+
+    async def release_reader(self, conn: aiosqlite.Connection):
+        if self._closed:
+            await conn.close()
+            return
+        if conn.in_transaction:
+            await conn.rollback()
+        self._readers.put_nowait(conn)
+
+    async def acquire_writer(self, timeout: Optional[float] = None) -> aiosqlite.Connection:
+        await self.open()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._writer_lock.acquire(), timeout or POOL_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise TimeoutError(f"Соединение для записи занято: {self.db_path}")
+        self._record_wait(started)
+        self._stats["writer_acquired"] += 1
+        return self._writer
+
+    async def release_writer(self, conn: aiosqlite.Connection):
+        try:
+            # Незакоммиченная транзакция не должна достаться следующему владельцу
+            if not self._closed and conn.in_transaction:
+                await conn.rollback()
+        finally:
+            self._writer_lock.release()
+
+    @asynccontextmanager
+    async def reader(self, timeout: Optional[float] = None):
+        conn = await self.acquire_reader(timeout)
+        try:
+            yield conn
+        finally:
+            await self.release_reader(conn)
+
+    @asynccontextmanager
+    async def writer(self, timeout: Optional[float] = None):
+        conn = await self.acquire_writer(timeout)
+        try:
+            yield conn
+        finally:
+            await self.release_writer(conn)
+
+    def metrics(self) -> dict:
+        acquired = self._stats["reader_acquired"] + self._stats["writer_acquired"]
+        return {
+            "db_path": self.db_path,
+            "readers_total": self.size,
+            "readers_idle": self._readers.qsize(),
+            "readers_in_use": len(self._reader_conns) - self._readers.qsize(),
+            "writer_busy": self._writer_lock.locked(),
+            "reader_acquired": self._stats["reader_acquired"],
+            "writer_acquired": self._stats["writer_acquired"],
+            "timeouts": self._stats["timeouts"],
+            "wait_avg_ms": round(self._stats["wait_total_ms"] / acquired, 3) if acquired else 0.0,
+            "wait_max_ms": round(self._stats["wait_max_ms"], 3),
+        }
+
+
+_POOLS = {}  # абсолютный путь к БД → ConnectionPool
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """Возвращает общий пул для файла БД (создаётся при первом обращении)."""
+    key = os.path.abspath(db_path)
+    pool = _POOLS.get(key)
+    if pool is None:
+        pool = _POOLS[key] = ConnectionPool(key)
+    return pool
+
+
+def reader(db_path: str, timeout: Optional[float] = None):
+    """Соединение для чтения: `async with reader(DB_PATH) as db:`."""
+    return get_pool(db_path).reader(timeout)
+
+
+def writer(db_path: str, timeout: Optional[float] = None):
+    """Единственное соединение для записи: `async with writer(DB_PATH) as db:`."""
+    return get_pool(db_path).writer(timeout)
+
+
+def pool_metrics() -> list:
+    return [pool.metrics() for pool in _POOLS.values()]
+
+
+async def close_pools():
+    """Закрывает все пулы процесса (вызывать при остановке)."""
+    pools = list(_POOLS.values())
+    _POOLS.clear()
+    for pool in pools:
+        await pool.close()
@@ -0,0 +1,331 @@
+# dispatch.py
+
+import asyncio
+import heapq
+import logging
+import math
+import os
+import time
+from typing import Optional
+
+import scheduler
+from database import (
+    save_driver_locations, get_driver_locations, get_order_dispatch_state, get_order_deadline, get_setting
+)
+
+logger = logging.getLogger(__name__)
+
+# === Настройки ===
+# Рассылать заказ волнами, пока нет заявок (0 — всем водителям сразу, как раньше)
+DISPATCH_WAVES = os.getenv("DISPATCH_WAVES", "1") == "1"
+# Учитывать расстояние до точки подачи при выборе водителей
+GEO_DISPATCH = os.getenv("GEO_DISPATCH", "1") == "1"
+# Радиусы колец, км: сначала ближайшие, затем шире; дальше последнего кольца заказ не уходит
+DISPATCH_RINGS_KM = [float(r) for r in os.getenv("DISPATCH_RINGS_KM", "2,5,10,25").split(",") if r.strip()]
+# Водителей в одной волне (DISPATCH_RING_SIZE читается как значение по умолчанию)
+DISPATCH_WAVE_SIZE = int(os.getenv("DISPATCH_WAVE_SIZE", os.getenv("DISPATCH_RING_SIZE", "30")))
+# Сколько ждать заявок перед следующей волной, секунд (DISPATCH_RING_INTERVAL — значение по умолчанию)
+DISPATCH_BID_WINDOW = float(os.getenv("DISPATCH_BID_WINDOW", os.getenv("DISPATCH_RING_INTERVAL", "15")))
+# До какого окна сокращать DISPATCH_BID_WINDOW, чтобы все волны ушли до автоотмены; дальше растут волны, секунд
+DISPATCH_MIN_BID_WINDOW = float(os.getenv("DISPATCH_MIN_BID_WINDOW", "5"))
+# Столько заявок достаточно, чтобы не звать следующие волны (при auto_accept_on_first_bid — всегда 1)
+DISPATCH_TARGET_BIDS = int(os.getenv("DISPATCH_TARGET_BIDS", "1"))
+# После колец отправить водителям без известной геопозиции
+DISPATCH_SEND_UNLOCATED = os.getenv("DISPATCH_SEND_UNLOCATED", "1") == "1"
+# Геопозиция старше этого не используется, секунд
+DRIVER_LOCATION_TTL = float(os.getenv("DRIVER_LOCATION_TTL", "1800"))
+# Размер ячейки сетки, км
+GEO_CELL_KM = float(os.getenv("GEO_CELL_KM", "1.0"))
+# Как часто сбрасывать позиции в БД и подхватывать чужие (бот), секунд
+DRIVER_LOCATION_SYNC_INTERVAL = float(os.getenv("DRIVER_LOCATION_SYNC_INTERVAL", "5"))
+
+# Срок в scheduler: очередная волна рассылки заказа, параметр — сколько водителей уже уведомлено
+DISPATCH_DEADLINE = "dispatch_wave"
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Расстояние по поверхности Земли (гаверсинус), км."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoGrid:
+    """
+    Пространственный индекс в памяти: ячейки примерно cell_km × cell_km.
+    Строка ячейки — полоса широты, ширина столбца в градусах долготы
+    подбирается по широте полосы, поэтому ячейки почти квадратные и на севере.
+    """
+
+    def __init__(self, cell_km: float = GEO_CELL_KM):
+        self.cell_km = cell_km
+        self._cells = {}      # (строка, столбец) → set(driver_id)
+        self._positions = {}  # driver_id → (lat, lon, updated_at, ячейка)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _row(self, lat: float) -> int:
+        return math.floor(lat * KM_PER_DEGREE / self.cell_km)
+
+    def _col_scale(self, row: int) -> float:
+        # км на градус долготы в середине полосы
+        center_lat = (row + 0.5) * self.cell_km / KM_PER_DEGREE
+        return max(KM_PER_DEGREE * math.cos(math.radians(center_lat)), 1e-6)
+
+    def _cell(self, lat: float, lon: float) -> tuple:
+        row = self._row(lat)
+        return row, math.floor(lon * self._col_scale(row) / self.cell_km)
+
+    def update(self, driver_id: int, lat: float, lon: float, updated_at: Optional[float] = None):
+        cell = self._cell(lat, lon)
+        previous = self._positions.get(driver_id)
+        if previous is not None and previous[3] != cell:
+            self._discard(driver_id, previous[3])
+        self._cells.setdefault(cell, set()).add(driver_id)
+        self._positions[driver_id] = (lat, lon, updated_at or time.time(), cell)
+
+    def remove(self, driver_id: int):
+        previous = self._positions.pop(driver_id, None)
+        if previous is not None:
+            self._discard(driver_id, previous[3])
+
+    def _discard(self, driver_id: int, cell: tuple):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self._cells[cell]
+
+    def position(self, driver_id: int) -> Optional[tuple]:
+        """(lat, lon, updated_at) или None."""
+        entry = self._positions.get(driver_id)
+        return entry[:3] if entry else None
+
+    def nearest(self, lat: float, lon: float, radius_km: float, k: Optional[int] = None,
+                allowed=None, exclude=(), max_age: Optional[float] = DRIVER_LOCATION_TTL) -> list:
+        """
+        До k ближайших водителей в радиусе radius_km: [(расстояние, driver_id)] по возрастанию.
+        allowed — множество допустимых driver_id (например, на смене), exclude — уже уведомлённые.
+        """
+        min_updated = time.time() - max_age if max_age else 0
+        max_ring = math.ceil(radius_km / self.cell_km)
+        center_row = self._row(lat)
+        found = []
+        # Обход кольцами ячеек от центра: ближайшие k обычно находятся за 2–3 кольца
+        for ring in range(max_ring + 1):
+            for row in range(center_row - ring, center_row + ring + 1):
+                center_col = math.floor(lon * self._col_scale(row) / self.cell_km)
+                # +1: ширина ячейки на краю полосы немного отличается от середины
+                cols = ring + 1
+                inner = abs(row - center_row) < ring
+                for col in range(center_col - cols, center_col + cols + 1):
+                    if inner and abs(col - center_col) < cols:
+                        continue  # ячейка уже просмотрена в предыдущем кольце
+                    members = self._cells.get((row, col))
+                    if not members:
+                        continue
+                    for driver_id in members:
+                        if driver_id in exclude or (allowed is not None and driver_id not in allowed):
+                            continue
+                        d_lat, d_lon, updated_at, _ = self._positions[driver_id]
+                        if updated_at < min_updated:
+                            continue
+                        distance = distance_km(lat, lon, d_lat, d_lon)
+                        if distance <= radius_km:
+                            found.append((distance, driver_id))
+            # Все непросмотренные ячейки не ближе ring × cell_km: дальше искать незачем
+            if k is not None and len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= ring * self.cell_km:
+                break
+        if k is None:
+            return sorted(found)
+        return heapq.nsmallest(k, found)
+
+
+DRIVER_INDEX = GeoGrid()
+_DIRTY = {}  # driver_id → (lat, lon, updated_at), ещё не записано в БД
+_SYNC_TASK: Optional[asyncio.Task] = None
+_LAST_SYNC = 0.0
+
+
+def update_driver_location(driver_id: int, lat: float, lon: float):
+    """Обновляет позицию водителя в индексе сразу, в БД — пачкой из фонового цикла."""
+    now = time.time()
+    DRIVER_INDEX.update(driver_id, lat, lon, now)
+    _DIRTY[driver_id] = (lat, lon, now)
+
+
+async def sync_driver_locations():
+    """Сбрасывает накопленные позиции в БД и подхватывает записанные другими процессами."""
+    global _LAST_SYNC
+    if _DIRTY:
+        pending = dict(_DIRTY)
+        await save_driver_locations([(driver_id, lat, lon, ts) for driver_id, (lat, lon, ts) in pending.items()])
+        # Снимаем только записанное: при ошибке пачка повторится, а позиции,
+        # пришедшие во время записи, уйдут следующим циклом
+        for driver_id, position in pending.items():
+            if _DIRTY.get(driver_id) == position:
+                del _DIRTY[driver_id]
+    now = time.time()
+    # С перекрытием: запись другого процесса могла закоммититься позже своей метки времени
+    since = _LAST_SYNC - DRIVER_LOCATION_SYNC_INTERVAL if _LAST_SYNC else now - DRIVER_LOCATION_TTL
+    _LAST_SYNC = now
+    for driver_id, lat, lon, updated_at in await get_driver_locations(since):
+        current = DRIVER_INDEX.position(driver_id)
+        if current is None or current[2] < updated_at:
+            DRIVER_INDEX.update(driver_id, lat, lon, updated_at)
+
+
+async def _sync_loop():
+    while True:
+        await asyncio.sleep(DRIVER_LOCATION_SYNC_INTERVAL)
+        try:
+            await sync_driver_locations()
+        except Exception as e:
+            logger.error(f"❌ Ошибка синхронизации геопозиций водителей: {e}")
+
+
+async def start_dispatch():
+    """Загружает свежие позиции водителей и запускает фоновую синхронизацию."""
+    global _SYNC_TASK
+    await sync_driver_locations()
+    logger.info(f"📍 Индекс геопозиций: {len(DRIVER_INDEX)} водителей")
+    _SYNC_TASK = asyncio.create_task(_sync_loop())
+
+
+async def stop_dispatch():
+    global _SYNC_TASK
+    if _SYNC_TASK is not None:
+        _SYNC_TASK.cancel()
+        await asyncio.gather(_SYNC_TASK, return_exceptions=True)
+        _SYNC_TASK = None
+    if _DIRTY:
+        await sync_driver_locations()
+
+
+def rank_drivers(candidates: list, lat: Optional[float] = None, lon: Optional[float] = None) -> list:
+    """
+    Порядок рассылки для [(driver_id, рейтинг, занят)]: сначала свободные водители,
+    затем ближнее кольцо DISPATCH_RINGS_KM, внутри кольца — выше рейтинг, затем ближе.
+    Водители без свежей геопозиции идут после всех колец (если DISPATCH_SEND_UNLOCATED),
+    с позицией дальше последнего кольца — не получают заказ.
+    Без координат подачи (или GEO_DISPATCH=0) — только занятость и рейтинг.
+    """
+    if not GEO_DISPATCH or lat is None or lon is None or not DISPATCH_RINGS_KM:
+        return [driver_id for _, driver_id in sorted(
+            ((busy, -rating), driver_id) for driver_id, rating, busy in candidates
+        )]
+
+    eligible = {driver_id for driver_id, _, _ in candidates}
+    # Расстояния для всех водителей в радиусе — один проход по сетке
+    distances = {driver_id: distance for distance, driver_id in
+                 DRIVER_INDEX.nearest(lat, lon, DISPATCH_RINGS_KM[-1], allowed=eligible)}
+    min_updated = time.time() - DRIVER_LOCATION_TTL
+    unlocated_band = len(DISPATCH_RINGS_KM)
+    ranked = []
+    for driver_id, rating, busy in candidates:
+        distance = distances.get(driver_id)
+        if distance is not None:
+            band = next(i for i, radius_km in enumerate(DISPATCH_RINGS_KM) if distance <= radius_km)
+        else:
+            position = DRIVER_INDEX.position(driver_id)
+            if not DISPATCH_SEND_UNLOCATED or (position is not None and position[2] >= min_updated):
+                continue  # далеко от точки подачи
+            band, distance = unlocated_band, math.inf
+        ranked.append(((busy, band, -rating, distance), driver_id))
+    ranked.sort()
+    return [driver_id for _, driver_id in ranked]
+
+
+DISPATCH_METRICS = {
+    "orders": 0,
+    "waves": 0,
+    "offers": 0,
+    "stopped_on_bid": 0,
+    "stopped_closed": 0,
+    "all_waves_sent": 0,
+    "last_first_bid_sec": None,
+}
+# Заказы со следующей волной в scheduler: order_id → (начало рассылки, срок волны), time.monotonic().
+# Только для метрик: срок, снятый принятием или отменой заказа, забывается после наступления
+_ACTIVE = {}
+
+
+def plan_waves(remaining: int, time_budget: Optional[float]) -> tuple:
+    """
+    (водителей в волне, окно ожидания заявок) для remaining ещё не уведомлённых водителей.
+    После каждой волны, включая последнюю, до автоотмены должно остаться целое окно
+    (time_budget секунд до неё; None — автоотмены нет): окно сокращается до DISPATCH_MIN_BID_WINDOW,
+    дальше увеличивается волна.
+    """
+    wave_size = max(1, DISPATCH_WAVE_SIZE)
+    window = DISPATCH_BID_WINDOW
+    if time_budget is None or remaining <= wave_size:
+        return wave_size, window
+    waves = math.ceil(remaining / wave_size)
+    if waves * window > time_budget:
+        window = max(min(DISPATCH_MIN_BID_WINDOW, window), time_budget / waves)
+        wave_size = max(wave_size, math.ceil(remaining / max(1, int(time_budget // window))))
+    return wave_size, window
+
+
+async def next_wave_needed(order_id: int) -> bool:
+    """Наступил срок следующей волны: нужна ли она (заказ ждёт водителя и заявок пока мало)."""
+    started = _ACTIVE.get(order_id, (None,))[0]
+    auto_accept = await get_setting("auto_accept_on_first_bid", "0") == "1"
+    target_bids = 1 if auto_accept else max(1, DISPATCH_TARGET_BIDS)
+    state = await get_order_dispatch_state(order_id)
+    if not state or state[0] != "pending":
+        _ACTIVE.pop(order_id, None)
+        DISPATCH_METRICS["stopped_closed"] += 1
+        logger.info(f"📍 Заказ {order_id}: рассылка остановлена — заказ больше не ждёт водителя")
+        return False
+    if state[1] >= target_bids:
+        _ACTIVE.pop(order_id, None)
+        DISPATCH_METRICS["stopped_on_bid"] += 1
+        if started is not None:
+            DISPATCH_METRICS["last_first_bid_sec"] = round(time.monotonic() - started, 1)
+        logger.info(f"📍 Заказ {order_id}: рассылка остановлена — есть заявки ({state[1]})")
+        return False
+    return True
+
+
+async def dispatch_wave(order_id: int, ranked: list, send, offset: int = 0) -> int:
+    """
+    Рассылает очередную волну заказа: send() получает первых offset + размер волны водителей
+    из ranked (порядок пересчитывается на каждой волне; уже уведомлённых отсекает dedup_key outbox).
+    Следующая волна назначается сроком DISPATCH_DEADLINE в scheduler, поэтому переживает перезапуск;
+    перед ней next_wave_needed() проверяет заявки и статус заказа.
+    Возвращает число новых предложений.
+    """
+    if not offset:
+        DISPATCH_METRICS["orders"] += 1
+    cancel_at = await get_order_deadline(order_id, scheduler.AUTO_CANCEL)
+    time_budget = max(0.0, cancel_at - time.time()) if cancel_at is not None else None
+    wave_size, window = plan_waves(max(0, len(ranked) - offset), time_budget)
+    sent_to = min(len(ranked), offset + wave_size)
+    added = await send(ranked[:sent_to]) if sent_to > offset else 0
+    DISPATCH_METRICS["waves"] += 1
+    DISPATCH_METRICS["offers"] += added
+    logger.info(f"📍 Заказ {order_id}: волна до {sent_to}-го водителя из {len(ranked)} — {added} новых предложений")
+
+    if sent_to >= len(ranked):
+        _ACTIVE.pop(order_id, None)
+        DISPATCH_METRICS["all_waves_sent"] += 1
+        return added
+    await scheduler.schedule(order_id, DISPATCH_DEADLINE, window, sent_to)
+    started = _ACTIVE.get(order_id, (time.monotonic(),))[0]
+    _ACTIVE[order_id] = (started, time.monotonic() + window)
+    return added
+
+
+def dispatch_metrics() -> dict:
+    now = time.monotonic()
+    for order_id in [order_id for order_id, (_, due) in _ACTIVE.items() if due < now - 1]:
+        del _ACTIVE[order_id]
+    return {**DISPATCH_METRICS, "in_progress": len(_ACTIVE)}
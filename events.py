@@ -0,0 +1,281 @@
+# events.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from database import get_orders_event_state
+
+logger = logging.getLogger(__name__)
+
+# === Настройки ===
+# Как часто проверять изменения, сделанные ботом (заявки, «прибыл»), секунд.
+# Одна выборка на все заказы, за которыми следят клиенты
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "1.0"))
+# Пустой комментарий в поток, чтобы прокси не закрывали соединение, секунд
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", "15"))
+# Необработанных событий на одного подписчика
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+# Сколько следить за заказом после последнего запроса с опросом (ETag, long-poll), секунд
+EVENTS_LEASE_TTL = float(os.getenv("EVENTS_LEASE_TTL", "60"))
+
+# События, после которых поток закрывается
+TERMINAL_EVENTS = {"cancelled", "completed"}
+STATE_FIELDS = ("status", "driver_id", "driver_arrived", "bids", "version")
+
+
+class OrderEventHub:
+    """
+    Подписки на события заказов внутри процесса.
+    Для каждого наблюдаемого заказа хранится последнее состояние; событие рассылается
+    только при его изменении, поэтому запись из webapp и опрос БД не дублируют друг друга.
+    Наблюдаемый заказ — с подписчиком SSE или с арендой (lease) от опроса по ETag/long-poll.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # order_id → set(asyncio.Queue)
+        self._state = {}        # order_id → dict(STATE_FIELDS)
+        self._early = {}        # order_id → изменения из webapp до первого чтения состояния
+        self._leases = {}       # order_id → time.monotonic(), до которого следить без подписчиков
+        self._waiters = {}      # order_id → asyncio.Event, срабатывает при любом изменении
+        # order_id → версия, известная до записи из webapp: чтения с такой или меньшей версией
+        # начались до этой записи и не должны перезаписать её результат
+        self._outdated = {}
+        self.metrics = {"published": 0, "dropped": 0}
+
+    def subscribe(self, order_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self._subscribers.setdefault(order_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, order_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(order_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[order_id]
+            if order_id not in self._leases:
+                self._forget(order_id)
+
+    def lease(self, order_id: int):
+        """Следить за заказом EVENTS_LEASE_TTL секунд: его версия будет известна без запроса к БД."""
+        self._leases[order_id] = time.monotonic() + EVENTS_LEASE_TTL
+
+    def expire_leases(self):
+        now = time.monotonic()
+        for order_id in [order_id for order_id, until in self._leases.items() if until < now]:
+            del self._leases[order_id]
+            self._waiters.pop(order_id, None)
+            if order_id not in self._subscribers:
+                self._forget(order_id)
+
+    def _forget(self, order_id: int):
+        self._state.pop(order_id, None)
+        self._early.pop(order_id, None)
+        self._outdated.pop(order_id, None)
+
+    def _stale(self, order_id: int, previous: dict, version: Optional[int]) -> bool:
+        """Строка из БД старше известного состояния (чтение началось до последней записи)."""
+        if version is None:
+            return False
+        if previous["version"] is not None and version < previous["version"]:
+            return True
+        outdated = self._outdated.get(order_id)
+        if outdated is not None:
+            if version <= outdated:
+                return True
+            del self._outdated[order_id]
+        return False
+
+    def _watching(self, order_id: int) -> bool:
+        return order_id in self._subscribers or order_id in self._leases
+
+    def watched(self) -> list:
+        return list(self._subscribers.keys() | self._leases.keys())
+
+    def version(self, order_id: int) -> Optional[int]:
+        """Последняя известная версия наблюдаемого заказа или None (нужно читать БД)."""
+        state = self._state.get(order_id)
+        return state["version"] if state else None
+
+    async def wait_changed(self, order_id: int, timeout: float) -> bool:
+        """Ждёт любого изменения заказа до timeout секунд. True — изменение было."""
+        # Событие убирается при изменении заказа или вместе с арендой
+        waiter = self._waiters.setdefault(order_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def subscriber_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def state(self, order_id: int) -> Optional[dict]:
+        state = self._state.get(order_id)
+        return dict(state) if state else None
+
+    def publish(self, order_id: int, event: str, data: dict):
+        queues = self._subscribers.get(order_id)
+        if not queues:
+            return
+        self.metrics["published"] += 1
+        for queue in queues:
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                self.metrics["dropped"] += 1
+
+    def observe(self, order_id: int, **changes):
+        """
+        Новое состояние заказа (все или часть STATE_FIELDS). Первое наблюдение только запоминается,
+        дальше каждое изменение превращается в событие: bid_created, accepted, driver_arrived,
+        cancelled, completed. Данные события — полное текущее состояние заказа.
+        """
+        if not self._watching(order_id):
+            return
+        previous = self._state.get(order_id)
+        if previous is None:
+            self._state[order_id] = {field: changes.get(field) for field in STATE_FIELDS}
+            early = self._early.pop(order_id, None)
+            if early:
+                # Запись из webapp успела раньше первого чтения: событие, если чтение её не увидело
+                self.observe(order_id, **early)
+            return
+        if self._stale(order_id, previous, changes.get("version")):
+            return
+        current = {**previous, **{k: v for k, v in changes.items() if k in STATE_FIELDS}}
+        if current == previous:
+            return
+        self._state[order_id] = current
+        waiter = self._waiters.pop(order_id, None)
+        if waiter is not None:
+            waiter.set()
+
+        events = []
+        if (current["bids"] or 0) > (previous["bids"] or 0):
+            events.append("bid_created")
+        if current["status"] != previous["status"] and current["status"] == "accepted":
+            events.append("accepted")
+        if current["driver_arrived"] and not previous["driver_arrived"]:
+            events.append("driver_arrived")
+        if current["status"] != previous["status"] and current["status"] in TERMINAL_EVENTS:
+            events.append(current["status"])
+        for event in events:
+            self.publish(order_id, event, dict(current))
+
+    def order_changed(self, order_id: int, **changes):
+        """Запись из webapp: событие уходит сразу, не дожидаясь опроса БД."""
+        # Новую версию знает только БД: до следующего чтения условные запросы идут в БД.
+        # version=None — «неизвестна, новее известной»
+        changes.setdefault("version", None)
+        if self._watching(order_id) and order_id not in self._state:
+            # Подписчик есть, но состояние ещё читается из БД: применим после чтения
+            self._early.setdefault(order_id, {}).update(changes)
+            return
+        previous = self._state.get(order_id)
+        if previous is not None and all(previous[k] == v for k, v in changes.items() if k != "version"):
+            return  # опрос уже увидел эту запись вместе с её версией
+        if previous is not None and previous["version"] is not None:
+            # Опрос, начатый до этой записи, вернёт эту версию или меньше: такие строки отбрасываются
+            self._outdated[order_id] = previous["version"]
+        self.observe(order_id, **changes)
+
+
+HUB = OrderEventHub()
+_TASK: Optional[asyncio.Task] = None
+_LAST_POLL_MS = 0.0
+
+
+def state_from_row(row: tuple) -> dict:
+    """(статус, driver_id, driver_arrived, заявки, версия) из get_orders_event_state → dict для observe()."""
+    status, driver_id, driver_arrived, bids, version = row
+    return {
+        "status": status, "driver_id": driver_id, "driver_arrived": bool(driver_arrived),
+        "bids": bids, "version": version,
+    }
+
+
+async def poll_once():
+    """Одна выборка по всем наблюдаемым заказам: изменения из бота превращаются в события."""
+    global _LAST_POLL_MS
+    HUB.expire_leases()
+    order_ids = HUB.watched()
+    if not order_ids:
+        return
+    started = time.perf_counter()
+    states = await get_orders_event_state(order_ids)
+    _LAST_POLL_MS = round((time.perf_counter() - started) * 1000, 2)
+    for order_id, row in states.items():
+        HUB.observe(order_id, **state_from_row(row))
+
+
+async def _poll_loop():
+    while True:
+        await asyncio.sleep(EVENTS_POLL_INTERVAL)
+        try:
+            await poll_once()
+        except Exception as e:
+            logger.error(f"❌ Ошибка опроса событий заказов: {e}")
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def order_event_stream(order_id: int):
+    """
+    Поток SSE по заказу. Подписка оформляется до чтения начального состояния,
+    чтобы не потерять событие между ними. Первое событие — snapshot с текущим состоянием.
+    """
+    queue = HUB.subscribe(order_id)
+    try:
+        row = (await get_orders_event_state([order_id])).get(order_id)
+        if row is None:
+            return
+        HUB.observe(order_id, **state_from_row(row))
+        snapshot = HUB.state(order_id)
+        # События, уже учтённые в snapshot, не повторяем
+        while not queue.empty():
+            queue.get_nowait()
+        yield format_sse("snapshot", snapshot)
+        if snapshot["status"] in TERMINAL_EVENTS:
+            return
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            yield format_sse(event, data)
+            if event in TERMINAL_EVENTS:
+                return
+    finally:
+        HUB.unsubscribe(order_id, queue)
+
+
+async def start_events():
+    global _TASK
+    _TASK = asyncio.create_task(_poll_loop())
+
+
+async def stop_events():
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        await asyncio.gather(_TASK, return_exceptions=True)
+        _TASK = None
+
+
+def events_metrics() -> dict:
+    return {
+        "watched_orders": len(HUB.watched()),
+        "leased_orders": len(HUB._leases),
+        "subscribers": HUB.subscriber_count(),
+        "last_poll_ms": _LAST_POLL_MS,
+        **HUB.metrics,
+    }
@@ -2019,6 +2019,7 @@
     const cancelSearchBtn = document.getElementById('cancelSearchBtn');
     
     let driverTimerInterval = null;
+    let driverBidEvents = null;
     let timeLeft = 120;
     let startMarker, endMarker;
     let activeAddressInput = null;
@@ -3084,11 +3085,21 @@ function confirmMarkerSelection() {
         
         if (timeLeft <= 0) {
           clearInterval(searchTimer);
+          stopSearchBidEvents();
           closeSearchDriverModal();
           showCancelScreen();
         }
       }, 1000);
       
+      // Первый отклик приходит событием bid_created (SSE); без EventSource — опрос каждые 2 секунды
+      let searchBidEvents = null;
+      const stopSearchBidEvents = () => {
+        if (searchBidEvents) {
+          searchBidEvents.close();
+          searchBidEvents = null;
+        }
+      };
+      
       // Изменяем обработчик кнопки отмены
       cancelSearchBtn.onclick = () => {
         // Создаем модальное окно подтверждения
@@ -3134,6 +3145,7 @@ function confirmMarkerSelection() {
         confirmModal.querySelector('.confirm-btn').addEventListener('click', () => {
           document.body.removeChild(confirmModal);
           clearInterval(searchTimer);
+          stopSearchBidEvents();
           closeSearchDriverModal();
           cancelOrder(orderId);
         });
@@ -3150,6 +3162,7 @@ function confirmMarkerSelection() {
           if (data.success && data.bids?.length > 0 && !hasReceivedFirstBid) {
             hasReceivedFirstBid = true;
             clearInterval(searchTimer);
+            stopSearchBidEvents();
             
             // Закрываем окно поиска и открываем окно выбора водителей
             closeSearchDriverModal();
@@ -3158,7 +3171,7 @@ function confirmMarkerSelection() {
             setTimeout(() => {
               showDriverModalForWeb(orderId, orderData);
             }, 300);
-          } else {
+          } else if (!searchBidEvents) {
             setTimeout(pollBidsForSearch, 2000);
           }
         } catch (e) {
@@ -3167,6 +3180,30 @@ function confirmMarkerSelection() {
         }
       };
       
+      if (window.EventSource) {
+        searchBidEvents = new EventSource(`${API_BASE_URL}/api/web/order/${orderId}/events`);
+        searchBidEvents.addEventListener('bid_created', () => pollBidsForSearch());
+        searchBidEvents.addEventListener('snapshot', (e) => {
+          const state = JSON.parse(e.data);
+          if (state.status === 'cancelled' || state.status === 'completed') {
+            searchBidEvents.close();
+          } else if (state.bids) {
+            // После переподключения: отклик мог прийти, пока потока не было
+            pollBidsForSearch();
+          }
+        });
+        // После отмены или завершения сервер закрывает поток; close() не даёт браузеру
+        // переподключаться каждые несколько секунд (ссылка остаётся — опрос не включается)
+        searchBidEvents.addEventListener('cancelled', () => searchBidEvents.close());
+        searchBidEvents.addEventListener('completed', () => searchBidEvents.close());
+        searchBidEvents.onerror = () => {
+          if (searchBidEvents && searchBidEvents.readyState === EventSource.CLOSED) {
+            searchBidEvents = null;
+            pollBidsForSearch();
+          }
+        };
+      }
+      
       pollBidsForSearch();
     }
     
@@ -3183,6 +3220,11 @@ function confirmMarkerSelection() {
       if (!isDriverModalOpen) return;
       isDriverModalOpen = false;
       
+      if (driverBidEvents) {
+        driverBidEvents.close();
+        driverBidEvents = null;
+      }
+      
       driverModal.classList.remove('active');
       document.body.style.overflow = 'auto';
       
@@ -3268,8 +3310,8 @@ function confirmMarkerSelection() {
             renderDriverBids(data.bids, orderId, orderData);
           }
           
-          // Продолжаем опрашивать пока окно открыто
-          if (isDriverModalOpen) {
+          // Без потока событий продолжаем опрашивать пока окно открыто
+          if (isDriverModalOpen && !driverBidEvents) {
             setTimeout(pollBids, 2000);
           }
         } catch (e) {
@@ -3281,6 +3323,32 @@ function confirmMarkerSelection() {
         }
       };
       
+      // Новые отклики приходят событием bid_created (SSE)
+      if (window.EventSource) {
+        if (driverBidEvents) driverBidEvents.close();
+        driverBidEvents = new EventSource(`${API_BASE_URL}/api/web/order/${orderId}/events`);
+        driverBidEvents.addEventListener('bid_created', () => pollBids());
+        driverBidEvents.addEventListener('snapshot', (e) => {
+          const state = JSON.parse(e.data);
+          if (state.status === 'cancelled' || state.status === 'completed') {
+            driverBidEvents.close();
+          } else if (state.bids) {
+            // После переподключения: отклики могли прийти, пока потока не было
+            pollBids();
+          }
+        });
+        // После отмены или завершения сервер закрывает поток; close() не даёт браузеру
+        // переподключаться каждые несколько секунд (ссылка остаётся — опрос не включается)
+        driverBidEvents.addEventListener('cancelled', () => driverBidEvents.close());
+        driverBidEvents.addEventListener('completed', () => driverBidEvents.close());
+        driverBidEvents.onerror = () => {
+          if (driverBidEvents && driverBidEvents.readyState === EventSource.CLOSED) {
+            driverBidEvents = null;
+            pollBids();
+          }
+        };
+      }
+      
       pollBids();
     }
     
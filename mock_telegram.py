@@ -0,0 +1,193 @@
+# mock_telegram.py
+"""
+Локальная заглушка Telegram Bot API для нагрузочных и интеграционных тестов.
+
+    python mock_telegram.py --port 8081 --latency-ms 40 --rate-429 0.01 --error-rate 0.005
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 python webapp.py
+
+Статистика вызовов: GET /stats, сброс: POST /reset.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class MockTelegram:
+    """Состояние заглушки: сообщения по чатам, счётчики и параметры сбоев."""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, rate_429: float = 0.0,
+                 retry_after: int = 1, error_rate: float = 0.0, global_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        # Больше global_rate запросов за последнюю секунду — 429, как у настоящего Telegram (0 — без лимита)
+        self.global_rate = global_rate
+        self.reset()
+
+    def reset(self):
+        self.messages = defaultdict(dict)  # chat_id → {message_id: text}
+        self.next_message_id = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.recent = deque()
+        self.started = time.monotonic()
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        total = sum(self.calls.values())
+        return {
+            "calls": dict(self.calls),
+            "errors": dict(self.errors),
+            "total": total,
+            "elapsed_sec": round(elapsed, 3),
+            "rate_per_sec": round(total / elapsed, 1) if elapsed else 0.0,
+            "chats": len(self.messages),
+            "live_messages": sum(len(chat) for chat in self.messages.values()),
+        }
+
+    def _too_fast(self) -> bool:
+        if not self.global_rate:
+            return False
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] > 1.0:
+            self.recent.popleft()
+        self.recent.append(now)
+        return len(self.recent) > self.global_rate
+
+    def _new_message(self, chat_id, text) -> dict:
+        self.next_message_id[chat_id] += 1
+        message_id = self.next_message_id[chat_id]
+        self.messages[chat_id][message_id] = text
+        return {"message_id": message_id, "chat": {"id": chat_id}, "date": int(time.time()), "text": text}
+
+    def handle(self, method: str, params: dict):
+        """Возвращает (HTTP-статус, тело ответа Bot API)."""
+        if self._too_fast() or random.random() < self.rate_429:
+            self.errors["429"] += 1
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        if random.random() < self.error_rate:
+            self.errors["500"] += 1
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+        self.calls[method] += 1
+        chat_id = _as_int(params.get("chat_id"))
+        message_id = _as_int(params.get("message_id"))
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Mock", "username": "mock_bot"}}
+        if method in ("sendMessage", "sendPhoto", "sendDocument"):
+            if chat_id is None:
+                return self._bad_request("chat_id is empty")
+            text = params.get("text") or params.get("caption") or ""
+            return 200, {"ok": True, "result": self._new_message(chat_id, text)}
+        if method == "deleteMessage":
+            if self.messages.get(chat_id, {}).pop(message_id, None) is None:
+                return self._bad_request("message to delete not found")
+            return 200, {"ok": True, "result": True}
+        if method in ("editMessageText", "editMessageReplyMarkup"):
+            chat = self.messages.get(chat_id, {})
+            if message_id not in chat:
+                return self._bad_request("message to edit not found")
+            if method == "editMessageText":
+                chat[message_id] = params.get("text", "")
+            return 200, {"ok": True, "result": {"message_id": message_id, "chat": {"id": chat_id}}}
+        if method == "answerCallbackQuery":
+            return 200, {"ok": True, "result": True}
+
+        self.calls[method] -= 1
+        self.errors["404"] += 1
+        return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+
+    def _bad_request(self, description: str):
+        self.errors["400"] += 1
+        return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {description}"}
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def _read_params(request: web.Request) -> dict:
+    if request.content_type == "application/json":
+        return await request.json()
+    # aiogram отправляет multipart/form-data или x-www-form-urlencoded
+    return dict(await request.post()) if request.body_exists else dict(request.query)
+
+
+def create_app(mock: MockTelegram) -> web.Application:
+    async def api_method(request: web.Request):
+        params = await _read_params(request)
+        delay = mock.latency_ms + random.uniform(0, mock.jitter_ms)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        status, body = mock.handle(request.match_info["method"], params)
+        return web.json_response(body, status=status, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+    async def stats(request: web.Request):
+        return web.json_response(mock.stats())
+
+    async def reset(request: web.Request):
+        mock.reset()
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app["mock"] = mock
+    app.router.add_route("*", "/bot{token}/{method}", api_method)
+    app.router.add_get("/stats", stats)
+    app.router.add_post("/reset", reset)
+    return app
+
+
+async def start_mock_server(mock: MockTelegram, host: str = "127.0.0.1", port: int = 8081) -> web.AppRunner:
+    """Запускает заглушку в текущем цикле событий (для бенчмарков); остановка — `await runner.cleanup()`."""
+    runner = web.AppRunner(create_app(mock), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка ответа, мс")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 (0..1)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500 (0..1)")
+    parser.add_argument("--global-rate", type=float, default=0.0, help="лимит запросов в секунду (0 — нет)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mock = MockTelegram(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_429=args.rate_429,
+        retry_after=args.retry_after,
+        error_rate=args.error_rate,
+        global_rate=args.global_rate,
+    )
+    logger.info(f"🧪 Заглушка Bot API: http://{args.host}:{args.port}")
+    web.run_app(create_app(mock), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
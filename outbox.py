@@ -0,0 +1,305 @@
+# outbox.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from database import outbox_enqueue, outbox_claim, outbox_finish, outbox_recover, outbox_cleanup, outbox_counts
+from telegram_api import call_api
+
+logger = logging.getLogger(__name__)
+
+# Предложение заказа водителю: ID доставленного сообщения сохраняется вместе с результатом отправки
+KIND_ORDER_OFFER = "order_offer"
+
+# === Приоритеты (меньше — раньше) ===
+PRIORITY_ORDER_OFFER = 0    # предложения заказа водителям
+PRIORITY_ORDER_UPDATE = 1   # уведомления участникам заказа
+PRIORITY_DEFAULT = 5
+PRIORITY_BROADCAST = 9      # массовые рассылки
+
+# === Настройки ===
+# Одновременных отправок (общий лимит Telegram соблюдает telegram_api, с учётом приоритета)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "20"))
+# Сколько попыток до окончательной ошибки
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Задержка повтора: base * 2^(попытка-1), но не больше max, секунд
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+# Как часто проверять очередь без сигнала (записи из другого процесса), секунд
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+# Сколько хранить отправленные сообщения (для дедупликации), часов
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "24"))
+# Аренда забранного сообщения: если процесс не отправил его за это время (упал, перезапущен),
+# сообщение возвращается в очередь. Должна быть больше времени ожидания в очереди и отправки, секунд
+OUTBOX_LEASE_SEC = float(os.getenv("OUTBOX_LEASE_SEC", "300"))
+# Результаты отправки копятся до этого времени и пишутся в БД одной транзакцией, секунд
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "0.2"))
+
+# Ошибки Bot API, которые повтором не исправить (чат не найден, бот заблокирован и т.п.)
+PERMANENT_ERRORS = {400, 403}
+
+_API_URL: Optional[str] = None
+_QUEUE: Optional[asyncio.Queue] = None
+_RESULTS: Optional[asyncio.Queue] = None
+_WAKEUP = asyncio.Event()
+_TASKS = []
+_FINISHER: Optional[asyncio.Task] = None
+_KINDS = {}  # kind → (before_send, after_send)
+OUTBOX_METRICS = {
+    "enqueued": 0,
+    "duplicates": 0,
+    "sent": 0,
+    "retried": 0,
+    "failed": 0,
+    "skipped": 0,
+    "last_latency_ms": 0.0,
+    "max_latency_ms": 0.0,
+}
+
+ROW_FIELDS = ("id", "kind", "order_id", "method", "chat_id", "payload", "attempts", "enqueued_at", "priority")
+
+
+def register_kind(kind: str, before_send=None, after_send=None):
+    """
+    Хуки для типа сообщений, вызываются на пачку (один запрос к БД на пачку, а не на сообщение):
+    before_send(messages) -> list[bool] — для каждого забранного сообщения; False отменяет
+    отправку (например, заказ уже принят);
+    after_send(delivered) — [(message, result)] доставленных, после записи результатов в БД.
+    """
+    _KINDS[kind] = (before_send, after_send)
+
+
+def message(chat_id: int, payload, *, method: str = "sendMessage", priority: int = PRIORITY_DEFAULT,
+            dedup_key: Optional[str] = None, kind: Optional[str] = None, order_id: Optional[int] = None) -> dict:
+    """Описание сообщения для enqueue_many(); payload — dict или готовое JSON-тело (str)."""
+    return {
+        "dedup_key": dedup_key,
+        "priority": priority,
+        "kind": kind,
+        "order_id": order_id,
+        "method": method,
+        "chat_id": chat_id,
+        "payload": payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False),
+    }
+
+
+async def enqueue_many(messages: list) -> int:
+    """Сохраняет сообщения в очередь одной транзакцией и будит воркеры. Возвращает число новых."""
+    if not messages:
+        return 0
+    added = await outbox_enqueue(messages)
+    OUTBOX_METRICS["enqueued"] += added
+    OUTBOX_METRICS["duplicates"] += len(messages) - added
+    if added:
+        _WAKEUP.set()
+    return added
+
+
+async def enqueue(chat_id: int, payload, **options) -> bool:
+    """Ставит одно сообщение в очередь. False — сообщение с таким dedup_key уже было."""
+    return await enqueue_many([message(chat_id, payload, **options)]) == 1
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** max(0, attempts - 1))
+
+
+async def _deliver(item: dict) -> tuple:
+    """Отправляет сообщение. Возвращает (message, status, next_attempt_at, last_error, result)."""
+    # Тело хранится готовым JSON и уходит в Telegram без повторной сериализации
+    data = await call_api(
+        _API_URL, item["method"], item["payload"], chat_id=item["chat_id"], priority=item["priority"]
+    )
+
+    if data and data.get("ok"):
+        latency = round((time.time() - item["enqueued_at"]) * 1000, 1)
+        OUTBOX_METRICS["sent"] += 1
+        OUTBOX_METRICS["last_latency_ms"] = latency
+        OUTBOX_METRICS["max_latency_ms"] = max(OUTBOX_METRICS["max_latency_ms"], latency)
+        return item, "sent", None, None, data.get("result")
+
+    error = "network error" if data is None else f"{data.get('error_code')}: {data.get('description')}"
+    permanent = data is not None and data.get("error_code") in PERMANENT_ERRORS
+    if permanent or item["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        logger.error(f"❌ Outbox {item['id']} ({item['method']} → {item['chat_id']}): не доставлено: {error}")
+        OUTBOX_METRICS["failed"] += 1
+        return item, "failed", None, error, None
+    delay = _retry_delay(item["attempts"])
+    logger.warning(f"⏳ Outbox {item['id']} ({item['chat_id']}): {error}, повтор через {delay:.1f} с")
+    OUTBOX_METRICS["retried"] += 1
+    return item, "pending", time.time() + delay, error, None
+
+
+async def _worker():
+    while True:
+        item = await _QUEUE.get()
+        try:
+            outcome = await _deliver(item)
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки из outbox ({item['id']}): {e}", exc_info=True)
+            outcome = (item, "pending", time.time() + _retry_delay(item["attempts"]), str(e), None)
+        _RESULTS.put_nowait(outcome)
+        _QUEUE.task_done()
+
+
+async def _finish(outcomes: list):
+    """
+    Записывает пачку результатов одной транзакцией вместе с ID доставленных предложений,
+    затем вызывает after_send по типам сообщений.
+    """
+    offers = [
+        (item["order_id"], item["chat_id"], item["chat_id"], result["message_id"])
+        for item, status, _, _, result in outcomes
+        if status == "sent" and item["kind"] == KIND_ORDER_OFFER and result
+    ]
+    try:
+        await outbox_finish(
+            [(item["id"], status, next_at, error) for item, status, next_at, error, _ in outcomes], offers
+        )
+    except Exception as e:
+        # Сообщения остаются 'sending' и вернутся в очередь после истечения аренды (outbox_recover)
+        logger.error(f"❌ Outbox: ошибка записи результатов ({len(outcomes)}): {e}")
+        return
+
+    delivered = {}
+    for item, status, _, _, result in outcomes:
+        if status == "sent":
+            delivered.setdefault(item["kind"], []).append((item, result))
+    for kind, messages in delivered.items():
+        after_send = _KINDS.get(kind, (None, None))[1]
+        if after_send is None:
+            continue
+        try:
+            await after_send(messages)
+        except Exception as e:
+            logger.error(f"❌ Outbox: ошибка after_send ({kind}): {e}", exc_info=True)
+
+
+async def _finisher():
+    """Собирает результаты воркеров за OUTBOX_FLUSH_INTERVAL и пишет их пачкой."""
+    loop = asyncio.get_running_loop()
+    while True:
+        outcomes = [await _RESULTS.get()]
+        deadline = loop.time() + OUTBOX_FLUSH_INTERVAL
+        while outcomes[-1] is not None:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                outcomes.append(await asyncio.wait_for(_RESULTS.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # None — сигнал остановки: записать накопленное и выйти
+        stopping = outcomes[-1] is None
+        outcomes = [outcome for outcome in outcomes if outcome is not None]
+        if outcomes:
+            await _finish(outcomes)
+        if stopping:
+            return
+
+
+async def _claimed(rows: list) -> list:
+    """Проверка before_send по типам сообщений одной пачкой; отменённые сразу помечаются 'failed'."""
+    items = [dict(zip(ROW_FIELDS, row)) for row in rows]
+    by_kind = {}
+    for item in items:
+        by_kind.setdefault(item["kind"], []).append(item)
+    skipped = set()
+    for kind, messages in by_kind.items():
+        before_send = _KINDS.get(kind, (None, None))[0]
+        if before_send is None:
+            continue
+        try:
+            allowed = await before_send(messages)
+        except Exception as e:
+            # Без проверки отправляем: лишнее предложение закроется после отправки
+            logger.error(f"❌ Outbox: ошибка before_send ({kind}): {e}")
+            continue
+        skipped.update(item["id"] for item, ok in zip(messages, allowed) if not ok)
+    if skipped:
+        OUTBOX_METRICS["skipped"] += len(skipped)
+        await outbox_finish([(outbox_id, "failed", None, "skipped") for outbox_id in skipped])
+    return [item for item in items if item["id"] not in skipped]
+
+
+async def _dispatcher():
+    """Забирает готовые сообщения из БД по приоритету и раздаёт воркерам."""
+    last_cleanup = 0.0
+    last_recover = time.monotonic()
+    while True:
+        _WAKEUP.clear()
+        try:
+            rows = await outbox_claim(OUTBOX_WORKERS, OUTBOX_LEASE_SEC)
+            items = await _claimed(rows) if rows else []
+        except Exception as e:
+            logger.error(f"❌ Outbox: ошибка чтения очереди: {e}")
+            rows = items = []
+        for item in items:
+            # Очередь ограничена: новые срочные сообщения не ждут за длинным хвостом
+            await _QUEUE.put(item)
+        if len(rows) == OUTBOX_WORKERS:
+            continue
+
+        if time.monotonic() - last_recover > OUTBOX_LEASE_SEC / 2:
+            last_recover = time.monotonic()
+            await _recover()
+
+        if time.monotonic() - last_cleanup > 3600:
+            last_cleanup = time.monotonic()
+            try:
+                removed = await outbox_cleanup(time.time() - OUTBOX_RETENTION_HOURS * 3600)
+                if removed:
+                    logger.info(f"🧹 Outbox: удалено {removed} старых сообщений")
+            except Exception as e:
+                logger.error(f"❌ Outbox: ошибка очистки: {e}")
+
+        try:
+            await asyncio.wait_for(_WAKEUP.wait(), OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _recover():
+    """Возвращает в очередь сообщения, аренда которых истекла (процесс-владелец упал)."""
+    try:
+        recovered = await outbox_recover()
+    except Exception as e:
+        logger.error(f"❌ Outbox: ошибка возврата сообщений в очередь: {e}")
+        return
+    if recovered:
+        logger.info(f"♻️ Outbox: возвращено в очередь {recovered} сообщений")
+        _WAKEUP.set()
+
+
+async def start_outbox(api_url: str):
+    """Запускает воркеры; сообщения с истёкшей арендой возвращаются в очередь."""
+    global _API_URL, _QUEUE, _RESULTS, _FINISHER
+    _API_URL = api_url
+    _QUEUE = asyncio.Queue(maxsize=OUTBOX_WORKERS)
+    _RESULTS = asyncio.Queue()
+    await _recover()
+    _FINISHER = asyncio.create_task(_finisher())
+    _TASKS.append(asyncio.create_task(_dispatcher()))
+    for _ in range(OUTBOX_WORKERS):
+        _TASKS.append(asyncio.create_task(_worker()))
+
+
+async def stop_outbox():
+    global _FINISHER
+    for task in _TASKS:
+        task.cancel()
+    await asyncio.gather(*_TASKS, return_exceptions=True)
+    _TASKS.clear()
+    if _FINISHER is not None:
+        # Результаты уже отправленных сообщений записываются, иначе после перезапуска они уйдут повторно
+        _RESULTS.put_nowait(None)
+        await asyncio.gather(_FINISHER, return_exceptions=True)
+        _FINISHER = None
+
+
+async def outbox_metrics() -> dict:
+    return {"queue": await outbox_counts(), **OUTBOX_METRICS}
@@ -0,0 +1,123 @@
+# scheduler.py
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+from typing import Optional
+
+from database import schedule_order_deadline, get_order_deadlines, claim_due_deadlines
+
+logger = logging.getLogger(__name__)
+
+# === Настройки ===
+# Через сколько секунд без единой заявки заказ отменяется автоматически
+AUTO_CANCEL_AFTER = float(os.getenv("AUTO_CANCEL_AFTER", "180"))
+
+# Срок автоотмены заказа без заявок
+AUTO_CANCEL = "auto_cancel"
+
+# Одна задача на все сроки: куча (due_at, order_id, kind) говорит, когда проснуться,
+# а что выполнять, решает БД — снятые заявкой или сменой статуса сроки там уже удалены
+# триггерами, поэтому из кучи их не вычищаем.
+_HEAP = []
+_HANDLERS = {}  # kind → async handler(order_id, arg)
+_WAKEUP = asyncio.Event()
+_TASK: Optional[asyncio.Task] = None
+SCHEDULER_METRICS = {
+    "scheduled": 0,
+    "recovered": 0,
+    "fired": 0,
+    "stale": 0,      # сроки в куче, снятые до наступления
+    "errors": 0,
+    "last_lag_ms": 0.0,
+}
+
+
+def register_handler(kind: str, handler):
+    """Обработчик наступившего срока kind: async handler(order_id, arg), arg — параметр из schedule()."""
+    _HANDLERS[kind] = handler
+
+
+def _push(due_at: float, order_id: int, kind: str):
+    entry = (due_at, order_id, kind)
+    heapq.heappush(_HEAP, entry)
+    if _HEAP[0] == entry:
+        # Новый ближайший срок: планировщик спит дольше, чем нужно
+        _WAKEUP.set()
+
+
+async def schedule(order_id: int, kind: str, delay: float, arg: Optional[int] = None):
+    """
+    Назначает (или переносит) срок kind для заказа через delay секунд с параметром arg;
+    срок сохраняется в БД и переживает перезапуск.
+    """
+    due_at = time.time() + delay
+    await schedule_order_deadline(order_id, kind, due_at, arg)
+    _push(due_at, order_id, kind)
+    SCHEDULER_METRICS["scheduled"] += 1
+
+
+async def _fire_due():
+    now = time.time()
+    if not _HEAP or _HEAP[0][0] > now:
+        return
+    SCHEDULER_METRICS["last_lag_ms"] = round((now - _HEAP[0][0]) * 1000, 2)
+    # Сначала БД: при ошибке записи сроки остаются в куче и будут забраны на следующем шаге
+    rows = await claim_due_deadlines(now)
+    popped = 0
+    while _HEAP and _HEAP[0][0] <= now:
+        heapq.heappop(_HEAP)
+        popped += 1
+    SCHEDULER_METRICS["stale"] += max(0, popped - len(rows))
+    for order_id, kind, arg in rows:
+        handler = _HANDLERS.get(kind)
+        if handler is None:
+            logger.warning(f"⚠️ Нет обработчика для срока {kind} заказа {order_id}")
+            continue
+        try:
+            await handler(order_id, arg)
+            SCHEDULER_METRICS["fired"] += 1
+        except Exception as e:
+            SCHEDULER_METRICS["errors"] += 1
+            logger.error(f"❌ Ошибка обработки срока {kind} заказа {order_id}: {e}", exc_info=True)
+
+
+async def _run():
+    while True:
+        timeout = max(0.0, _HEAP[0][0] - time.time()) if _HEAP else None
+        try:
+            await asyncio.wait_for(_WAKEUP.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        _WAKEUP.clear()
+        try:
+            await _fire_due()
+        except Exception as e:
+            logger.error(f"❌ Ошибка планировщика сроков: {e}")
+            await asyncio.sleep(1)
+
+
+async def start_scheduler():
+    """Загружает сроки, назначенные до перезапуска (просроченные выполнятся сразу), и запускает задачу."""
+    global _TASK
+    for order_id, kind, due_at in await get_order_deadlines():
+        heapq.heappush(_HEAP, (due_at, order_id, kind))
+        SCHEDULER_METRICS["recovered"] += 1
+    if _HEAP:
+        logger.info(f"⏰ Восстановлено сроков по заказам: {len(_HEAP)}")
+    _TASK = asyncio.create_task(_run())
+
+
+async def stop_scheduler():
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        await asyncio.gather(_TASK, return_exceptions=True)
+        _TASK = None
+    _HEAP.clear()
+
+
+def scheduler_metrics() -> dict:
+    return {**SCHEDULER_METRICS, "pending": len(_HEAP)}
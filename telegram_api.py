@@ -0,0 +1,247 @@
+# telegram_api.py
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Optional, Union
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Адрес сервера Bot API: для нагрузочных тестов — локальный mock_telegram.py
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+# === Настройки HTTP-клиента Bot API ===
+# Всего соединений и соединений на один хост (api.telegram.org)
+HTTP_LIMIT = int(os.getenv("TELEGRAM_HTTP_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("TELEGRAM_HTTP_LIMIT_PER_HOST", "50"))
+# Кэш DNS, секунд
+DNS_CACHE_TTL = int(os.getenv("TELEGRAM_DNS_CACHE_TTL", "300"))
+# Сколько держать простаивающее keep-alive соединение, секунд
+KEEPALIVE_TIMEOUT = float(os.getenv("TELEGRAM_KEEPALIVE_TIMEOUT", "60"))
+# Таймауты запроса, секунд
+CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+REQUEST_TIMEOUT = float(os.getenv("TELEGRAM_REQUEST_TIMEOUT", "15"))
+
+# === Лимиты Telegram ===
+# Глобально ~30 сообщений/с на бота, в один чат — около раза в секунду (с короткой пачкой)
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+PER_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1.0"))
+PER_CHAT_BURST = int(os.getenv("TELEGRAM_PER_CHAT_BURST", "3"))
+# Сколько раз повторять запрос после ответа 429
+MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# Одновременных запросов при рассылке одного заказа
+FANOUT_CONCURRENCY = int(os.getenv("TELEGRAM_FANOUT_CONCURRENCY", "20"))
+
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+def bot_api_url(token: str) -> str:
+    """Базовый URL методов бота: {TELEGRAM_API_BASE}/bot<token>."""
+    return f"{TELEGRAM_API_BASE}/bot{token}"
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Общая сессия процесса с keep-alive: TCP+TLS рукопожатие с Telegram
+    выполняется один раз, а не на каждое сообщение.
+    """
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = _create_session()
+    return _SESSION
+
+
+async def open_session():
+    """Создаёт сессию при старте приложения."""
+    get_session()
+    logger.info(f"✅ HTTP-сессия Bot API открыта (лимит {HTTP_LIMIT}, на хост {HTTP_LIMIT_PER_HOST})")
+
+
+async def close_session():
+    """Закрывает сессию при остановке приложения."""
+    global _SESSION
+    session, _SESSION = _SESSION, None
+    if session is not None and not session.closed:
+        await session.close()
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты: rate токенов в секунду, запас не больше capacity.
+    При нехватке токенов первыми обслуживаются ожидающие с меньшим priority
+    (как в outbox: предложения заказов раньше рассылок), внутри приоритета — по очереди.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []  # куча (priority, номер, future)
+        self._seq = itertools.count()
+        self._runner: Optional[asyncio.Task] = None
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = 0):
+        now = time.monotonic()
+        if not self._waiters and now >= self._paused_until:
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), granted))
+        if self._runner is None or self._runner.done() or self._runner.get_loop() is not loop:
+            self._runner = loop.create_task(self._grant())
+        # Отмена ожидания отменяет future, и раздача её пропускает
+        await granted
+
+    async def _grant(self):
+        """Раздаёт токены ожидающим по мере пополнения, пока очередь не опустеет."""
+        while True:
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                return
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            # Пока ждали токен, мог прийти более срочный запрос: он уже в голове кучи
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    self._tokens -= 1
+                    future.set_result(None)
+                    break
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (после 429 от Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class ChatThrottle:
+    """Лимит сообщений в один чат: короткая пачка до burst, дальше раз в interval секунд."""
+
+    def __init__(self, interval: float, burst: int = 1):
+        self.interval = interval
+        self.burst = burst
+        self._state = {}  # chat_id → (токены, момент обновления); минус — очередь ожидающих
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        tokens, updated = self._state.get(chat_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) / self.interval)
+        self._state[chat_id] = (tokens - 1, now)
+        if len(self._state) > 10000:
+            self._state = {k: v for k, v in self._state.items() if now - v[1] < self.interval * self.burst}
+        if tokens < 1:
+            await asyncio.sleep((1 - tokens) * self.interval)
+
+
+GLOBAL_LIMITER = TokenBucket(GLOBAL_RATE)
+CHAT_THROTTLE = ChatThrottle(PER_CHAT_INTERVAL, PER_CHAT_BURST)
+
+
+class PreparedMessage:
+    """
+    Тело запроса, сериализованное в JSON один раз: для каждого получателя
+    подставляется только chat_id (рассылка одного заказа многим водителям).
+    """
+
+    __slots__ = ("method", "_tail")
+
+    def __init__(self, method: str, payload: dict):
+        self.method = method
+        fields = {key: value for key, value in payload.items() if key != "chat_id"}
+        body = json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
+        self._tail = "," + body[1:] if fields else "}"
+
+    def body(self, chat_id: int) -> str:
+        return '{"chat_id":' + str(int(chat_id)) + self._tail
+
+
+async def call_api(api_url: str, method: str, payload: Union[dict, str, bytes], chat_id=None,
+                   priority: int = 0) -> Optional[dict]:
+    """
+    Вызывает метод Bot API с учётом лимитов и повторяет запрос после 429 (retry_after).
+    payload — dict или уже готовое JSON-тело (str/bytes, см. PreparedMessage).
+    priority — очередь к общему лимиту бота (меньше — раньше, приоритеты outbox).
+    Возвращает ответ Telegram (dict) или None при сетевой ошибке.
+    """
+    if isinstance(payload, dict):
+        request = {"json": payload}
+    else:
+        body = payload.encode() if isinstance(payload, str) else payload
+        request = {"data": body, "headers": {"Content-Type": "application/json"}}
+    for attempt in range(MAX_RETRIES + 1):
+        if chat_id is not None:
+            await CHAT_THROTTLE.wait(chat_id)
+        await GLOBAL_LIMITER.acquire(priority)
+        try:
+            async with get_session().post(f"{api_url}/{method}", **request) as response:
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"❌ {method} ({chat_id}): ошибка запроса: {e}")
+            return None
+
+        if data.get("error_code") == 429 and attempt < MAX_RETRIES:
+            retry_after = (data.get("parameters") or {}).get("retry_after", 1)
+            logger.warning(f"⏳ {method} ({chat_id}): 429, повтор через {retry_after} с")
+            GLOBAL_LIMITER.pause(retry_after)
+            continue
+        return data
+    return data
+
+
+async def fan_out(send, targets, concurrency: int = FANOUT_CONCURRENCY) -> dict:
+    """
+    Параллельно вызывает send(target) для всех targets, не больше concurrency одновременно.
+    Возвращает статистику: sent, failed, last_ms — время до последней успешной отправки.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    stats = {"sent": 0, "failed": 0, "last_ms": 0.0}
+
+    async def run(target):
+        async with semaphore:
+            try:
+                ok = await send(target)
+            except Exception as e:
+                logger.error(f"❌ Ошибка рассылки для {target}: {e}")
+                ok = False
+        if ok:
+            stats["sent"] += 1
+            stats["last_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        else:
+            stats["failed"] += 1
+
+    await asyncio.gather(*(run(target) for target in targets))
+    return stats
@@ -343,10 +343,6 @@ function showDriverModalForWeb(orderId, orderData) {
     // Функция опроса откликов водителей
     const pollBids = async () => {
         try {
-            const API_BASE_URL = window.location.hostname === 'localhost' 
-                ? 'http://localhost:8004' 
-                : 'https://taxibarsnz24.ru';
-            
             const res = await fetch(`${API_BASE_URL}/api/web/order/${orderId}/bids`);
             
             if (!res.ok) {
@@ -359,8 +355,8 @@ function showDriverModalForWeb(orderId, orderData) {
                 renderDriverBids(data.bids, orderId, orderData);
             }
             
-            // Продолжаем опрашивать, пока окно открыто
-            if (isDriverModalOpen) {
+            // Без потока событий продолжаем опрашивать, пока окно открыто
+            if (isDriverModalOpen && !bidEvents) {
                 setTimeout(pollBids, 2000);
             }
         } catch (error) {
@@ -387,7 +383,33 @@ function showDriverModalForWeb(orderId, orderData) {
         }
     };
     
-    // Запускаем опрос откликов
+    // Новые отклики приходят событием bid_created (SSE); без EventSource — опрос каждые 2 секунды
+    let bidEvents = null;
+    if (window.EventSource) {
+        bidEvents = new EventSource(`${API_BASE_URL}/api/web/order/${orderId}/events`);
+        bidEvents.addEventListener('bid_created', () => pollBids());
+        bidEvents.addEventListener('snapshot', (e) => {
+            const state = JSON.parse(e.data);
+            if (state.status === 'cancelled' || state.status === 'completed') {
+                bidEvents.close();
+            } else if (state.bids) {
+                // После переподключения: отклики могли прийти, пока потока не было
+                pollBids();
+            }
+        });
+        // После отмены или завершения сервер закрывает поток; close() не даёт браузеру
+        // переподключаться каждые несколько секунд (ссылка остаётся — опрос не включается)
+        bidEvents.addEventListener('cancelled', () => bidEvents.close());
+        bidEvents.addEventListener('completed', () => bidEvents.close());
+        bidEvents.onerror = () => {
+            if (bidEvents && bidEvents.readyState === EventSource.CLOSED) {
+                bidEvents = null;
+                pollBids();
+            }
+        };
+    }
+    
+    // Загружаем уже пришедшие отклики
     pollBids();
     
     // Функция закрытия модального окна
@@ -396,6 +418,11 @@ function showDriverModalForWeb(orderId, orderData) {
         
         isDriverModalOpen = false;
         
+        if (bidEvents) {
+            bidEvents.close();
+            bidEvents = null;
+        }
+        
         if (driverTimerInterval) {
             clearInterval(driverTimerInterval);
             driverTimerInterval = null;
@@ -1,15 +1,27 @@
 import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, WebSocket, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-import aiosqlite
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
 import uvicorn
 import os
-import aiohttp
 import json
+import time
+from collections import OrderedDict
 from datetime import datetime
+from db_pool import reader, writer, close_pools, pool_metrics
+from database import (
+    RATING_STATS_QUERY, get_dispatch_candidates, get_orders_event_state, get_order_statuses, user_cache_metrics
+)
+from telegram_api import open_session, close_session, call_api, fan_out, bot_api_url, PreparedMessage
+import outbox
+import dispatch
+import events
+import board
+import scheduler
+from broadcaster import start_broadcaster, stop_broadcaster, broadcast_metrics
 try:
     from aiogram.types import InlineKeyboardMarkup
 except ImportError:
@@ -30,7 +42,7 @@ logger = logging.getLogger(__name__)
 
 DB_PATH = "/root/test/taxi_bot.db"
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8417867887:AAFzHQcBEYc3ZOE0KkURCN8zUWIh_tysscU")
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+TELEGRAM_API_URL = bot_api_url(BOT_TOKEN)
 
 # === CORS ===
 origins = [
@@ -53,6 +65,39 @@ app.add_middleware(
 ADMINS = 257681118, 805113718
 
 
+@app.on_event("startup")
+async def on_startup():
+    import database
+    # Функции database.py (outbox, сроки, кэш пользователей) работают с database.DB_PATH:
+    # миграции и все запросы процесса должны идти в один файл
+    database.DB_PATH = DB_PATH
+    # На актуальной базе это одна проверка PRAGMA user_version
+    await database.init_db()
+    await open_session()
+    await outbox.start_outbox(TELEGRAM_API_URL)
+    await start_offer_workers()
+    await start_broadcaster(TELEGRAM_API_URL)
+    await dispatch.start_dispatch()
+    await events.start_events()
+    await board.start_board()
+    scheduler.register_handler(scheduler.AUTO_CANCEL, auto_cancel_order_if_no_bids)
+    scheduler.register_handler(dispatch.DISPATCH_DEADLINE, notify_drivers_about_order)
+    await scheduler.start_scheduler()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await scheduler.stop_scheduler()
+    await board.stop_board()
+    await events.stop_events()
+    await dispatch.stop_dispatch()
+    await stop_broadcaster()
+    await stop_offer_workers()
+    await outbox.stop_outbox()
+    await close_session()
+    await close_pools()
+
+
 def start_webapp(bot_instance):
     global bot
     bot = bot_instance
@@ -84,14 +129,22 @@ class AcceptDriverRequest(BaseModel):
 class CancelOrderRequest(BaseModel):
     reason: str = "client_cancelled"
 
+class DriverLocationRequest(BaseModel):
+    lat: float
+    lon: float
+
 # === Временное хранилище ===
-_TEMP_ORDER_DATA = {}  # order_id → dict
-_ORDER_MESSAGES = {} # Хранения id сообщений для их удаления
-CANCEL_TASKS = {} # Для хранения задачи таймеров
+# Кэш неизменяемых данных заказа (цена, координаты...) поверх колонок orders
+ORDER_META_CACHE_SIZE = int(os.getenv("ORDER_META_CACHE_SIZE", "1000"))
+ORDER_META_FIELDS = (
+    "passengers", "price", "distance_km", "estimated_time",
+    "pickup_lat", "pickup_lon", "dropoff_lat", "dropoff_lon",
+)
+_ORDER_META_CACHE = OrderedDict()  # order_id → dict, вытесняются самые старые
 
 # === Вспомогательные функции ===
 async def get_order(order_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("SELECT * FROM orders WHERE id = ?", (order_id,)) as cursor:
             row = await cursor.fetchone()
             if row:
@@ -99,103 +152,295 @@ async def get_order(order_id: int):
                 return dict(zip(columns, row))
     return None
 
-async def create_order(client_id, pickup, dropoff, comment):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO orders (client_id, pickup_address, dropoff_address, comment, status, source) VALUES (?, ?, ?, ?, 'pending', 'web')",
-            (client_id, pickup, dropoff, comment)
+async def create_order(client_id, pickup, dropoff, comment, **meta):
+    """Создаёт веб-заказ; meta — поля из ORDER_META_FIELDS."""
+    fields = {name: meta.get(name) for name in ORDER_META_FIELDS}
+    if fields["passengers"] is None:
+        fields["passengers"] = 1
+    columns = ", ".join(fields)
+    placeholders = ", ".join("?" for _ in fields)
+    async with writer(DB_PATH) as db:
+        cursor = await db.execute(
+            f"INSERT INTO orders (client_id, pickup_address, dropoff_address, comment, status, source, {columns}) "
+            f"VALUES (?, ?, ?, ?, 'pending', 'web', {placeholders})",
+            (client_id, pickup, dropoff, comment, *fields.values())
         )
         await db.commit()
-        async with db.execute("SELECT last_insert_rowid()") as cursor:
-            return (await cursor.fetchone())[0]
+        return cursor.lastrowid
 
+async def get_order_meta(order_id: int) -> dict:
+    """Цена, пассажиры и координаты заказа (read-through кэш ограниченного размера)."""
+    meta = _ORDER_META_CACHE.get(order_id)
+    if meta is not None:
+        _ORDER_META_CACHE.move_to_end(order_id)
+        return meta
+
+    async with reader(DB_PATH) as db:
+        async with db.execute(
+            f"SELECT {', '.join(ORDER_META_FIELDS)} FROM orders WHERE id = ?", (order_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return {}
+
+    meta = dict(zip(ORDER_META_FIELDS, row))
+    _ORDER_META_CACHE[order_id] = meta
+    while len(_ORDER_META_CACHE) > ORDER_META_CACHE_SIZE:
+        _ORDER_META_CACHE.popitem(last=False)
+    return meta
+
+def forget_order_meta(order_id: int):
+    """Убирает завершённый/отменённый заказ из кэша."""
+    _ORDER_META_CACHE.pop(order_id, None)
+
+
+def build_message_payload(chat_id: int, text: str, reply_markup=None) -> dict:
+    """Собирает тело запроса sendMessage (клавиатура приводится к JSON)."""
+    payload = {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": "HTML",
+        "disable_web_page_preview": True
+    }
+    if reply_markup:
+        # Convert InlineKeyboardMarkup to dictionary if needed
+        if hasattr(reply_markup, 'to_dict'):
+            # If it's an aiogram InlineKeyboardMarkup object, convert to dict
+            reply_markup = reply_markup.to_dict()
+        elif hasattr(reply_markup, 'model_dump'):
+            # aiogram 3: pydantic-модель
+            reply_markup = reply_markup.model_dump(exclude_none=True)
+        elif isinstance(reply_markup, dict):
+            # If it's already a dict, use as is
+            pass
+        else:
+            # If it's some other format, try to convert to dict
+            try:
+                reply_markup = dict(reply_markup)
+            except (TypeError, ValueError):
+                logger.warning(f"Could not convert reply_markup to dict: {type(reply_markup)}")
+                reply_markup = None
 
-async def send_telegram_message(chat_id: int, text: str, reply_markup=None):
-    """Отправляет сообщение и возвращает ID сообщения для последующего удаления"""
-    try:
-        payload = {
-            "chat_id": chat_id,
-            "text": text,
-            "parse_mode": "HTML",
-            "disable_web_page_preview": True
-        }
         if reply_markup:
-            # Convert InlineKeyboardMarkup to dictionary if needed
-            if hasattr(reply_markup, 'to_dict'):
-                # If it's an aiogram InlineKeyboardMarkup object, convert to dict
-                reply_markup = reply_markup.to_dict()
-            elif isinstance(reply_markup, dict):
-                # If it's already a dict, use as is
-                pass
-            else:
-                # If it's some other format, try to convert to dict
-                try:
-                    reply_markup = dict(reply_markup)
-                except (TypeError, ValueError):
-                    logger.warning(f"Could not convert reply_markup to dict: {type(reply_markup)}")
-                    reply_markup = None
-            
-            if reply_markup:
-                # Recursively convert any nested objects that might not be JSON serializable
-                def convert_objects(obj):
-                    if hasattr(obj, 'to_dict'):
-                        return obj.to_dict()
-                    elif isinstance(obj, dict):
-                        return {key: convert_objects(value) for key, value in obj.items()}
-                    elif isinstance(obj, list):
-                        return [convert_objects(item) for item in obj]
-                    else:
-                        return obj
-                
-                reply_markup = convert_objects(reply_markup)
-                payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
-
-        logger.debug(f"📤 Отправка сообщения на {TELEGRAM_API_URL}/sendMessage")
-        logger.debug(f"📦 Payload: {json.dumps(payload, ensure_ascii=False, indent=2)}")
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{TELEGRAM_API_URL}/sendMessage", json=payload) as response:
-                response_text = await response.text()
-                response_data = json.loads(response_text)
-                logger.debug(f"↩️ Ответ от Telegram API ({chat_id}): {response.status} {response_text}")
-
-                if response.status == 200 and response_data.get("ok"):
-                    message_id = response_data["result"]["message_id"]
-                    logger.debug(f"✅ Сообщение успешно отправлено водителю {chat_id}, ID: {message_id}")
-                    return message_id
+            # Recursively convert any nested objects that might not be JSON serializable
+            def convert_objects(obj):
+                if hasattr(obj, 'to_dict'):
+                    return obj.to_dict()
+                elif hasattr(obj, 'model_dump'):
+                    return obj.model_dump(exclude_none=True)
+                elif isinstance(obj, dict):
+                    return {key: convert_objects(value) for key, value in obj.items()}
+                elif isinstance(obj, list):
+                    return [convert_objects(item) for item in obj]
                 else:
-                    logger.error(f"❌ Ошибка Telegram API ({chat_id}): {response.status} {response_text}")
-                    return None
+                    return obj
+
+            reply_markup = convert_objects(reply_markup)
+            payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
+    return payload
+
+
+async def send_telegram_message(chat_id: int, text: str, reply_markup=None):
+    """Отправляет сообщение сразу и возвращает ID сообщения для последующего удаления"""
+    try:
+        payload = build_message_payload(chat_id, text, reply_markup)
+
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            # Форматирование payload дорогое — только при включённом DEBUG
+            logger.debug(f"📤 Отправка сообщения на {TELEGRAM_API_URL}/sendMessage")
+            logger.debug(f"📦 Payload: {json.dumps(payload, ensure_ascii=False, indent=2)}")
+
+        response_data = await call_api(TELEGRAM_API_URL, "sendMessage", payload, chat_id=chat_id)
+        if debug:
+            logger.debug(f"↩️ Ответ от Telegram API ({chat_id}): {response_data}")
+
+        if response_data and response_data.get("ok"):
+            message_id = response_data["result"]["message_id"]
+            logger.debug(f"✅ Сообщение успешно отправлено водителю {chat_id}, ID: {message_id}")
+            return message_id
+        else:
+            logger.error(f"❌ Ошибка Telegram API ({chat_id}): {response_data}")
+            return None
 
     except Exception as e:
         logger.exception(f"🚨 КРИТИЧЕСКАЯ ОШИБКА при отправке сообщения водителю {chat_id}: {e}")
         return None
 
 
-# === Функция для удаления сообщений у водителей ===
-async def delete_order_messages(order_id: int):
-    """Удаляет сообщения о заказе у всех водителей, которым они были отправлены"""
-    if order_id not in _ORDER_MESSAGES:
+async def queue_telegram_message(chat_id: int, text: str, reply_markup=None,
+                                 priority: int = outbox.PRIORITY_ORDER_UPDATE, **options) -> bool:
+    """Ставит сообщение в outbox: доставка с повторами, ответ API не ждёт Telegram."""
+    try:
+        payload = build_message_payload(chat_id, text, reply_markup)
+        return await outbox.enqueue(chat_id, payload, priority=priority, **options)
+    except Exception as e:
+        logger.exception(f"🚨 Не удалось поставить сообщение для {chat_id} в очередь: {e}")
+        return False
+
+
+# === Предложения заказов водителям (доставляет outbox) ===
+# ID доставленных предложений outbox сохраняет в driver_order_messages вместе с результатом отправки
+async def _offer_before_send(messages: list) -> list:
+    # Заказ уже принят или отменён — предложение не нужно. Один запрос на пачку
+    statuses = await get_order_statuses({message["order_id"] for message in messages})
+    return [statuses.get(message["order_id"]) == "pending" for message in messages]
+
+async def _offer_after_send(delivered: list):
+    # Пока сообщения были в пути, заказы могли принять или отменить
+    order_ids = {message["order_id"] for message, _ in delivered}
+    statuses = await get_order_statuses(order_ids)
+    for order_id in order_ids:
+        if statuses.get(order_id) != "pending":
+            close_order_offers(order_id)
+
+outbox.register_kind(outbox.KIND_ORDER_OFFER, before_send=_offer_before_send, after_send=_offer_after_send)
+
+
+# === Закрытие предложений у водителей ===
+# Когда заказ принят или отменён, предложение редактируется на месте (editMessageText):
+# кнопка исчезает, водитель видит итог. ID и состояние сообщений хранятся в
+# driver_order_messages, поэтому закрытие переживает перезапуск.
+OFFER_CLOSE_MODE = os.getenv("OFFER_CLOSE_MODE", "edit")  # edit | delete
+OFFER_WORKERS = int(os.getenv("OFFER_WORKERS", os.getenv("DELETE_WORKERS", "2")))
+OFFER_RETRY_DELAY = float(os.getenv("OFFER_RETRY_DELAY", os.getenv("DELETE_RETRY_DELAY", "30")))
+# Пауза перед обработкой: быстрые смены статуса схлопываются в одну правку
+OFFER_CLOSE_DEBOUNCE = float(os.getenv("OFFER_CLOSE_DEBOUNCE", "0.5"))
+OFFER_CLOSED_TEXT = {
+    "won": "✅ <b>Заказ №{order_id}</b> закреплён за вами.",
+    "taken": "🚫 <b>Заказ №{order_id}</b> уже взят другим водителем.",
+    "cancelled": "❌ <b>Заказ №{order_id}</b> отменён.",
+}
+_OFFER_QUEUE = asyncio.Queue()
+_OFFER_QUEUED = {}      # order_id → момент постановки в очередь
+_OFFER_RUNNING = set()  # заказы, которые сейчас обрабатывает воркер
+_OFFER_DIRTY = set()    # статус сменился во время обработки — пройти ещё раз
+_OFFER_WORKER_TASKS = []
+OFFER_METRICS = {
+    "orders_done": 0,
+    "messages_edited": 0,
+    "messages_deleted": 0,
+    "messages_failed": 0,
+    "coalesced": 0,
+    "retries": 0,
+    "last_latency_ms": 0.0,
+    "max_latency_ms": 0.0,
+}
+
+def close_order_offers(order_id: int):
+    """Ставит закрытие предложений заказа в очередь — ответ клиенту не ждёт Telegram."""
+    if order_id in _OFFER_QUEUED:
+        OFFER_METRICS["coalesced"] += 1
+        return
+    if order_id in _OFFER_RUNNING:
+        _OFFER_DIRTY.add(order_id)
         return
+    _OFFER_QUEUED[order_id] = time.monotonic()
+    asyncio.get_running_loop().call_later(OFFER_CLOSE_DEBOUNCE, _OFFER_QUEUE.put_nowait, order_id)
+
+def _offer_target_state(order: Optional[dict], driver_id: int) -> Optional[str]:
+    """Что должен видеть водитель; None — предложение остаётся открытым."""
+    if not order or order["status"] == "cancelled":
+        return "cancelled"
+    if order["status"] == "pending":
+        return None
+    return "won" if order.get("driver_id") == driver_id else "taken"
 
-    messages_to_delete = _ORDER_MESSAGES.pop(order_id)
+async def _close_offers_for_order(order_id: int) -> bool:
+    """Правит (или удаляет) сообщения параллельно. Возвращает True, если повторять не нужно."""
+    from database import get_offer_messages, set_offer_message_states, delete_driver_order_message_rows
 
-    for driver_id, message_id in messages_to_delete:
-        try:
-            payload = {
-                "chat_id": driver_id,
-                "message_id": message_id
+    # Статус читается в момент обработки: промежуточные состояния не отправляются
+    order = await get_order(order_id)
+    targets = []
+    for chat_id, message_id, driver_id, state in await get_offer_messages(order_id):
+        target = _offer_target_state(order, driver_id)
+        if target is not None and state not in (target, "deleted"):
+            targets.append((chat_id, message_id, driver_id, target))
+    updated, retry = [], []
+
+    async def close_one(message):
+        chat_id, message_id, driver_id, target = message
+        if OFFER_CLOSE_MODE == "delete":
+            method, payload = "deleteMessage", {"chat_id": chat_id, "message_id": message_id}
+        else:
+            # Без reply_markup — кнопка «Принять» убирается вместе с текстом
+            method, payload = "editMessageText", {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "text": OFFER_CLOSED_TEXT[target].format(order_id=order_id),
+                "parse_mode": "HTML",
             }
-
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{TELEGRAM_API_URL}/deleteMessage", json=payload) as response:
-                    if response.status == 200:
-                        logger.debug(f"✅ Сообщение {message_id} удалено у водителя {driver_id}")
-                    else:
-                        logger.warning(
-                            f"⚠️ Не удалось удалить сообщение {message_id} у водителя {driver_id}: {await response.text()}")
+        response_data = await call_api(TELEGRAM_API_URL, method, payload)
+        if response_data is None or response_data.get("error_code", 0) >= 500:
+            # Сетевая ошибка или сбой на стороне Telegram — повторим позже
+            retry.append(message)
+            return False
+        description = response_data.get("description", "")
+        if response_data.get("ok") or "message is not modified" in description:
+            updated.append((chat_id, message_id, "deleted" if method == "deleteMessage" else target))
+            logger.debug(f"✅ Предложение {message_id} у водителя {driver_id}: {target}")
+            return True
+        # Сообщение удалено водителем или слишком старое — повтор не поможет
+        logger.warning(f"⚠️ Не удалось закрыть предложение {message_id} у водителя {driver_id}: {response_data}")
+        OFFER_METRICS["messages_failed"] += 1
+        updated.append((chat_id, message_id, "deleted"))
+        return False
+
+    stats = await fan_out(close_one, targets)
+    OFFER_METRICS["messages_deleted" if OFFER_CLOSE_MODE == "delete" else "messages_edited"] += stats["sent"]
+    if OFFER_CLOSE_MODE == "delete":
+        await delete_driver_order_message_rows(order_id, [(chat_id, message_id) for chat_id, message_id, _ in updated])
+    else:
+        await set_offer_message_states(order_id, updated)
+    return not retry
+
+async def _offer_worker():
+    while True:
+        order_id = await _OFFER_QUEUE.get()
+        enqueued_at = _OFFER_QUEUED.pop(order_id, None)
+        _OFFER_RUNNING.add(order_id)
+        try:
+            finished = await _close_offers_for_order(order_id)
         except Exception as e:
-            logger.error(f"❌ Ошибка при удалении сообщения {message_id} у водителя {driver_id}: {e}")
+            logger.error(f"❌ Ошибка при закрытии предложений заказа {order_id}: {e}", exc_info=True)
+            finished = False
+        _OFFER_RUNNING.discard(order_id)
+        if order_id in _OFFER_DIRTY:
+            _OFFER_DIRTY.discard(order_id)
+            close_order_offers(order_id)
+        elif finished:
+            latency = round((time.monotonic() - (enqueued_at or time.monotonic())) * 1000, 1)
+            OFFER_METRICS["orders_done"] += 1
+            OFFER_METRICS["last_latency_ms"] = latency
+            OFFER_METRICS["max_latency_ms"] = max(OFFER_METRICS["max_latency_ms"], latency)
+        else:
+            OFFER_METRICS["retries"] += 1
+            # Заказ считается поставленным: смены статуса до повтора схлопнутся в него
+            _OFFER_QUEUED[order_id] = enqueued_at or time.monotonic()
+            asyncio.get_running_loop().call_later(OFFER_RETRY_DELAY, _OFFER_QUEUE.put_nowait, order_id)
+        _OFFER_QUEUE.task_done()
+
+async def start_offer_workers():
+    """Запускает воркеры и закрывает предложения, оставшиеся открытыми с прошлого запуска."""
+    from database import get_orders_with_stale_messages, purge_closed_offer_messages
+    for _ in range(OFFER_WORKERS):
+        _OFFER_WORKER_TASKS.append(asyncio.create_task(_offer_worker()))
+    for order_id in await get_orders_with_stale_messages():
+        close_order_offers(order_id)
+    await purge_closed_offer_messages()
+
+async def stop_offer_workers():
+    for task in _OFFER_WORKER_TASKS:
+        task.cancel()
+    _OFFER_WORKER_TASKS.clear()
+
+def offer_metrics() -> dict:
+    return {
+        "mode": OFFER_CLOSE_MODE,
+        "in_progress": len(_OFFER_QUEUED) + len(_OFFER_RUNNING),
+        **OFFER_METRICS,
+    }
 
 def get_client_status(ride_count: int) -> tuple[str, str]:
     if ride_count >= 30:
@@ -210,7 +455,7 @@ def get_client_status(ride_count: int) -> tuple[str, str]:
 # Добавьте эти функции перед определением эндпоинтов
 async def has_user_rated(order_id: int, user_id: int) -> bool:
     """Проверяет, оценил ли пользователь этот заказ."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader(DB_PATH) as db:
         async with db.execute("""
             SELECT 1 FROM ratings 
             WHERE order_id = ? AND rater_id = ?
@@ -219,7 +464,7 @@ async def has_user_rated(order_id: int, user_id: int) -> bool:
 
 async def save_rating(order_id: int, rater_id: int, target_id: int, rating: int, comment: str = ""):
     """Сохраняет оценку в базу данных (без комментария)."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer(DB_PATH) as db:
         await db.execute("""
             INSERT INTO ratings (order_id, rater_id, target_id, rating)
             VALUES (?, ?, ?, ?)
@@ -228,71 +473,54 @@ async def save_rating(order_id: int, rater_id: int, target_id: int, rating: int,
 
 async def get_user_role(user_id: int) -> str:
     """Возвращает роль пользователя (client/driver)."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT role FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else "client"  # По умолчанию client
+    from database import get_user_role as get_cached_role
+    return await get_cached_role(user_id) or "client"  # По умолчанию client
 
 async def get_user_username(user_id: int) -> str:
     """Возвращает username пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT username FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row and row[0] else f"ID_{user_id}"
+    from database import get_user_username as get_cached_username
+    return await get_cached_username(user_id) or f"ID_{user_id}"
 
 # === Основная функция уведомления ===
-async def notify_drivers_about_order(
-    order_id: int,
-    passengers: int = 1,
-    price: float = 0.0,
-    pickup_lat: Optional[float] = None,
-    pickup_lon: Optional[float] = None,
-    dropoff_lat: Optional[float] = None,
-    dropoff_lon: Optional[float] = None,
-):
-    _TEMP_ORDER_DATA[order_id] = {
-        "passengers": passengers,
-        "price": price,
-        "pickup_lat": pickup_lat,
-        "pickup_lon": pickup_lon,
-        "dropoff_lat": dropoff_lat,
-        "dropoff_lon": dropoff_lon,
-    }
-
+async def notify_drivers_about_order(order_id: int, wave_offset: Optional[int] = None):
+    """
+    Срок dispatch_wave (scheduler.py): рассылка заказа водителям. wave_offset — сколько водителей
+    уже уведомлено предыдущими волнами; следующую волну назначает dispatch.dispatch_wave.
+    """
+    wave_offset = wave_offset or 0
     order = await get_order(order_id)
     if not order or order["status"] != "pending":
         return
+    if wave_offset and not await dispatch.next_wave_needed(order_id):
+        return
 
-    # Инициализируем список для хранения ID сообщений
-    _ORDER_MESSAGES[order_id] = []
+    meta = await get_order_meta(order_id)
+    passengers = meta.get("passengers") or 1
+    price = meta.get("price") or 0.0
+    pickup_lat, pickup_lon = meta.get("pickup_lat"), meta.get("pickup_lon")
 
     client_id = order["client_id"]
 
-    # 🔥 Рейтинг клиента
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT AVG(rating) FROM ratings WHERE target_id = ?", (client_id,)) as cursor:
+    async with reader(DB_PATH) as db:
+        # 🔥 Рейтинг клиента
+        async with db.execute(RATING_STATS_QUERY, (client_id,)) as cursor:
             row = await cursor.fetchone()
             client_rating = round(row[0], 1) if row and row[0] is not None else 0.0
 
-    # 🔥 Статус клиента (как в основном боте)
-    async with aiosqlite.connect(DB_PATH) as db:
+        # 🔥 Статус клиента (как в основном боте)
         async with db.execute(
             "SELECT ride_count FROM monthly_rides WHERE user_id = ? AND year_month = ?",
             (client_id, datetime.now().strftime("%Y-%m"))
         ) as cursor:
             row = await cursor.fetchone()
             rides = row[0] if row else 0
+
+    # 🔥 Только водители со сменой = 1 И is_verified = 1: свободные, ближе и с рейтингом выше — раньше
+    drivers = dispatch.rank_drivers(await get_dispatch_candidates(), pickup_lat, pickup_lon)
+
     status_name, status_emoji = get_client_status(rides)
     client_status_display = f"{status_emoji} {status_name}"
 
-    # 🔥 Только водители со сменой = 1 И is_verified = 1
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id FROM users 
-            WHERE role = 'driver' AND shift_opened = 1 AND is_verified = 1
-        """) as cursor:
-            drivers = [row[0] for row in await cursor.fetchall()]
-
     if not drivers:
         logger.warning(f"Нет активных водителей для заказа {order_id}")
         return
@@ -319,47 +547,100 @@ async def notify_drivers_about_order(
 
     keyboard = {"inline_keyboard": [[{"text": "✅ Принять заказ", "callback_data": f"accept_{order_id}"}]]}
 
-    for driver_id in drivers:
-        # Используем новую функцию для получения ID сообщения
-        message_id = await send_telegram_message(driver_id, message_text, reply_markup=keyboard)
-        if message_id:
-            _ORDER_MESSAGES[order_id].append((driver_id, message_id))
-        else:
-            logger.warning(f"Не удалось получить ID сообщения для водителя {driver_id}")
-
-async def auto_cancel_order_if_no_bids(order_id: int, client_id: int):
-    """Автоматически отменяет заказ если нет откликов через 180 секунд"""
-    # Регистрируем задачу в глобальном словаре
-    task = asyncio.current_task()
-    CANCEL_TASKS[order_id] = task
-    await asyncio.sleep(180)  # 3 минуты ожидания
-
-    # Проверяем актуальный статус заказа
-    order = await get_order(order_id)
-    if not order or order["status"] != "pending":
-        logger.debug(f"Заказ {order_id} уже обработан (статус: {order['status'] if order else 'unknown'})")
-        return
+    # Текст и клавиатура сериализуются один раз на заказ, для водителя меняется только chat_id
+    prepared = PreparedMessage("sendMessage", build_message_payload(0, message_text, keyboard))
+
+    async def send_offers(driver_ids) -> int:
+        added = await outbox.enqueue_many([
+            outbox.message(
+                driver_id, prepared.body(driver_id),
+                priority=outbox.PRIORITY_ORDER_OFFER,
+                dedup_key=f"offer:{order_id}:{driver_id}",
+                kind=outbox.KIND_ORDER_OFFER,
+                order_id=order_id,
+            )
+            for driver_id in driver_ids
+        ])
+        logger.info(f"📣 Заказ {order_id}: в очередь поставлено {added}/{len(driver_ids)} предложений водителям")
+        return added
+
+    if dispatch.DISPATCH_WAVES:
+        # Следующая волна — только если предыдущие не принесли заявок
+        await dispatch.dispatch_wave(order_id, drivers, send_offers, wave_offset)
+    else:
+        await send_offers(drivers)
 
+async def auto_cancel_order_if_no_bids(order_id: int, arg: Optional[int] = None):
+    """
+    Срок auto_cancel наступил: откликов не было (первая заявка снимает срок триггером в БД),
+    заказ отменяется автоматически. Вызывается планировщиком scheduler.py.
+    """
     try:
-        # Используем существующий механизм отмены заказов
-        from database import cancel_order_with_reason
-        await cancel_order_with_reason(order_id, "Никто не откликнулся")
-        # === 🗑️ УДАЛЯЕМ СООБЩЕНИЯ У ВСЕХ ВОДИТЕЛЕЙ ===
-        await delete_order_messages(order_id)
+        # Статус и заявки проверяются в том же UPDATE: заявка или принятие между
+        # срабатыванием срока и отменой не будут перезаписаны
+        from database import cancel_order_if_no_bids
+        client_id = await cancel_order_if_no_bids(order_id, "Никто не откликнулся")
+        if client_id is None:
+            logger.debug(f"Заказ {order_id} уже обработан или получил заявку, автоотмена не нужна")
+            return
+        events.HUB.order_changed(order_id, status="cancelled")
+        board.refresh_soon()
+        # === 🔒 ЗАКРЫВАЕМ ПРЕДЛОЖЕНИЯ У ВСЕХ ВОДИТЕЛЕЙ ===
+        close_order_offers(order_id)
         # Очищаем временные данные
-        _TEMP_ORDER_DATA.pop(order_id, None)
+        forget_order_meta(order_id)
 
         # Уведомляем клиента
-        await send_telegram_message(
+        await queue_telegram_message(
             client_id,
-            f"❌ Заказ №{order_id} отменён автоматически: не найдено водителей в течение 3 минут."
+            f"❌ Заказ №{order_id} отменён автоматически: не найдено водителей в течение "
+            f"{scheduler.AUTO_CANCEL_AFTER / 60:g} мин."
         )
         logger.info(f"✅ Заказ {order_id} автоматически отменён по таймауту")
     except Exception as e:
         logger.error(f"❌ Ошибка при автоматической отмене заказа {order_id}: {e}", exc_info=True)
-    finally:
-        # Всегда удаляем задачу из словаря при завершении
-        CANCEL_TASKS.pop(order_id, None)
+
+# === Условные запросы (ETag) и long-poll ===
+# Максимальное ожидание изменений заказа в запросе с ?since=, секунд
+LONG_POLL_TIMEOUT = float(os.getenv("LONG_POLL_TIMEOUT", "25"))
+
+def order_etag(version: int) -> str:
+    return f'"v{version}"'
+
+def _client_version(if_none_match: Optional[str], since: Optional[int]) -> Optional[int]:
+    if since is not None:
+        return since
+    if not if_none_match:
+        return None
+    tag = if_none_match.split(",")[0].strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    try:
+        return int(tag.strip('"').lstrip("v"))
+    except ValueError:
+        return None
+
+async def not_modified(order_id: int, if_none_match: Optional[str], since: Optional[int],
+                       timeout: float) -> Optional[Response]:
+    """
+    304 без обращения к SQLite, если у клиента текущая версия заказа (If-None-Match или ?since=).
+    С ?since= запрос ждёт изменения заказа до timeout секунд (long-poll).
+    None — нужен полный ответ.
+    """
+    # Пока клиент опрашивает заказ, его версию поддерживает фоновая выборка events
+    events.HUB.lease(order_id)
+    client_version = _client_version(if_none_match, since)
+    current = events.HUB.version(order_id)
+    if client_version is None or current is None or client_version != current:
+        return None
+    if since is not None and await events.HUB.wait_changed(order_id, max(0.0, min(timeout, LONG_POLL_TIMEOUT))):
+        return None
+    return Response(status_code=304, headers={"ETag": order_etag(current), "Cache-Control": "no-cache"})
+
+def set_order_etag(response: Response, version: int):
+    # no-cache: браузер повторяет запрос с If-None-Match и получает 304 вместо тела
+    response.headers["ETag"] = order_etag(version)
+    response.headers["Cache-Control"] = "no-cache"
 
 # === Эндпоинты ===
 @app.post("/api/web/order/create")
@@ -369,39 +650,25 @@ async def create_web_order(order_data: CreateOrderRequest):
             client_id=order_data.client_id,
             pickup=order_data.pickup_address,
             dropoff=order_data.dropoff_address,
-            comment=order_data.comment
-        )
-
-        # Сохраняем ВСЕ данные заказа
-        _TEMP_ORDER_DATA[order_id] = {
-            "passengers": order_data.passengers,
-            "price": order_data.price,
-            "pickup_lat": order_data.pickup_lat,
-            "pickup_lon": order_data.pickup_lon,
-            "dropoff_lat": order_data.dropoff_lat,
-            "dropoff_lon": order_data.dropoff_lon,
-            "distance": order_data.distance_km,  # Добавлено поле расстояния
-            "estimated_time": order_data.estimated_time_min,  # Добавлено поле времени
-            "client_id": order_data.client_id,
-            "pickup_address": order_data.pickup_address,
-            "dropoff_address": order_data.dropoff_address,
-            "comment": order_data.comment
-        }
-
-        # Начинаем уведомление водителей
-        asyncio.create_task(notify_drivers_about_order(
-            order_id=order_id,
+            comment=order_data.comment,
             passengers=order_data.passengers,
             price=order_data.price,
+            distance_km=order_data.distance_km,
+            estimated_time=order_data.estimated_time_min,
             pickup_lat=order_data.pickup_lat,
             pickup_lon=order_data.pickup_lon,
             dropoff_lat=order_data.dropoff_lat,
             dropoff_lon=order_data.dropoff_lon,
-        ))
+        )
+
+        board.refresh_soon()
 
-        # Запускаем таймер автоматической отмены
-        task = asyncio.create_task(auto_cancel_order_if_no_bids(order_id, order_data.client_id))
-        CANCEL_TASKS[order_id] = task  # Сохраняем ссылку на задачу
+        # Срок автоматической отмены: снимется первой заявкой или сменой статуса.
+        # Назначается до рассылки: волны подстраиваются под него
+        await scheduler.schedule(order_id, scheduler.AUTO_CANCEL, scheduler.AUTO_CANCEL_AFTER)
+        # Рассылка водителям — срок в scheduler: первая волна уходит сразу, следующие
+        # назначаются так же и переживают перезапуск
+        await scheduler.schedule(order_id, dispatch.DISPATCH_DEADLINE, 0, 0)
 
         return {"success": True, "order_id": order_id}
     except Exception as e:
@@ -409,18 +676,29 @@ async def create_web_order(order_data: CreateOrderRequest):
         raise HTTPException(status_code=500, detail="Ошибка при создании заказа")
 
 @app.get("/api/web/order/{order_id}/bids")
-async def get_order_bids(order_id: int):
+async def get_order_bids(order_id: int, response: Response, since: Optional[int] = None,
+                         timeout: float = LONG_POLL_TIMEOUT, if_none_match: Optional[str] = Header(None)):
     try:
-        from database import get_bids_for_order, get_driver_rating
+        from database import get_bids_with_ratings
+
+        cached = await not_modified(order_id, if_none_match, since, timeout)
+        if cached is not None:
+            return cached
 
-        bids = await get_bids_for_order(order_id)
+        # Версия читается до заявок: ETag никогда не новее данных в ответе
+        state = (await get_orders_event_state([order_id])).get(order_id)
+        if state is not None:
+            events.HUB.observe(order_id, **events.state_from_row(state))
+            set_order_etag(response, state[4])
+        version = state[4] if state else None
+
+        bids = await get_bids_with_ratings(order_id)
         if not bids:
-            return {"success": True, "bids": [], "count": 0}
+            return {"success": True, "bids": [], "count": 0, "version": version}
 
         result = []
         for bid in bids:
-            driver_id, car_brand, car_number, arrival_minutes, has_co_driver = bid
-            rating = await get_driver_rating(driver_id)
+            driver_id, car_brand, car_number, arrival_minutes, has_co_driver, rating = bid
             result.append({
                 "driver_id": driver_id,
                 "car_brand": car_brand or "Не указано",
@@ -431,17 +709,11 @@ async def get_order_bids(order_id: int):
                 "driver_rating": rating
             })
 
-        # 🔥 ОТМЕНЯЕМ ТАЙМЕР АВТОМАТИЧЕСКОЙ ОТМЕНЫ
-        if order_id in CANCEL_TASKS:
-            task = CANCEL_TASKS.pop(order_id)
-            if not task.done():  # Проверяем, не завершена ли задача уже
-                task.cancel()
-                logger.info(f"⏰ Таймер отмены заказа {order_id} успешно отменён")
-
         return {
             "success": True,
             "bids": result,
-            "count": len(result)
+            "count": len(result),
+            "version": version
         }
     except Exception as e:
         logger.error(f"Ошибка при получении откликов для заказа {order_id}: {e}", exc_info=True)
@@ -456,20 +728,18 @@ async def accept_driver(order_id: int, data: AcceptDriverRequest):
         if not order:
             raise HTTPException(status_code=404, detail="Заказ не найден")
 
-        # Проверяем, не занят ли водитель другим активным заказом
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute("SELECT id FROM orders WHERE driver_id = ? AND status = 'accepted'", (data.driver_id,)) as cursor:
-                active_orders = await cursor.fetchall()
-                if active_orders:
-                    raise HTTPException(status_code=400, detail="Водитель уже выполняет другой заказ. Пожалуйста выберите другого.")
-
-        from database import accept_bid
-        success = await accept_bid(order_id, data.driver_id)
-        if not success:
+        # Проверка занятости водителя и назначение — одна атомарная операция
+        from database import try_accept_bid, ACCEPT_OK, ACCEPT_DRIVER_BUSY
+        result = await try_accept_bid(order_id, data.driver_id)
+        if result == ACCEPT_DRIVER_BUSY:
+            raise HTTPException(status_code=400, detail="Водитель уже выполняет другой заказ. Пожалуйста выберите другого.")
+        if result != ACCEPT_OK:
             raise HTTPException(status_code=400, detail="Невозможно принять водителя")
+        events.HUB.order_changed(order_id, status="accepted", driver_id=data.driver_id)
+        board.refresh_soon()
 
-        # === 🗑️ УДАЛЯЕМ СООБЩЕНИЯ У ВСЕХ ВОДИТЕЛЕЙ ===
-        await delete_order_messages(order_id)
+        # === 🔒 ЗАКРЫВАЕМ ПРЕДЛОЖЕНИЯ У ВСЕХ ВОДИТЕЛЕЙ (в фоне) ===
+        close_order_offers(order_id)
 
         # === 1. Отправляем активное меню водителю ===
         pickup = order["pickup_address"]
@@ -493,11 +763,13 @@ async def accept_driver(order_id: int, data: AcceptDriverRequest):
             ]
         }
 
-        await send_telegram_message(data.driver_id, menu_text, reply_markup=menu_keyboard)
+        await queue_telegram_message(
+            data.driver_id, menu_text, reply_markup=menu_keyboard, dedup_key=f"menu:{order_id}:{data.driver_id}"
+        )
 
         # === 2. Отправляем кнопку «Маршрут» ===
-        temp = _TEMP_ORDER_DATA.get(order_id, {})
-        logger.info(f"🔍 Временные данные для заказа {order_id}: {temp}")
+        temp = await get_order_meta(order_id)
+        logger.info(f"🔍 Данные заказа {order_id}: {temp}")
 
         pickup_lat = temp.get("pickup_lat")
         pickup_lon = temp.get("pickup_lon")
@@ -513,16 +785,17 @@ async def accept_driver(order_id: int, data: AcceptDriverRequest):
                 ]
             }
 
-            route_message = await send_telegram_message(
+            route_queued = await queue_telegram_message(
                 data.driver_id,
                 "✅ Вы приняли заказ. Откройте маршрут к клиенту:",
-                reply_markup=route_keyboard
+                reply_markup=route_keyboard,
+                dedup_key=f"route:{order_id}:{data.driver_id}"
             )
 
             logger.info(
-                f"✅ Кнопка маршрута отправлена водителю {data.driver_id} для заказа {order_id}. Результат: {route_message}")
+                f"✅ Кнопка маршрута поставлена в очередь водителю {data.driver_id} для заказа {order_id}. Результат: {route_queued}")
         else:
-            logger.error(f"❌ Координаты не найдены в _TEMP_ORDER_DATA для заказа {order_id}. Данные: {temp}")
+            logger.error(f"❌ Координаты не найдены для заказа {order_id}. Данные: {temp}")
 
         return {"success": True, "message": "Водитель принят"}
     except HTTPException:
@@ -534,15 +807,21 @@ async def accept_driver(order_id: int, data: AcceptDriverRequest):
 
 
 @app.get("/api/web/order/{order_id}")
-async def get_order_details(order_id: int):
+async def get_order_details(order_id: int, response: Response, since: Optional[int] = None,
+                            timeout: float = LONG_POLL_TIMEOUT, if_none_match: Optional[str] = Header(None)):
     try:
+        cached = await not_modified(order_id, if_none_match, since, timeout)
+        if cached is not None:
+            return cached
+
         order = await get_order(order_id)
         if not order:
             raise HTTPException(status_code=404, detail="Заказ не найден")
+        set_order_etag(response, order["version"])
 
         # 🔥 Получаем статус прибытия водителя из БД
         is_arrived = False
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with reader(DB_PATH) as db:
             async with db.execute(
                     "SELECT driver_arrived FROM orders WHERE id = ?",
                     (order_id,)
@@ -576,36 +855,50 @@ async def get_order_details(order_id: int):
                 "created_at": order["created_at"],
                 "cancelled_by": order.get("cancelled_by"),
                 "driver_arrived": is_arrived,  # 🔥 Теперь получаем из БД
-                "driver": driver_info
+                "driver": driver_info,
+                "version": order["version"]
             }
         }
     except Exception as e:
         logger.error(f"❌ Ошибка при получении деталей заказа {order_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/web/order/{order_id}/events")
+async def order_events(order_id: int):
+    """
+    Поток событий заказа (Server-Sent Events) вместо опроса каждые 2–3 секунды:
+    snapshot, bid_created, accepted, driver_arrived, cancelled, completed.
+    Данные каждого события — текущее состояние: status, driver_id, driver_arrived, bids.
+    """
+    if not await get_order(order_id):
+        raise HTTPException(status_code=404, detail="Заказ не найден")
+    return StreamingResponse(
+        events.order_event_stream(order_id),
+        media_type="text/event-stream",
+        # Без буферизации в nginx, иначе события приходят пачками
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/api/web/order/{order_id}/cancel")
 async def cancel_order_api(order_id: int, cancel_data: CancelOrderRequest):
     try:
-        # ✅ Отменяем таймер при ручной отмене
-        if order_id in CANCEL_TASKS:
-            task = CANCEL_TASKS.pop(order_id)
-            if not task.done():
-                task.cancel()
-                logger.info(f"⏰ Таймер отменён при ручной отмене заказа {order_id}")
-        await delete_order_messages(order_id)
+        # Срок автоотмены снимается триггером при смене статуса
         from database import cancel_order_with_reason
         await cancel_order_with_reason(order_id, cancel_data.reason)
+        events.HUB.order_changed(order_id, status="cancelled")
+        board.refresh_soon()
+        forget_order_meta(order_id)
+        # === 🔒 ЗАКРЫВАЕМ ПРЕДЛОЖЕНИЯ У ВСЕХ ВОДИТЕЛЕЙ (в фоне) ===
+        close_order_offers(order_id)
 
         # Используем ЛОКАЛЬНУЮ функцию get_order
         order = await get_order(order_id)
         driver_id = order.get("driver_id") if order else None
         if driver_id:
-            await send_telegram_message(
+            await queue_telegram_message(
                 driver_id,
                 f"❌ Заказ №{order_id} отменён клиентом."
             )
-             # === 🗑️ УДАЛЯЕМ СООБЩЕНИЯ У ВСЕХ ВОДИТЕЛЕЙ ===
-            await delete_order_messages(order_id)
 
         return {"success": True, "message": "Заказ отменён"}
     except Exception as e:
@@ -620,6 +913,8 @@ async def complete_order_api(order_id: int):
         from keyboards import rating_keyboard
         from main import bot
         await complete_order(order_id)
+        events.HUB.order_changed(order_id, status="completed")
+        forget_order_meta(order_id)
         
         # Используем ЛОКАЛЬНУЮ функцию get_order вместо импортированной
         order = await get_order(order_id)
@@ -630,11 +925,11 @@ async def complete_order_api(order_id: int):
             client_id = order["client_id"]
             
             # Уведомляем водителя об успешном завершении
-            await send_telegram_message(
+            await queue_telegram_message(
                 driver_id,
                 f"🎉 Заказ №{order_id} успешно завершен! Спасибо за работу."
             )
-            logger.info(f"✅ Уведомление о завершении отправлено водителю {driver_id}")
+            logger.info(f"✅ Уведомление о завершении поставлено в очередь водителю {driver_id}")
             
             # Отправляем запрос на оценку водителя клиенту (аналогично Telegram-версии)
             already_client_rated = await has_user_rated(order_id, client_id)
@@ -653,11 +948,11 @@ async def complete_order_api(order_id: int):
             already_driver_rated = await has_user_rated(order_id, driver_id)
             if not already_driver_rated:
                 try:
-                    await send_telegram_message(
+                    await queue_telegram_message(
                         driver_id,
                         f"🏁 Заказ №{order_id} завершён. Оцените клиента:"
                     )
-                    await send_telegram_message(
+                    await queue_telegram_message(
                         driver_id,
                         "Поставьте оценку клиенту от 1 до 5:",
                         reply_markup=rating_keyboard(client_id, order_id)
@@ -717,14 +1012,14 @@ async def submit_rating(rating_data: dict):
             # Отправляем сообщение всем администраторам
             for admin_id in ADMINS:
                 try:
-                    await send_telegram_message(admin_id, admin_msg)
+                    await queue_telegram_message(admin_id, admin_msg, priority=outbox.PRIORITY_DEFAULT)
                 except Exception as e:
                     logging.error(f"Не удалось отправить комментарий админу {admin_id}: {e}")
 
             # Отправляем комментарий целевому пользователю
             target_msg = f"💬 Пользователь оставил комментарий к оценке {rating} за заказ №{order_id}:\n{comment}"
             try:
-                await send_telegram_message(target_id, target_msg)
+                await queue_telegram_message(target_id, target_msg, priority=outbox.PRIORITY_DEFAULT)
             except Exception as e:
                 logging.warning(f"Не удалось отправить комментарий пользователю {target_id}: {e}")
 
@@ -737,7 +1032,7 @@ async def submit_rating(rating_data: dict):
 @app.get("/api/web/user/{user_id}/active-order")
 async def get_active_order(user_id: int):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with reader(DB_PATH) as db:
             query = """
             SELECT * FROM orders 
             WHERE client_id = ? 
@@ -753,9 +1048,6 @@ async def get_active_order(user_id: int):
                 columns = [desc[0] for desc in cursor.description]
                 order = dict(zip(columns, row))
 
-                # Получаем данные из временного хранилища
-                temp_data = _TEMP_ORDER_DATA.get(order["id"], {})
-
                 # Получаем информацию о водителе
                 driver_info = None
                 if order.get("driver_id"):
@@ -771,9 +1063,7 @@ async def get_active_order(user_id: int):
 
                             # Получаем рейтинг водителя
                             driver_rating = 4.8
-                            async with db.execute("""
-                                SELECT AVG(rating) FROM ratings WHERE target_id = ?
-                            """, (order["driver_id"],)) as rating_cursor:
+                            async with db.execute(RATING_STATS_QUERY, (order["driver_id"],)) as rating_cursor:
                                 rating_row = await rating_cursor.fetchone()
                                 if rating_row and rating_row[0] is not None:
                                     driver_rating = round(rating_row[0], 1)
@@ -794,21 +1084,15 @@ async def get_active_order(user_id: int):
                     "dropoff_address": order["dropoff_address"],
                     "comment": order.get("comment", ""),
                     "created_at": order["created_at"],
-                    "price": order.get("price", 0) or temp_data.get("price", 0),
-                    "distance_km": temp_data.get("distance", 0.0),
-                    "estimated_time_min": temp_data.get("estimated_time", "15 минут"),
-                    "passengers": order.get("passengers", 1) or temp_data.get("passengers", 1),
+                    "price": order.get("price") or 0,
+                    "distance_km": order.get("distance_km") or 0.0,
+                    "estimated_time_min": order.get("estimated_time") or "15 минут",
+                    "passengers": order.get("passengers") or 1,
                     "driver_id": order.get("driver_id"),
-                    "pickup_coordinates": [
-                        order.get("pickup_lat", 0) or temp_data.get("pickup_lat", 0),
-                        order.get("pickup_lon", 0) or temp_data.get("pickup_lon", 0)
-                    ] if (order.get("pickup_lat") or temp_data.get("pickup_lat")) and (
-                                order.get("pickup_lon") or temp_data.get("pickup_lon")) else None,
-                    "dropoff_coordinates": [
-                        order.get("dropoff_lat", 0) or temp_data.get("dropoff_lat", 0),
-                        order.get("dropoff_lon", 0) or temp_data.get("dropoff_lon", 0)
-                    ] if (order.get("dropoff_lat") or temp_data.get("dropoff_lat")) and (
-                                order.get("dropoff_lon") or temp_data.get("dropoff_lon")) else None
+                    "pickup_coordinates": [order["pickup_lat"], order["pickup_lon"]]
+                    if order.get("pickup_lat") and order.get("pickup_lon") else None,
+                    "dropoff_coordinates": [order["dropoff_lat"], order["dropoff_lon"]]
+                    if order.get("dropoff_lat") and order.get("dropoff_lon") else None
                 }
 
                 # Добавляем информацию о водителе
@@ -832,8 +1116,8 @@ async def get_active_order(user_id: int):
 async def get_user_profile(user_id: int):
     try:
         # Рейтинг
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute("SELECT AVG(rating) FROM ratings WHERE target_id = ?", (user_id,)) as cursor:
+        async with reader(DB_PATH) as db:
+            async with db.execute(RATING_STATS_QUERY, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 avg_rating = round(row[0], 1) if row and row[0] is not None else 0.0
 
@@ -858,10 +1142,53 @@ async def get_user_profile(user_id: int):
         logger.error(f"Ошибка профиля {user_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка загрузки профиля")
 
+@app.post("/api/web/driver/{driver_id}/location")
+async def update_driver_location_api(driver_id: int, location: DriverLocationRequest):
+    """Последняя геопозиция водителя для рассылки заказов по близости."""
+    if not (-90 <= location.lat <= 90 and -180 <= location.lon <= 180):
+        raise HTTPException(status_code=400, detail="Некорректные координаты")
+    if await get_user_role(driver_id) != "driver":
+        raise HTTPException(status_code=404, detail="Водитель не найден")
+    dispatch.update_driver_location(driver_id, location.lat, location.lon)
+    return {"success": True}
+
+@app.websocket("/ws/driver/{driver_id}/board")
+async def driver_order_board(websocket: WebSocket, driver_id: int):
+    """
+    Доска ожидающих заказов рядом с водителем без сообщений в Telegram.
+    Сервер: {"type": "snapshot", "orders": [...]}, затем {"type": "diff", "add": [...], "remove": [id, ...]}
+    и {"type": "ping"}. Клиент отвечает {"type": "pong"} и может прислать
+    {"type": "location", "lat": ..., "lon": ...}.
+    """
+    from database import is_driver_verified
+    if not await is_driver_verified(driver_id):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    await board.serve_driver(websocket, driver_id)
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/health/db")
+async def db_pool_health():
+    return {"status": "ok", "pools": pool_metrics()}
+
+@app.get("/health/workers")
+async def workers_health():
+    return {
+        "status": "ok",
+        "offers": offer_metrics(),
+        "outbox": await outbox.outbox_metrics(),
+        "broadcasts": broadcast_metrics(),
+        "dispatch": dispatch.dispatch_metrics(),
+        "events": events.events_metrics(),
+        "board": board.board_metrics(),
+        "scheduler": scheduler.scheduler_metrics(),
+        "user_cache": user_cache_metrics(),
+    }
+
 # === Запуск ===
 if __name__ == "__main__":
     uvicorn.run("webapp:app", host="0.0.0.0", port=8004, log_level="info")
\ No newline at end of file